@@ -4,7 +4,8 @@ created by Xiao Wang
 University of Arizona, Tucson, AZ
 """
 
-import inspect, functools, time, sys, glob, math, traceback, random
+import inspect, functools, time, sys, glob, math, traceback, random, warnings
+import threading, queue
 import cv2
 from pylablib.devices import Thorlabs
 import pypylon.pylon as py
@@ -12,6 +13,182 @@ import numpy as np
 from typing import Any
 
 
+class FrameStatsAccumulator(object):
+    """
+    Streaming per-pixel statistics of a frame sequence, accumulated on a worker thread
+    so that the accumulation overlaps with RetrieveResult
+
+    mean / variance: exact integer sums of x and x**2 for integer frames, Welford's update for float frames
+    sigma-clipped mean: the mean and standard deviation of the first "clip_warmup" frames are the reference,
+    later pixels further than "clip_sigma" standard deviations from it (hot pixels, cosmic rays) are left out;
+    a few warm-up frames underestimate the noise (pixels constant over the warm-up have none), so the
+    standard deviation is at least the shot noise of the reference mean at "clip_gain" [e-/LSB] and the
+    accepted range is at least +-1 LSB wider for integer frames
+    """
+
+    def __init__(
+        self,
+        shape: tuple,
+        dtype=np.uint16,
+        max_frames: int = 1000,
+        bit_depth: int = None,
+        clip_sigma: float = None,
+        clip_warmup: int = 10,
+        clip_gain: float = 1.0,
+        queue_size: int = 8,
+    ) -> None:
+        if clip_sigma is not None and max_frames <= clip_warmup:
+            raise ValueError(
+                f"sigma clipping needs more than clip_warmup={clip_warmup} frames, "
+                f"got max_frames={max_frames}"
+            )
+        self.shape = shape
+        self.integer = np.issubdtype(np.dtype(dtype), np.integer)
+        self.clip_sigma = clip_sigma
+        self.clip_warmup = clip_warmup
+        self.clip_gain = clip_gain
+        self.n = 0
+
+        if self.integer:
+            # the narrowest accumulators that cannot overflow within "max_frames" frames of "bit_depth" bits
+            bits = bit_depth or np.iinfo(dtype).bits
+            acc_dtype = lambda v: np.uint32 if v < 2**32 else np.uint64
+            self.sum = np.zeros(shape, dtype=acc_dtype((2**bits - 1) * max_frames))
+            if (2**bits - 1) ** 2 * max_frames < 2**53:
+                # float64 holds these sums exactly, and cv2.accumulateSquare squares and adds in one pass
+                self.sum_sq, self.sq = np.zeros(shape, dtype=np.float64), None
+            else:
+                self.sum_sq = np.zeros(shape, dtype=np.uint64)
+                self.sq = np.empty(shape, dtype=np.uint64)  # x**2 of the current frame
+        else:
+            self.mean = np.zeros(shape, dtype=np.float64)
+            self.m2 = np.zeros(shape, dtype=np.float64)
+            self.delta = np.empty(shape, dtype=np.float64)
+
+        info = np.iinfo(dtype) if self.integer else np.finfo(dtype)
+        self.min = np.full(shape, info.max, dtype=dtype)
+        self.max = np.full(shape, info.min, dtype=dtype)
+
+        self.clip_center = None  # reference mean of the sigma clipping
+        self.clip_lo, self.clip_hi = None, None  # per-pixel range of accepted values
+        self.clip_mask = np.empty(shape, dtype=np.uint8)  # 255 where the pixel is kept
+        ## clipped pixels are rare, so only they are accumulated and taken out of the full sums at the end
+        self.rejected_sum = np.zeros(shape, dtype=np.float64)
+        self.rejected_count = np.zeros(shape, dtype=np.uint32)
+
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.worker = threading.Thread(target=self._work, daemon=True)
+
+    def start(self):
+        """
+        start the worker thread
+        """
+        self.worker.start()
+        return self
+
+    def put(self, frame) -> None:
+        """
+        hand a frame to the worker thread (blocks only if "queue_size" frames are waiting)
+        """
+        if self.error is not None:
+            raise RuntimeError(f"frame statistics failed: {self.error}") from self.error
+        self.frames.put(frame)
+
+    def _work(self) -> None:
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            try:
+                self.add(frame)
+            except Exception as e:
+                self.error = e
+
+    def add(self, frame) -> None:
+        """
+        accumulate one frame
+        """
+        self.n += 1
+        if self.integer:
+            np.add(self.sum, frame, out=self.sum)
+            if self.sq is None:
+                cv2.accumulateSquare(frame, self.sum_sq)
+            else:
+                np.multiply(frame, frame, out=self.sq, dtype=self.sq.dtype)
+                np.add(self.sum_sq, self.sq, out=self.sum_sq)
+        else:
+            np.subtract(frame, self.mean, out=self.delta)
+            self.mean += self.delta / self.n
+            self.m2 += self.delta * (frame - self.mean)
+        np.minimum(self.min, frame, out=self.min)
+        np.maximum(self.max, frame, out=self.max)
+
+        if self.clip_sigma is None:
+            return
+        if self.clip_center is None:
+            if self.n == self.clip_warmup:
+                mean, var = self._mean_var()
+                shot_var = np.maximum(mean, 0) / self.clip_gain
+                limit = self.clip_sigma * np.sqrt(np.maximum(var, shot_var))
+                if self.integer:
+                    limit += 1
+                self.clip_center = mean
+                self.clip_lo, self.clip_hi = mean - limit, mean + limit
+                if self.integer:  # bounds in the frame dtype, cv2.inRange needs matching types
+                    info = np.iinfo(frame.dtype)
+                    self.clip_lo = np.clip(np.ceil(self.clip_lo), info.min, info.max)
+                    self.clip_hi = np.clip(np.floor(self.clip_hi), info.min, info.max)
+                self.clip_lo = self.clip_lo.astype(frame.dtype)
+                self.clip_hi = self.clip_hi.astype(frame.dtype)
+            return
+        ## one fused pass for the range test, the rest only touches the clipped pixels
+        cv2.inRange(frame, self.clip_lo, self.clip_hi, dst=self.clip_mask)
+        if cv2.countNonZero(self.clip_mask) == self.clip_mask.size:
+            return
+        rejected = np.flatnonzero(self.clip_mask.reshape(-1) == 0)
+        self.rejected_sum.reshape(-1)[rejected] += frame.reshape(-1)[rejected]
+        self.rejected_count.reshape(-1)[rejected] += 1
+
+    def _mean_var(self):
+        if self.integer:
+            mean = self.sum / self.n
+            var = (self.sum_sq - self.sum * mean) / max(self.n - 1, 1)  # exact sums, no cancellation drift
+        else:
+            mean = self.mean.copy()
+            var = self.m2 / max(self.n - 1, 1)
+        return mean, np.maximum(var, 0)
+
+    def stop(self) -> None:
+        """
+        end the worker thread once the queued frames are accumulated
+        """
+        self.frames.put(None)
+        self.worker.join()
+
+    def finish(self) -> dict:
+        """
+        wait for the worker thread and return the statistics
+        """
+        self.stop()
+        if self.error is not None:
+            raise RuntimeError(f"frame statistics failed: {self.error}") from self.error
+
+        mean, var = self._mean_var()
+        stats = {"n": self.n, "mean": mean, "var": var, "std": np.sqrt(var),
+                 "min": self.min, "max": self.max}
+        if self.clip_sigma is not None and self.clip_center is None:
+            warnings.warn(
+                f"only {self.n} frames for clip_warmup={self.clip_warmup}: "
+                f"no sigma-clipped mean"
+            )
+        if self.clip_center is not None:
+            # the warm-up frames are not clipped, they are taken in as they are
+            total = self.sum if self.integer else self.mean * self.n
+            stats["clipped_mean"] = (total - self.rejected_sum) / (self.n - self.rejected_count)
+        return stats
+
+
 class FP_system_control(object):
     """
     Class for Fourier Ptychography system control
@@ -26,6 +203,9 @@ class FP_system_control(object):
         move_max_velocity=1,
         acceleration=1,
         home_direction="reverse",
+        settle_tolerance=5e-4,
+        settle_dwell=0.05,
+        settle_timeout=5.0,
         *args,
         **kwargs,
     ) -> None:
@@ -52,6 +232,17 @@ class FP_system_control(object):
         self.acceleration = acceleration
         self.home_direction = home_direction
 
+        ## settle detection after a move, instead of a fixed sleep: every stage has to stay
+        ## within "settle_tolerance" [mm] of its target for "settle_dwell" [s]; setup_settle()
+        ## tunes a stage, settle_report() gives the times. the same rule and statistics as
+        ## SettleDetector in hardware_NiChen/hardware/settle_detector.py, kept here because
+        ## this script does not depend on that directory
+        self.settle_tolerance = settle_tolerance
+        self.settle_dwell = settle_dwell
+        self.settle_timeout = settle_timeout
+        self.settle_params = {}  # per-stage (tolerance [mm], dwell [s]) over the defaults
+        self.settle_stats = {}  # per-stage settle and wait times [s], polls, timeouts
+
         print("start to initialize all translation stages:")
         self.init_all_stage()  # initialize all translation stages
 
@@ -61,6 +252,15 @@ class FP_system_control(object):
         self.cam_devices = self.tlf.EnumerateDevices()
         # self.camera_SN = [cam_device.GetSerialNumber() for cam_device in cam_devices] # Basler camera serial number
         self.camera = {}  # store Basler camera objects
+        self.cam_queue = {}  # per-camera queues of (exposure time [s], device timestamp, frame)
+        self.cam_threads = {}  # per-camera grab threads
+        self.cam_grab_stats = {}  # per-camera grabbed/dropped frame counters
+        ## per-camera (tick period [s], offset [s]) from device timestamps to time.perf_counter(),
+        ## None for a camera whose clock could not be latched
+        self.cam_clock = {}
+        self.grab_start_time = None
+        self.cam_stop = threading.Event()
+        self.cam_queue_size = 16  # frames buffered per camera before the oldest is dropped
 
     def __str__(self) -> str:
         """
@@ -120,13 +320,13 @@ class FP_system_control(object):
         def wrapper(self, *name_list, **new_name_dict):
 
             name_list = list(name_list)
-            if name_list == []:  # choose all stages if name_list == []
+            if name_list == []:  # choose all cameras if name_list == []
                 name_list = list(self.camera.keys())
 
             exist_list = list(
                 map(
                     self.check_name,
-                    [self.stage.copy() for _ in range(len(name_list))],
+                    [self.camera.copy() for _ in range(len(name_list))],
                     name_list,
                 )
             )
@@ -171,7 +371,7 @@ class FP_system_control(object):
         """
         initialize all detected Basler cameras
         """
-        for i in len(self.cam_devices):
+        for i in range(len(self.cam_devices)):
             SN = self.cam_devices[i].GetSerialNumber()
             self.camera[SN] = py.InstantCamera(
                 self.tlf.CreateDevice(self.cam_devices[i])
@@ -223,12 +423,11 @@ class FP_system_control(object):
 
             self.stage[SN].home(force=True)  # home the stage
             self.stage[SN].wait_for_home()  # wait for "home"
-            time.sleep(1)  # wait to be stable
+            self.wait_settled(SN)  # wait to be stable
 
             print("finished.", end=" ")
             print(f"current position: {self.stage[SN].get_position()} [mm]")
 
-        time.sleep(1)  # wait to be stable
         print(f"stage(s) {self.motor_SN} initialization finished! \n")
 
     @_search_stage_name
@@ -244,6 +443,9 @@ class FP_system_control(object):
         ):
             if exit_flag:
                 self.stage[new_name] = self.stage.pop(old_name)
+                for settle_dict in (self.settle_params, self.settle_stats):
+                    if old_name in settle_dict:
+                        settle_dict[new_name] = settle_dict.pop(old_name)
                 operate_name_list.append(old_name)
             else:
                 print(f"cannot find stage {old_name}")
@@ -318,12 +520,11 @@ class FP_system_control(object):
                 self.stage[name].home(force=True)  # home the stage
                 self.stage[name].wait_for_home()  # wait for "home"
                 operate_name_list.append(name)
-                time.sleep(1)  # wait to be stable
+                self.wait_settled(name)  # wait to be stable
                 print(f"finished!")
                 self.get_stage_position(name)
             else:
                 print(f"cannot find stage {name}")
-        time.sleep(1)
         print(f"stage(s) {operate_name_list} finished homing!\n")
 
     @_search_stage_name
@@ -340,15 +541,96 @@ class FP_system_control(object):
                 self.stage[name].move_to(pos)
                 self.stage[name].wait_move()  # wait for moving
                 operate_name_list.append(name)
-                time.sleep(1)  # wait to be stable
+                self.wait_settled(name, target=pos)  # wait to be stable
                 print("finished!")
             else:
                 print(f"cannot find stage {name}")
 
-        time.sleep(1)  # wait to be stable
         print(f"stage(s) {operate_name_list} finished moving!\n")
         self.get_stage_position()
 
+    def setup_settle(
+        self, name: str, tolerance: float = None, dwell: float = None
+    ) -> None:
+        """
+        per-stage settle tolerance [mm] and dwell time [s]; None keeps the current value
+        """
+        old_tolerance, old_dwell = self.settle_params.get(
+            name, (self.settle_tolerance, self.settle_dwell)
+        )
+        self.settle_params[name] = (
+            old_tolerance if tolerance is None else tolerance,
+            old_dwell if dwell is None else dwell,
+        )
+
+    def wait_settled(
+        self, name: str, target: float = None, poll_interval: float = 1e-3
+    ) -> float:
+        """
+        poll the position (the encoder count of a KDC101) until it stays within the settle
+        tolerance of "target" for the dwell time; return the time spent waiting [s],
+        including the dwell
+
+        without "target" (after homing) the window is centered where the stage is when it
+        enters it, so only stillness is checked, not that the stage arrived anywhere
+        """
+        tolerance, dwell = self.settle_params.get(
+            name, (self.settle_tolerance, self.settle_dwell)
+        )
+        stats = self.settle_stats.setdefault(
+            name, {"settle": [], "wait": [], "polls": 0, "timeouts": 0}
+        )
+        t0 = time.perf_counter()
+        deadline = t0 + self.settle_timeout
+        reference, t_enter = None, None  # window center, time the stage entered it
+        while True:
+            position = self.stage[name].get_position()
+            t = time.perf_counter()
+            stats["polls"] += 1
+            if t_enter is None:
+                reference = position if target is None else target
+                t_enter = t
+            if abs(position - reference) > tolerance:
+                t_enter = None
+            elif t - t_enter >= dwell:
+                break
+            if time.perf_counter() > deadline:
+                stats["timeouts"] += 1
+                raise TimeoutError(
+                    f"stage {name} not settled within {self.settle_timeout} s: "
+                    f"{position - reference:+.4f} [mm] off, tolerance {tolerance} [mm]"
+                )
+            if poll_interval > 0:
+                time.sleep(poll_interval)
+
+        elapsed = time.perf_counter() - t0
+        stats["settle"].append(t_enter - t0)  # until it entered the window for good
+        stats["wait"].append(elapsed)
+        return elapsed
+
+    def settle_report(self) -> str:
+        """
+        per-stage settle and wait times observed by wait_settled(), in the format of
+        SettleDetector.summary()
+        """
+        lines = []
+        for name, stats in self.settle_stats.items():
+            lines.append(
+                f"{name}: {len(stats['wait'])} settles, {stats['timeouts']} timeouts, "
+                f"{stats['polls']} polls"
+            )
+            for label in ("settle", "wait"):
+                if not stats[label]:
+                    continue
+                times = np.asarray(stats[label])
+                p50, p90, p99 = np.percentile(times, [50, 90, 99])
+                lines.append(
+                    f"  {name} {label}: n={len(times)}, mean={1e3*times.mean():.2f} ms, "
+                    f"p50={1e3*p50:.2f} ms, p90={1e3*p90:.2f} ms, p99={1e3*p99:.2f} ms, "
+                    f"max={1e3*times.max():.2f} ms"
+                )
+        return "\n".join(lines)
+
     def get_all_stage_name(self) -> None:
         """
         get all connected stage(s) name
@@ -405,27 +687,254 @@ class FP_system_control(object):
         pass
 
     def cam_capture(
-        self, cam_name: str, frame_num: int = 100, exp_time: float = 1000.0
-    ) -> None:
+        self,
+        cam_name=None,
+        frame_num: int = 100,
+        exp_time: float = 1000.0,
+        clip_sigma: float = None,
+    ):
         """
         use camera to capture frames for each exposure times
         return a averaged image
+
+        the per-pixel mean, variance, min/max (and the sigma-clipped mean if "clip_sigma" is given)
+        are accumulated on a worker thread and kept in self.img_stats
+
+        "cam_name" may be one camera name, a list of names or None for all cameras: several cameras
+        capture at the same time, one thread each, and {name: averaged image} is returned
+        (self.img_stats is then {name: statistics})
+        """
+        if isinstance(cam_name, str):
+            self.img_avrg, self.img_stats = self._cam_capture(
+                cam_name, frame_num, exp_time, clip_sigma
+            )
+            return self.img_avrg
+
+        names = list(self.camera.keys()) if cam_name is None else list(cam_name)
+        results, errors = {}, {}
+
+        def capture(name):
+            try:
+                results[name] = self._cam_capture(name, frame_num, exp_time, clip_sigma)
+            except Exception as e:
+                errors[name] = e
+
+        threads = [threading.Thread(target=capture, args=(name,)) for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            name, error = next(iter(errors.items()))
+            raise RuntimeError(f"capture on camera {name} failed: {error}") from error
+
+        self.img_avrg = {name: img for name, (img, _) in results.items()}
+        self.img_stats = {name: stats for name, (_, stats) in results.items()}
+        return self.img_avrg
+
+    def _cam_capture(
+        self, cam_name: str, frame_num: int, exp_time: float, clip_sigma: float
+    ) -> tuple:
+        """
+        capture "frame_num" frames on one camera, return (averaged image, statistics)
         """
         # fetch some images with foreground loop
         cam = self.camera[cam_name]  # default is SN
         cam.ExposureTime.Value = exp_time  # [μs]
-        img_sum = np.zeros((cam.Height.Value, cam.Width.Value), dtype=np.float32)
+        pixel_format = cam.PixelFormat.Value
+        bit_depth = int("".join(c for c in pixel_format if c.isdigit()) or 8)  # Mono8, Mono12, ...
+        acc = FrameStatsAccumulator(
+            (cam.Height.Value, cam.Width.Value),
+            dtype=np.uint8 if bit_depth <= 8 else np.uint16,
+            max_frames=frame_num,
+            bit_depth=bit_depth,
+            clip_sigma=clip_sigma,
+        ).start()
         cam.StartGrabbingMax(frame_num)
-        while cam.IsGrabbing():
-            with cam.RetrieveResult(1000) as res:
-                if res.GrabSucceeded():
-                    img = res.Array
-                    img_sum += img
-                else:
-                    raise RuntimeError("Grab failed")
+        try:
+            while cam.IsGrabbing():
+                with cam.RetrieveResult(1000) as res:
+                    if res.GrabSucceeded():
+                        acc.put(res.GetArray())
+                    else:
+                        raise RuntimeError("Grab failed")
+        except BaseException:
+            ## the grab error is what the caller needs to see, not a failure of the statistics
+            cam.StopGrabbing()
+            acc.stop()
+            raise
         cam.StopGrabbing()
-        self.img_avrg = img_sum / frame_num
-        return self.img_avrg
+        img_stats = acc.finish()
+        return img_stats["mean"].astype(np.float32), img_stats
+
+    def _grab_loop(self, name: str) -> None:
+        """
+        grab thread of one camera: keep RetrieveResult draining into the camera's queue,
+        dropping the oldest frame when the consumer falls behind
+        """
+        cam = self.camera[name]
+        frame_queue = self.cam_queue[name]
+        stats = self.cam_grab_stats[name]
+        clock = self.cam_clock[name]
+        while not self.cam_stop.is_set() and cam.IsGrabbing():
+            res = cam.RetrieveResult(100, py.TimeoutHandling_Return)
+            if res is None or not res.IsValid():
+                continue
+            try:
+                if not res.GrabSucceeded():
+                    stats["failed"] += 1
+                    continue
+                arrival = time.perf_counter()
+                timestamp = res.GetTimeStamp()
+                frame = res.GetArray()
+                stats["dropped"] += res.GetNumberOfSkippedImages()
+            finally:
+                res.Release()
+
+            ## exposure start on the host clock; None without a latched clock, the arrival
+            ## time would include the exposure and readout
+            exposed = None if clock is None else timestamp * clock[0] + clock[1]
+            item = (exposed, timestamp, frame)
+
+            while True:
+                try:
+                    frame_queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        frame_queue.get_nowait()
+                        stats["dropped"] += 1
+                    except queue.Empty:
+                        pass
+            stats["grabbed"] += 1
+
+    @_search_cam_name
+    def start_grabbing(self, name_list: list = [], exit_list: list = []) -> None:
+        """
+        start continuous grabbing on camera(s), one grab thread and result queue per camera
+        default: all connected cameras
+        """
+        if self.cam_threads:  # grabbing already: stop the old threads first
+            self.stop_grabbing()
+        self.cam_stop.clear()
+        self.cam_queue, self.cam_grab_stats, self.cam_clock = {}, {}, {}
+        self.grab_start_time = time.perf_counter()
+        for name, exit_flag in zip(name_list, exit_list):
+            if not exit_flag:
+                print(f"cannot find camera {name}")
+                continue
+
+            self.cam_queue[name] = queue.Queue(maxsize=self.cam_queue_size)
+            self.cam_grab_stats[name] = {"grabbed": 0, "dropped": 0, "failed": 0}
+            self.cam_clock[name] = self._latch_clock(name)
+            if self.cam_clock[name] is None:
+                print(
+                    f"camera {name} has no timestamp latch: "
+                    f"its frames cannot be matched by get_frame_set()"
+                )
+            self.camera[name].StartGrabbing(py.GrabStrategy_OneByOne)
+            self.cam_threads[name] = threading.Thread(
+                target=self._grab_loop, args=(name,), daemon=True
+            )
+            self.cam_threads[name].start()
+
+        print(f"camera(s) {list(self.cam_threads.keys())} started grabbing!\n")
+
+    def _latch_clock(self, name: str, repeats: int = 5):
+        """
+        (tick period [s], offset [s]) from the device timestamps of camera "name" to
+        time.perf_counter(), so that the frames of different cameras can be matched by
+        exposure time; latched against the host clock, best of "repeats" round trips.
+        USB3 cameras: TimestampLatch, ticks of 1 ns. GigE cameras: GevTimestampControlLatch,
+        ticks of 1 / GevTimestampTickFrequency. None if the camera has neither
+        """
+        cam = self.camera[name]
+        try:
+            latch, value = cam.TimestampLatch.Execute, lambda: cam.TimestampLatchValue.Value
+            tick = 1e-9
+        except Exception:
+            try:
+                latch = cam.GevTimestampControlLatch.Execute
+                value = lambda: cam.GevTimestampValue.Value
+                tick = 1.0 / cam.GevTimestampTickFrequency.Value
+            except Exception:
+                return None
+
+        best = None
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            latch()
+            t1 = time.perf_counter()
+            ticks = value()
+            if best is None or t1 - t0 < best[0]:
+                best = (t1 - t0, (t0 + t1) / 2 - ticks * tick)
+        return tick, best[1]
+
+    def stop_grabbing(self) -> None:
+        """
+        stop the grab threads of all cameras and report the aggregate frame rate
+        """
+        self.cam_stop.set()
+        for name, thread in self.cam_threads.items():
+            thread.join()
+            self.camera[name].StopGrabbing()
+
+        print(self.grab_report())
+        self.cam_threads = {}
+
+    def grab_report(self) -> str:
+        """
+        per-camera and aggregate frames per second since start_grabbing()
+        """
+        if self.grab_start_time is None:
+            return "not grabbing: call start_grabbing() first"
+        elapsed = time.perf_counter() - self.grab_start_time
+        total = sum(stats["grabbed"] for stats in self.cam_grab_stats.values())
+        lines = [
+            f"{name}: {stats['grabbed'] / elapsed:.1f} fps, {stats}"
+            for name, stats in self.cam_grab_stats.items()
+        ]
+        lines.append(f"aggregate: {total / elapsed:.1f} fps over {elapsed:.1f} s")
+        return "\n".join(lines)
+
+    def get_frame_set(
+        self, after: float = None, tolerance: float = 0.05, timeout: float = 2.0
+    ) -> dict:
+        """
+        return {camera name: frame} with one frame per grabbing camera, matched by exposure time: the
+        device timestamps mapped to time.perf_counter() with the per-camera clock offset calibrated at
+        start_grabbing(); all frames exposed within "tolerance" [s] of each other and after "after"
+        (time.perf_counter()), e.g. the time the stage settled at the current position
+        """
+        if not self.cam_queue:
+            raise RuntimeError("no camera is grabbing: call start_grabbing() first")
+        unlatched = [name for name in self.cam_queue if self.cam_clock.get(name) is None]
+        if unlatched:
+            raise RuntimeError(
+                f"camera(s) {unlatched} have no latched timestamp clock: "
+                f"their exposure times are unknown, frames cannot be matched"
+            )
+        deadline = time.perf_counter() + timeout
+        heads = {}
+        while True:
+            for name, frame_queue in self.cam_queue.items():
+                while name not in heads or heads[name][0] < (after or 0):
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        raise TimeoutError(f"no frame set received in {timeout} s")
+                    try:
+                        heads[name] = frame_queue.get(timeout=remaining)
+                    except queue.Empty:
+                        raise TimeoutError(f"camera {name} delivered no frame in {timeout} s")
+
+            # frames older than the newest head by more than "tolerance" cannot belong to this set
+            newest = max(t for t, _, _ in heads.values())
+            late = [name for name, (t, _, _) in heads.items() if newest - t > tolerance]
+            if not late:
+                return {name: frame for name, (_, _, frame) in heads.items()}
+            for name in late:
+                del heads[name]
+            after = max(after or 0, newest - tolerance)
 
     def close_all_cams(
         self,
@@ -433,6 +942,8 @@ class FP_system_control(object):
         """
         close all cameras
         """
+        if self.cam_threads:
+            self.stop_grabbing()
         for name, cam_obj in self.camera.items():
             self.camera[name].Close()
 
@@ -0,0 +1,727 @@
+'''
+
+Benchmarks for the acquisition pipeline.
+
+Usage:
+  python benchmark_acquisition.py <benchmark> [--camera_mode ...] [--n ...]
+
+'''
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+
+def report(name, times, n_bytes=None):
+    times = np.asarray(times)
+    line = f'{name:<32s} {len(times):5d} frames  mean {1e3*times.mean():8.2f} ms  ' \
+           f'p95 {1e3*np.percentile(times, 95):8.2f} ms  {1/times.mean():8.1f} fps'
+    if n_bytes is not None:
+        line = f'{line}  {n_bytes / times.mean() / 1e6:8.1f} MB/s'
+    print(line)
+
+
+############################################# Simulated scan ###########################################################
+def bench_scan(n=100, step=6e-6, drop_rate=0.01, **camera_kwargs):
+    # the scan loop of capture_with_scanning_sensor.py end to end, on simulated stages and a synthetic camera
+    from camera import Camera
+    from synthetic import SimulatedStage
+
+    ss = SimulatedStage('LST150')
+    ss.open(axis_num=2)
+    c = Camera(camera_type='synthetic', headless=True, synthetic={'stage': ss, 'drop_rate': drop_rate},
+               **camera_kwargs)
+    c.set_camera()
+
+    side = int(np.ceil(np.sqrt(n)))
+    pos = np.stack(np.unravel_index(np.arange(n), (side, side))[::-1]) * step / ss.step_in_m
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        c.start_streaming(buffer_size=8)
+        c.start_writer(workers=2, max_inflight_mb=1024)
+
+        move, capture = [], []
+        for idx in range(n):
+            t0 = time.perf_counter()
+            ss.move_to(pos[:, idx])
+            t1 = time.perf_counter()
+            c.capture(os.path.join(out_dir, f'img{idx+1:04}.tiff'))
+            move.append(t1 - t0)
+            capture.append(time.perf_counter() - t1)
+
+        print(f'stream stats: {c.stream_stats()}')
+        c.close()
+
+    report('move', move)
+    report('capture', capture)
+    report('scan position', np.add(move, capture))
+
+
+def bench_scan_engine(n=100, step=6e-6, settle=0.05, drop_rate=0.0, **camera_kwargs):
+    # The serial loop of the scan scripts (move, settle, capture), with the frames written in the loop as the
+    # scripts used to and with the background writer, versus ScanEngine; on simulated devices. In free-run mode the
+    # engine only learns that the exposure is over when the frame arrives; with the software trigger the stage moves
+    # on as soon as the exposure ends, while the frame is read out and written.
+    from camera import Camera
+    from scan_engine import FileSink, ScanEngine
+    from synthetic import SimulatedStage
+
+    side = int(np.ceil(np.sqrt(n)))
+    pos = np.stack(np.unravel_index(np.arange(n), (side, side))[::-1]).astype(float)
+
+    for name in ['serial, blocking write', 'serial, background write', 'scan engine', 'scan engine, triggered']:
+        ss = SimulatedStage('LST150')
+        ss.open(axis_num=2)
+        trigger = 'software' if name.endswith('triggered') else None
+        c = Camera(camera_type='synthetic', headless=True, trigger=trigger,
+                   synthetic={'stage': ss, 'drop_rate': drop_rate}, **camera_kwargs)
+        c.set_camera()
+        targets = pos * step / ss.step_in_m + np.array(ss.stage_pos)[:, None]
+
+        with tempfile.TemporaryDirectory() as out_dir:
+            c.start_streaming(buffer_size=8)
+            if name != 'serial, blocking write':
+                c.start_writer(workers=2, max_inflight_mb=1024)
+            t0 = time.perf_counter()
+            if name.startswith('scan engine'):
+                engine = ScanEngine(ss, c, FileSink(c, out_dir), settle=settle)
+                engine.run(targets)
+            else:
+                for idx in range(n):
+                    ss.move_to(targets[:, idx])
+                    time.sleep(settle)
+                    c.capture(os.path.join(out_dir, f'img{idx+1:04}.tiff'))
+                if c.writer is not None:
+                    c.writer.flush()
+            elapsed = time.perf_counter() - t0
+            c.close()
+        ss.close()
+        if name.startswith('scan engine'):
+            print(engine.summary())
+        print(f'{name:<26s} {n} positions in {elapsed:6.2f} s, {1e3 * elapsed / n:7.2f} ms per position')
+
+
+############################################# Stages ###################################################################
+def bench_stage(n=100, step=6e-6, jitter=0.15):
+    # per-step time of an XY raster on the simulated stages, axes moved one after the other versus together;
+    # the scan scripts add a random offset to every position, so both axes move on every step
+    from synthetic import SimulatedStage
+
+    side = int(np.ceil(np.sqrt(n)))
+    rows, cols = np.unravel_index(np.arange(n), (side, side))
+    cols = np.where(rows % 2, side - 1 - cols, cols)                  # zigzag raster
+    pos = np.stack([cols, rows]).astype(float)
+    pos += jitter * np.random.default_rng(0).standard_normal(pos.shape)
+
+    for name in ['sequential axes', 'concurrent axes']:
+        ss = SimulatedStage('LST150')
+        ss.open(axis_num=2)
+        targets = pos * step / ss.step_in_m + np.array(ss.stage_pos)[:, None]
+
+        times = []
+        for idx in range(n):
+            t0 = time.perf_counter()
+            if name == 'sequential axes':
+                for stage, p in zip(ss.stages, targets[:, idx]):     # the previous KinesisStage.move_to
+                    stage.move_to(p)
+                    stage.wait_move()
+            else:
+                ss.move_to(targets[:, idx])
+            times.append(time.perf_counter() - t0)
+        report(name, times)
+        ss.close()
+
+
+def bench_settle(n=50, step=6e-6, jitter=0.15, tolerance=0.1e-6, dwell=0.02):
+    # Per-step time and the position error at the end of the wait, fixed sleeps after every move versus the settle
+    # detector, on simulated stages that ring after each move (and that do not).
+    from settle_detector import SettleDetector
+    from synthetic import SimulatedStage
+
+    rng = np.random.default_rng(0)
+    pos = np.cumsum(1 + jitter * rng.standard_normal((2, n)), axis=1)
+    for ringing in [None, (2e-6, 30, 0.03)]:
+        label = 'no ringing' if ringing is None else f'ringing {1e6*ringing[0]:.1f} um, {ringing[1]} Hz, ' \
+                                                     f'{1e3*ringing[2]:.0f} ms'
+        for settle in [0.05, 0.1, None]:
+            ss = SimulatedStage('LST150', ringing=ringing)
+            ss.settle_detector = SettleDetector(tolerance=tolerance / ss.step_in_m, dwell=dwell)
+            ss.open(axis_num=2)
+            targets = pos * step / ss.step_in_m + np.array(ss.stage_pos)[:, None]
+
+            times, errors = [], []
+            for idx in range(n):
+                t0 = time.perf_counter()
+                ss.move_to(targets[:, idx])
+                if settle is None:
+                    ss.wait_settled(targets[:, idx])
+                else:
+                    time.sleep(settle)
+                times.append(time.perf_counter() - t0)
+                errors.append(max(abs(p - q) for p, q in zip(ss.position_in_m(), targets[:, idx] * ss.step_in_m)))
+            errors = 1e6 * np.array(errors)
+            name = 'settle detector' if settle is None else f'sleep {1e3*settle:.0f} ms'
+            print(f'{label:<30s} {name:<16s} step {1e3*np.mean(times):6.1f} ms  error at release: '
+                  f'mean {errors.mean():.3f} um, max {errors.max():.3f} um')
+            if settle is None:
+                print(ss.settle_detector.summary())
+            ss.close()
+
+
+def bench_fly_scan(n=100, step=6e-6, row=20, framerate=100, exposuretime=220, max_blur=0.5e-6):
+    # The same raster as a step scan (ScanEngine: move, settle, grab a free-running frame) and as a fly scan
+    # (continuous rows, one position-triggered frame every `step`); simulated stages and synthetic cameras.
+    from camera import Camera
+    from fly_scan import FlyScan
+    from scan_engine import ScanEngine
+    from synthetic import SimulatedStage
+
+    rows = int(np.ceil(n / row))
+    frames = []
+
+    def sink(index, frame, meta):
+        frames.append(index)
+
+    for name in ['step scan', 'fly scan']:
+        ss = SimulatedStage('LST150')
+        ss.open(axis_num=2)
+        synthetic = {'stage': ss, 'width': 640, 'height': 480}
+        if name == 'fly scan':
+            synthetic['trigger'] = ss.stages[0]        # the controller's trigger output on the camera's trigger input
+        c = Camera(camera_type='synthetic', headless=True, framerate=framerate, exposuretime=exposuretime,
+                   synthetic=synthetic)
+        c.set_camera()
+        c.start_streaming(buffer_size=8)
+        x0, y0 = ss.stage_pos
+        pitch = step / ss.step_in_m
+        frames.clear()
+
+        t0 = time.perf_counter()
+        if name == 'step scan':
+            y, x = np.mgrid[:rows, :row].astype(float)
+            x[1::2] = x[1::2, ::-1]                                         # zigzag
+            pos = np.stack([x0 + pitch * x.ravel(), y0 + pitch * y.ravel()])
+            engine = ScanEngine(ss, c, sink, settle=0.05)
+            engine.run(pos)
+        else:
+            # 90 % of the camera's frame rate, well within the blur budget at this exposure
+            fly = FlyScan(ss, c, pitch=pitch, velocity=0.9 * pitch * framerate, max_blur=max_blur / ss.step_in_m)
+            fly.run(x0, x0 + pitch * (row - 1), y0 + pitch * np.arange(rows), sink)
+        elapsed = time.perf_counter() - t0
+        c.close()
+        ss.close()
+
+        print(f'{name:<10s} {rows}x{row} positions, {len(frames)} frames in {elapsed:6.2f} s, '
+              f'{1e3 * elapsed / (rows * row):6.2f} ms per position')
+        if name == 'fly scan':
+            print(fly.summary())
+            print(f'missed triggers: {c.cam.missed_triggers}')
+
+
+def bench_scan_planner(n=10000, step=6e-6, jitter=0.5, settle=0.0):
+    # Planning time and modelled path time of spiral patterns with random offsets, pattern order versus planned
+    # order, then both orders of a 121-point pattern run on the simulated stages to check the model.
+    from scan_planner import ScanPlanner
+    from synthetic import SimulatedStage
+
+    def spiral(num):
+        side = int(np.ceil(np.sqrt(num)))
+        y, x = np.mgrid[:side, :side] - side // 2
+        order = np.lexsort((np.arctan2(y, x).ravel(), np.maximum(abs(x), abs(y)).ravel()))     # ring by ring
+        return np.stack([x.ravel(), y.ravel()])[:, order[:num]].astype(float)
+
+    ss = SimulatedStage('LST150')
+    ss.open(axis_num=2)
+    velocity, acceleration = ss.velocity_parameters()
+    rng = np.random.default_rng(0)
+    for num in sorted({121, 1521, n}):
+        pos = (spiral(num) + jitter * rng.standard_normal((2, num))) * step / ss.step_in_m
+        planner = ScanPlanner(velocity, acceleration, settle=settle)
+        t0 = time.perf_counter()
+        order = planner.plan(pos, start=[0, 0])
+        print(f'plan in {1e3*(time.perf_counter() - t0):6.0f} ms: {planner.summary()}')
+
+    pos = (spiral(121) + jitter * rng.standard_normal((2, 121))) * step / ss.step_in_m
+    order = ScanPlanner(velocity, acceleration, settle=settle).plan(pos, start=[0, 0])
+    for name, visit in [('pattern order', np.arange(121)), ('planned order', order)]:
+        targets = pos[:, visit] + np.array(ss.stage_pos)[:, None]
+        ss.move_to_origin()
+        t0 = time.perf_counter()
+        for idx in range(targets.shape[1]):
+            ss.move_to(targets[:, idx])
+        print(f'{name:<16s} 121 positions on the simulated stages in {time.perf_counter() - t0:6.2f} s')
+    ss.close()
+
+
+############################################# Camera streaming #########################################################
+def bench_streaming(camera_mode='Basler daA1920-160um', n=100, **camera_kwargs):
+    # per-frame StartGrabbing()/StopGrabbing() versus one streaming session for the whole run
+    from camera import Camera
+
+    c = Camera(camera_mode=camera_mode, **camera_kwargs)
+    c.set_camera()
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        times = []
+        for idx in range(n):
+            t0 = time.perf_counter()
+            c.capture(os.path.join(out_dir, f'img{idx+1:04}.tiff'))
+            times.append(time.perf_counter() - t0)
+        report('per-frame capture', times)
+
+        c.start_streaming()
+        times = []
+        for idx in range(n):
+            t0 = time.perf_counter()
+            c.capture(os.path.join(out_dir, f'img{idx+1:04}.tiff'))
+            times.append(time.perf_counter() - t0)
+        report('streaming capture', times)
+        print(f'stream stats: {c.stream_stats()}')
+
+    c.close()
+
+
+def bench_trigger(camera_mode='Basler daA1920-160um', n=100, **camera_kwargs):
+    # capture latency (request to frame available) in free-run mode versus software trigger mode
+    from camera import Camera
+
+    for trigger in [None, 'software']:
+        c = Camera(camera_mode=camera_mode, trigger=trigger, **camera_kwargs)
+        c.set_camera()
+        for _ in range(n):
+            c.grab_frame()
+        counts, edges = c.latency_histogram(bins=10)
+        print(f'trigger={trigger}:')
+        for count, lo, hi in zip(counts, edges[:-1], edges[1:]):
+            print(f'  {1e3*lo:8.2f} - {1e3*hi:8.2f} ms: {count}')
+        c.close()
+
+
+def bench_settings(camera_mode='Basler daA1920-160um', n=100, n_profile=10, **camera_kwargs):
+    # one connected camera: the full configuration on connect, re-applying unchanged settings, node writes through
+    # update_settings and the exposure fast path, then saving and loading a feature persistence profile
+    from camera import Camera
+
+    def timed(name, step, count):
+        times = []
+        for idx in range(count):
+            t0 = time.perf_counter()
+            step(idx)
+            times.append(time.perf_counter() - t0)
+        report(name, times)
+
+    c = Camera(camera_mode=camera_mode, **camera_kwargs)
+    c.show_camera_image = lambda frame: None
+    t0 = time.perf_counter()
+    c.set_camera()
+    print(f'{"set_camera (connect, configure)":<32s} {1e3*(time.perf_counter() - t0):8.2f} ms')
+
+    nodes = ['Width', 'Height', 'OffsetX', 'OffsetY', 'PixelFormat', 'Gain', 'ExposureTime']
+    current = {name: c.settings.get(name) for name in nodes}
+    timed('apply unchanged settings', lambda idx: c.settings.apply(current), n)
+    timed('update_settings Gain', lambda idx: c.update_settings(Gain=c.gain + (0.1 if idx % 2 else 0)), n)
+    timed('set_exposure', lambda idx: c.set_exposure(c.exposuretime + (10 if idx % 2 else -10)), n)
+
+    if c.cam.IsGrabbing():        # a profile is only loaded while the camera is not grabbing
+        c.cam.StopGrabbing()
+    with tempfile.TemporaryDirectory() as profile_dir:
+        c.settings.profile_dir = profile_dir
+        timed('save_profile', lambda idx: c.settings.save_profile('bench'), n_profile)
+        timed('load_profile', lambda idx: c.settings.load_profile('bench'), n_profile)
+    c.close()
+
+
+def bench_roi(camera_mode='Basler daA1920-160um', n=100, **camera_kwargs):
+    # measured frame rate and bytes per frame of the full frame, a 512x512 ROI and 2x2 binning
+    from camera import Camera
+
+    for name, mode in [('full frame', {}), ('512x512 ROI', {'roi': (512, 512)}), ('2x2 binning', {'binning': 2})]:
+        c = Camera(camera_mode=camera_mode, **mode, **camera_kwargs)
+        c.show_camera_image = lambda frame: None
+        c.set_camera()
+        info = c.acquisition_info()
+        c.start_streaming()
+
+        times = []
+        t0 = time.perf_counter()
+        for _ in range(n):
+            frame = c.grab_frame()
+            t1 = time.perf_counter()
+            times.append(t1 - t0)
+            t0 = t1
+        report(f'{name} {frame.shape[1]}x{frame.shape[0]}', times, info['bytes_per_frame'])
+        c.close()
+
+
+############################################# Import time ##############################################################
+previous_imports = ['numpy', 'pygrabber.dshow_graph', 'pylablib', 'pylablib.devices.Basler', 'pypylon.pylon',
+                    'matplotlib.pyplot', 'mpl_toolkits.axes_grid1', 'matplotlib.ticker', 'cv2', 'tisgrabber',
+                    'imutils']
+
+
+def import_time(statement):
+    # total cumulative import time [s] of `statement` in a fresh interpreter, from python -X importtime
+    import subprocess
+    import sys
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=here,
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        return None
+    total = 0
+    for line in proc.stderr.splitlines():
+        fields = line.split('|')
+        # only the top-level imports, their cumulative time includes the nested ones
+        if line.startswith('import time:') and len(fields) == 3 and not fields[2].startswith('  ') \
+                and fields[1].strip().isdigit():
+            total += int(fields[1])
+    return total * 1e-6
+
+
+def bench_import(n=5):
+    # import time of camera.py, and of the SDKs it imported eagerly before they were loaded per backend
+    def best(statement):
+        times = [import_time(statement) for _ in range(n)]
+        return None if None in times else min(times)
+
+    installed = []
+    for name in previous_imports:
+        t = best(f'import {name}')
+        print(f'{"import " + name:<40s} {"not installed" if t is None else f"{1e3*t:8.1f} ms"}')
+        if t is not None:
+            installed.append(name)
+    t = best('; '.join(f'import {name}' for name in installed))
+    print(f'{"previous eager imports (installed ones)":<40s} {1e3*t:8.1f} ms')
+
+    t = best('import camera')
+    print(f'{"import camera":<40s} {"failed" if t is None else f"{1e3*t:8.1f} ms"}')
+
+
+def bench_auto_exposure(n=3, **camera_kwargs):
+    # frames and time auto_exposure() needs from under-, over- and far over-exposed starts, on the synthetic camera
+    from camera import Camera
+
+    for exposure in [220, 8500, 40000]:
+        c = Camera(camera_type='synthetic', headless=True, exposuretime=exposure, **camera_kwargs)
+        c.set_camera()
+        c.start_streaming()
+        n_frames = len(c.capture_latency)
+        t0 = time.perf_counter()
+        result = c.auto_exposure()
+        t = time.perf_counter() - t0
+        print(f'start {exposure:8.1f} -> {result:8.1f} in {len(c.capture_latency) - n_frames} frames, {1e3*t:.1f} ms')
+        c.close()
+
+
+def bench_buffer_pool(n=300, framerate=200, **camera_kwargs):
+    # sustained streaming capture on the synthetic camera with and without the buffer pool: heap growth, page
+    # faults and garbage collections in steady state (after a warm-up of 50 frames)
+    import gc
+    import resource
+    import tracemalloc
+    from camera import Camera
+
+    for pool_size in [0, None]:
+        c = Camera(camera_type='synthetic', headless=True, framerate=framerate, exposuretime=1000, **camera_kwargs)
+        c.set_camera()
+        with tempfile.TemporaryDirectory() as out_dir:
+            c.start_streaming(buffer_size=8, pool_size=pool_size)
+            c.start_writer(workers=2, max_inflight_mb=256)
+            for idx in range(50):
+                c.capture(os.path.join(out_dir, f'img{idx+1:04}.tiff'))
+
+            tracemalloc.start()
+            faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+            collections = sum(stat['collections'] for stat in gc.get_stats())
+            times = []
+            for idx in range(n):
+                t0 = time.perf_counter()
+                c.capture(os.path.join(out_dir, f'img{idx+1:04}.tiff'))
+                times.append(time.perf_counter() - t0)
+            c.writer.flush()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt - faults
+            collections = sum(stat['collections'] for stat in gc.get_stats()) - collections
+            c.close()
+
+        name = 'allocate per frame' if pool_size == 0 else 'buffer pool'
+        report(name, times)
+        print(f'{"":32s} heap growth {current / 2**20:.1f} MB, peak {peak / 2**20:.1f} MB, '
+              f'{faults / n:.0f} page faults/frame, {collections} GC collections')
+
+
+def bench_hdr(n=30, exposures=(1000, 4000, 16000), **camera_kwargs):
+    # throughput per scan position: one frame per position versus an HDR bracket merged on the worker thread
+    from camera import Camera
+
+    c = Camera(camera_type='synthetic', headless=True, framerate=60, exposuretime=exposures[0], **camera_kwargs)
+    c.set_camera()
+    c.start_streaming()
+    c.start_writer()
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        single, bracket = [], []
+        for idx in range(n):
+            t0 = time.perf_counter()
+            c.capture(os.path.join(out_dir, f'img{idx+1:04}.tiff'))
+            single.append(time.perf_counter() - t0)
+        for idx in range(n):
+            t0 = time.perf_counter()
+            c.capture_hdr(os.path.join(out_dir, f'hdr{idx+1:04}.tiff'), exposures)
+            bracket.append(time.perf_counter() - t0)
+        c.close()
+
+    report('single exposure', single)
+    report(f'HDR bracket of {len(exposures)}', bracket)
+    print(f'HDR throughput per position: {np.mean(single) / np.mean(bracket):.2f}x of a single exposure')
+
+
+############################################# Compression ##############################################################
+def bench_compression(n=20, data_dir=None, workers=4):
+    # Lossless codecs of FrameWriter: compression ratio, and MB/s of frame data through one writer thread and
+    # through `workers` threads. Uses the img*.tiff frames of a scan in data_dir, synthetic frames otherwise.
+    import glob
+    import cv2
+    from frame_writer import FrameWriter, imwrite_params
+
+    if data_dir is not None:
+        files = sorted(glob.glob(os.path.join(data_dir, 'img*.tiff')))[:n]
+        assert files, f'No img*.tiff frames in {data_dir}'
+        frames = [cv2.imread(file_name, cv2.IMREAD_UNCHANGED) for file_name in files]
+    else:
+        from synthetic import SyntheticCamera
+        cam = SyntheticCamera(width=4000, height=3000, bit_depth=12)
+        frames = [cam.snap().copy() for _ in range(n)]
+        cam.close()
+    n_bytes = sum(frame.nbytes for frame in frames)
+    print(f'{len(frames)} frames of {frames[0].shape} {frames[0].dtype}, {n_bytes / len(frames) / 1e6:.1f} MB each')
+
+    codecs = [('none', '.tiff', 1), ('lzw', '.tiff', 1), ('deflate', '.tiff', 1),
+              ('none', '.png', 1), ('none', '.png', 3), ('none', '.png', 6)]
+    with tempfile.TemporaryDirectory() as out_dir:
+        for compression, ext, png_level in codecs:
+            name = f'PNG level {png_level}' if ext == '.png' else f'TIFF {compression}'
+            file_name = os.path.join(out_dir, f'check{ext}')
+            cv2.imwrite(file_name, frames[0], imwrite_params(file_name, compression, png_level))
+            assert np.array_equal(cv2.imread(file_name, cv2.IMREAD_UNCHANGED), frames[0]), f'{name} is not lossless'
+
+            for threads in [1, workers]:
+                writer = FrameWriter(workers=threads, max_inflight_mb=1024, compression=compression,
+                                     png_level=png_level)
+                t0 = time.perf_counter()
+                for idx, frame in enumerate(frames):
+                    writer.submit(frame, os.path.join(out_dir, f'img{idx+1:04}{ext}'))
+                writer.flush()
+                elapsed = time.perf_counter() - t0
+                ratio = writer.compression_ratio()
+                writer.pool.shutdown(wait=True)
+                print(f'{name:<16s} {threads} threads  {n_bytes / elapsed / 1e6:8.1f} MB/s  '
+                      f'{len(frames) / elapsed:6.1f} fps  ratio {ratio:5.2f}')
+
+
+############################################# Frame conversion #########################################################
+def bench_tis_conversion(n=20, width=4000, height=3000):
+    # RGB24 sink buffer of the DFM 37UX226-ML -> 16-bit gray frame, previous copy chain versus rgb_to_gray16
+    import cv2
+    from frame_decoders import rgb_to_gray16
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+    def previous(image):
+        frame = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        frame = np.uint16(frame) * 256
+        frame = cv2.flip(frame, 1)
+        M = cv2.getRotationMatrix2D((width / 2, height / 2), 180, 1.0)     # imutils.rotate(frame, angle=180)
+        return cv2.warpAffine(frame, M, (width, height))
+
+    out, gray = np.empty((height, width), np.uint16), np.empty((height, width), np.uint8)
+    for name, convert in [('cvtColor/*256/flip/rotate', previous),
+                          ('rgb_to_gray16', lambda image: rgb_to_gray16(image, out, gray))]:
+        times = []
+        for _ in range(n):
+            t0 = time.perf_counter()
+            convert(image)
+            times.append(time.perf_counter() - t0)
+        report(name, times, image.nbytes)
+
+
+def bench_tis_y16(camera_mode=None, n=20, width=4000, height=3000):
+    # Y16 sink versus RGB64 video format with an RGB24 sink on the DFM 37UX226-ML: bit-exact check of the Y16
+    # decoder against a reference frame, decode cost, bytes per frame; frame rate on the camera if camera_mode is set
+    from camera import Camera, tis_formats
+    from frame_decoders import get_decoder
+
+    rng = np.random.default_rng(0)
+    reference = rng.integers(0, 4096, (height, width), dtype=np.uint16) << 4     # 12 bits, MSB-aligned
+
+    # sink buffers as tisgrabber fills them: bottom-up rows; Y16 little endian, RGB24 the 8 MSBs in every channel
+    y16 = np.empty((height, width, 2), dtype=np.uint8)
+    y16[..., 0] = reference[::-1] & 0xFF
+    y16[..., 1] = reference[::-1] >> 8
+    rgb24 = np.repeat((reference[::-1] >> 8).astype(np.uint8)[..., None], 3, axis=2)
+
+    for fourcc, raw in [('Y16', y16), ('RGB64', rgb24)]:
+        decoder = get_decoder('DFM 37UX226-ML', fourcc)
+        frame = decoder(raw, width, height)
+        error = np.abs(frame.astype(np.int32) - reference).max()
+        times = []
+        for _ in range(n):
+            t0 = time.perf_counter()
+            decoder(raw, width, height)
+            times.append(time.perf_counter() - t0)
+        report(f'decode {fourcc}', times, raw.nbytes)
+        print(f'  {fourcc}: {width * height * tis_formats[fourcc][1] / 1e6:.1f} MB per frame over USB, '
+              f'{raw.nbytes / 1e6:.1f} MB sink buffer, max error {error}, bit-exact {error == 0}')
+    assert np.array_equal(get_decoder('DFM 37UX226-ML', 'Y16')(y16, width, height), reference), \
+        'Y16 decoder is not bit-exact'
+
+    if camera_mode is None:
+        return
+    for pixelformat in ['RGB64', 'Mono12']:
+        c = Camera(camera_mode=camera_mode, pixelformat=pixelformat, headless=True)
+        c.set_camera()
+        times = []
+        for _ in range(n):
+            t0 = time.perf_counter()
+            c.grab_frame()
+            times.append(time.perf_counter() - t0)
+        report(f'grab {c.fourcc}', times, c.acquisition_info()['bytes_per_frame'])
+        c.close()
+
+
+def bench_decoders(n=20, width=4200, height=3120):
+    # every registered raw-format decoder, plus the previous astype/shift/add Y16 unpacking as reference
+    from frame_decoders import decoders
+
+    rng = np.random.default_rng(0)
+
+    def previous_y16(raw):
+        frame = raw.reshape(height, width * 2)
+        frame = frame.astype(np.uint16)
+        frame = (frame[:, 0::2] << 8) + frame[:, 1::2]
+        return frame.view(np.uint16)
+
+    raw = rng.integers(0, 256, (height, width * 2), dtype=np.uint8)
+    entries = [('previous Y16 unpacking', previous_y16, raw)]
+    for (camera_mode, fourcc), decoder_class in decoders.items():
+        decoder = decoder_class()
+        raw = rng.integers(0, 256, decoder.raw_shape(width, height), dtype=np.uint8)
+        entries.append((f'{camera_mode or "*"} {fourcc}', lambda raw, decoder=decoder: decoder(raw, width, height), raw))
+
+    for name, decode, raw in entries:
+        times = []
+        for _ in range(n):
+            t0 = time.perf_counter()
+            decode(raw)
+            times.append(time.perf_counter() - t0)
+        report(name, times, raw.nbytes)
+
+
+############################################# Preview ##################################################################
+def bench_preview(n=50, width=4000, height=3000):
+    # cost on the acquisition thread: full-frame flatten + weighted 256-bin histogram versus LivePreview.update()
+    from preview import LivePreview
+
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 4096, (height, width), dtype=np.uint16)
+
+    def previous(frame):
+        img_flatten = frame.flatten()
+        np.histogram(img_flatten, bins=256, weights=np.ones_like(img_flatten) / len(img_flatten))
+
+    preview = LivePreview(max_value=4095, headless=True, log_interval=1.0)
+    for name, show in [('flatten/histogram', previous), ('LivePreview.update', preview.update)]:
+        times = []
+        for _ in range(n):
+            t0 = time.perf_counter()
+            show(frame)
+            times.append(time.perf_counter() - t0)
+        report(name, times, frame.nbytes)
+    preview.close()
+
+
+############################################# Scan dataset #############################################################
+def bench_dataset_load(n=121, width=2048, height=2048, img_size=512):
+    # load a centre crop of every frame: one TIFF per position (load_data) versus one memory-mapped dataset
+    import cv2
+    from scan_dataset import ScanDataset, import_tiff_dir
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as out_dir:
+        frame = rng.integers(0, 4096, (height, width), dtype=np.uint16)
+        for idx in range(n):
+            cv2.imwrite(os.path.join(out_dir, f'img{idx+1:04}.tiff'), np.roll(frame, idx, axis=1),
+                        [cv2.IMWRITE_TIFF_COMPRESSION, 1])
+        import_tiff_dir(out_dir, os.path.join(out_dir, 'scan.scands')).close()
+
+        try:
+            from ptychography import load_data
+        except ImportError:
+            def load_data(data_dir, file_type, img_num, img_size, shift):
+                y0, x0 = (height - img_size) // 2 + shift[0], (width - img_size) // 2 + shift[1]
+                stack = np.empty((img_size, img_size, img_num), dtype=np.float32)
+                for idx in range(img_num):
+                    img = cv2.imread(os.path.join(data_dir, f'img{idx+1:04}.{file_type}'), cv2.IMREAD_UNCHANGED)
+                    stack[:, :, idx] = img[y0:y0 + img_size, x0:x0 + img_size]
+                return stack
+
+        t0 = time.perf_counter()
+        load_data(data_dir=out_dir, file_type='tiff', img_num=n, img_size=img_size, shift=[0, 0])
+        t_tiff = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        ds = ScanDataset(os.path.join(out_dir, 'scan.scands'))
+        np.asarray(ds.stack(img_size), dtype=np.float32)
+        t_dataset = time.perf_counter() - t0
+        ds.close()
+
+    print(f'{n} frames {width}x{height}, {img_size}x{img_size} crop: per-TIFF {1e3*t_tiff:.1f} ms, '
+          f'dataset {1e3*t_dataset:.1f} ms ({t_tiff / t_dataset:.1f}x)')
+
+
+benchmarks = {
+    'scan': bench_scan,
+    'scan_engine': bench_scan_engine,
+    'stage': bench_stage,
+    'settle': bench_settle,
+    'scan_planner': bench_scan_planner,
+    'fly_scan': bench_fly_scan,
+    'streaming': bench_streaming,
+    'trigger': bench_trigger,
+    'settings': bench_settings,
+    'roi': bench_roi,
+    'auto_exposure': bench_auto_exposure,
+    'buffer_pool': bench_buffer_pool,
+    'hdr': bench_hdr,
+    'compression': bench_compression,
+    'import': bench_import,
+    'tis_conversion': bench_tis_conversion,
+    'tis_y16': bench_tis_y16,
+    'decoders': bench_decoders,
+    'preview': bench_preview,
+    'dataset_load': bench_dataset_load,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Acquisition pipeline benchmarks')
+    parser.add_argument('benchmark', choices=list(benchmarks.keys()))
+    parser.add_argument('--camera_mode', default=None)
+    parser.add_argument('--n', type=int, default=None, help='iterations, default: the benchmark\'s own')
+    parser.add_argument('--data_dir', default=None, help='frames of a real scan, for the compression benchmark')
+    args = parser.parse_args()
+
+    kwargs = {}
+    if args.n is not None:
+        kwargs['n'] = args.n
+    if args.camera_mode is not None:
+        kwargs['camera_mode'] = args.camera_mode
+    if args.data_dir is not None:
+        kwargs['data_dir'] = args.data_dir
+    benchmarks[args.benchmark](**kwargs)
@@ -0,0 +1,73 @@
+'''
+
+Preallocated frame buffers for the streaming path.
+
+The stream reader copies every grab result straight into a free slot of the pool and gives the pylon buffer back
+at once; the slot travels through the ring and the writer and is returned by whoever finishes with it last. After
+start-up nothing is allocated per frame, so a long scan does not grow the heap, trigger the garbage collector or
+page-fault on fresh allocations.
+
+Python cannot page-lock memory portably, so the slots are "pinned" in the sense that they are written once when
+the pool is created: every page is mapped before the first frame arrives.
+
+'''
+
+import threading
+
+import numpy as np
+
+
+def pixel_dtype(pixelformat):
+    # numpy dtype of an unpacked frame of a GenICam pixel format (Mono8, Mono10, Mono12, Mono16, ...)
+    bits = int(''.join(c for c in pixelformat if c.isdigit()) or 8)
+    return np.uint8 if bits <= 8 else np.uint16
+
+
+class BufferPool():
+    def __init__(self, shape, dtype=np.uint16, count=16):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = []
+        for _ in range(count):
+            slot = np.empty(self.shape, dtype=self.dtype)
+            slot.fill(0)            # map every page now, not on the first frame
+            self.slots.append(slot)
+
+        self.free = list(self.slots)
+        self.owned = {id(slot) for slot in self.slots}
+        self.cond = threading.Condition()
+
+        self.acquired = 0
+        self.exhausted = 0          # acquire() calls that found no free slot in time
+        self.min_free = count
+
+    @property
+    def nbytes(self):
+        return sum(slot.nbytes for slot in self.slots)
+
+    def acquire(self, timeout=None):
+        # a free slot, or None if none was returned within `timeout` seconds
+        with self.cond:
+            if not self.free and not self.cond.wait_for(lambda: self.free, timeout):
+                self.exhausted += 1
+                return None
+            slot = self.free.pop()
+            self.acquired += 1
+            self.min_free = min(self.min_free, len(self.free))
+            return slot
+
+    def release(self, slot):
+        # give a slot back; views of a slot (e.g. an ROI crop) release the slot they look into
+        while id(slot) not in self.owned and isinstance(slot, np.ndarray) and slot.base is not None:
+            slot = slot.base
+        assert id(slot) in self.owned, 'array does not belong to this pool'
+
+        with self.cond:
+            assert all(s is not slot for s in self.free), 'slot released twice'
+            self.free.append(slot)
+            self.cond.notify()
+
+    def stats(self):
+        with self.cond:
+            return {'slots': len(self.slots), 'free': len(self.free), 'min_free': self.min_free,
+                    'acquired': self.acquired, 'exhausted': self.exhausted, 'MB': self.nbytes / 2**20}
@@ -13,28 +13,36 @@ Resources:
 
 import numpy as np
 
-from pygrabber.dshow_graph import FilterGraph
-
-import pylablib
-from pylablib.devices import Basler
-from pypylon import pylon
-
-import platform
-import matplotlib.pyplot as plt
-from mpl_toolkits.axes_grid1 import make_axes_locatable
-from matplotlib.ticker import PercentFormatter
 from time import sleep
 import os
 
 import cv2, queue, threading, time
 
-import tisgrabber as tis
-
 import ctypes
-import imutils
 import re
 
-pylablib.par["devices/dlls/basler_pylon"] = "C:/Basler/pylon/Runtime/x64/"
+from lazy_import import LazyModule
+from streaming import FrameRing, StreamReader
+from frame_decoders import get_decoder
+from frame_writer import FrameWriter, imwrite_params
+from camera_settings import PylonSettings
+from preview import LivePreview, histogram_percentile
+from timing import LatencyStats, FrameLog
+from buffer_pool import BufferPool, pixel_dtype
+from hdr import HDRMerger
+from synthetic import SyntheticCamera
+
+
+def _set_basler_dll_path():
+    import pylablib
+    pylablib.par["devices/dlls/basler_pylon"] = "C:/Basler/pylon/Runtime/x64/"
+
+
+# camera SDKs, imported when the backend of the selected camera_type first uses them
+dshow_graph = LazyModule('pygrabber.dshow_graph')                                    # opencv
+Basler = LazyModule('pylablib.devices.Basler', before_import=_set_basler_dll_path)  # pylon
+pylon = LazyModule('pypylon.pylon')                                                   # pylon
+tis = LazyModule('tisgrabber')                                                        # imaging_source
 
 
 ############################################# Camera control ###########################################################
@@ -53,44 +61,112 @@ pylablib.par["devices/dlls/basler_pylon"] = "C:/Basler/pylon/Runtime/x64/"
 fourcc_names = ['CAP_PROP_FPS',  'CAP_PROP_BRIGHTNESS', 'CAP_PROP_CONTRAST', 'CAP_PROP_SATURATION',
                 'CAP_PROP_HUE', 'CAP_PROP_GAIN', 'CAP_PROP_EXPOSURE', 'CAP_PROP_GAMMA']
 
+# tisgrabber video format FOURCC -> (sink format, bytes per pixel transferred from the camera). Y16 transfers a
+# quarter of RGB64 and keeps the 12 bits of the sensor; the RGB24 sink of RGB64 is converted to 8-bit gray.
+tis_formats = {'Y16': ('Y16', 2), 'RGB64': ('RGB24', 8)}
+
+
+############################################# ROI and binning ##########################################################
+roi_nodes = ['OffsetX', 'Width', 'OffsetY', 'Height']
+
+
+def split_roi(roi, max_width, max_height, soft_binning=1, increments=(1, 1, 1, 1)):
+    '''
+    Split a requested ROI (in binned pixels) into the ROI read out by the sensor and the crop of the delivered frame.
+
+    roi: None (full frame), (width, height) centred, or (x, y, width, height).
+    max_width, max_height: largest frame the sensor delivers, in sensor pixels (after hardware binning).
+    soft_binning: binning done in software, the sensor reads out `soft_binning` times the ROI.
+    increments: granularity of (OffsetX, OffsetY, Width, Height); the sensor ROI is the smallest aligned ROI that
+                contains the request, the remainder is cropped.
+    Returns (x, y, width, height) of the sensor ROI and (row slice, column slice) or None.
+    '''
+    b = soft_binning
+    if roi is None:
+        roi = (max_width // b, max_height // b)
+    if len(roi) == 2:
+        roi = ((max_width // b - roi[0]) // 2, (max_height // b - roi[1]) // 2, roi[0], roi[1])
+    x, y, w, h = [v * b for v in roi]
+    assert x >= 0 and y >= 0 and x + w <= max_width and y + h <= max_height, \
+        f'ROI {roi} is outside of the {max_width // b}x{max_height // b} frame'
+
+    ix, iy, iw, ih = increments
+    hx, hy = x // ix * ix, y // iy * iy
+    hw = min(-(-(x + w - hx) // iw) * iw, max_width - hx)
+    hh = min(-(-(y + h - hy) // ih) * ih, max_height - hy)
+
+    crop = (slice(y - hy, y - hy + h), slice(x - hx, x - hx + w))
+    if (hx, hy, hw, hh) == (x, y, w, h):
+        crop = None
+    return (hx, hy, hw, hh), crop
+
+
+def roi_settings(hardware_roi, current):
+    # OffsetX/Width/OffsetY/Height in an order that is valid at every step: a decreasing offset is written before
+    # the size, an increasing offset after it
+    x, y, w, h = hardware_roi
+    settings = {}
+    for (offset, size), (value, size_value), current_offset in zip([('OffsetX', 'Width'), ('OffsetY', 'Height')],
+                                                                   [(x, w), (y, h)], current[0::2]):
+        if value <= current_offset:
+            settings.update({offset: value, size: size_value})
+        else:
+            settings.update({size: size_value, offset: value})
+    return settings
+
 
-# class VideoCapture:
-#     def __init__(self, name):
-#         self.cap = cv2.VideoCapture(name)
-#         self.q = queue.Queue()
-#         t = threading.Thread(target=self._reader)
-#         t.daemon = True
-#         t.start()
-#
-#     # read frames as soon as they are available, keeping only most recent one
-#     def _reader(self):
-#         while True:
-#             ret, frame = self.cap.read()
-#             if not ret:
-#                 break
-#             if not self.q.empty():
-#                 try:
-#                     self.q.get_nowait()  # discard previous (unprocessed) frame
-#                 except queue.Empty:
-#                     pass
-#             self.q.put(frame)
-#
-#     def read(self):
-#         return self.q.get()
+def bin_frame(frame, binning):
+    # average binning x binning blocks; the frame is cut to a multiple of the binning
+    h, w = frame.shape[0] // binning, frame.shape[1] // binning
+    blocks = frame[:h * binning, :w * binning].reshape(h, binning, w, binning)
+    return (blocks.sum(axis=(1, 3), dtype=np.uint32) // (binning * binning)).astype(frame.dtype)
 
 
 class Camera():
     def __init__(self, camera_mode='DFM 37UX226-ML',
                        brightness=0.0, contrast=0.0, gain=0.0, gamma=1.0,
-                       framerate=30, pixelformat="Mono12", exposuretime=4000):
+                       framerate=30, pixelformat="Mono12", exposuretime=4000,
+                       trigger=None, trigger_timeout=2000, profile=None, roi=None, binning=1, headless=False,
+                       camera_type=None, synthetic=None):
 
         super().__init__()
 
         self.camera_mode = camera_mode
+        self.camera_type = camera_type      # None: from camera_mode
+        self.synthetic = synthetic or {}    # SyntheticCamera arguments for camera_type='synthetic', e.g. a stage
 
         self.cam = None
         self.width = None
         self.height = None
+        self.stream = None
+        self.writer = None
+        self.pool = None                # preallocated frame buffers of the stream, see start_streaming()
+        self.hdr = None                 # HDR merge worker, see capture_hdr()
+
+        # pylon: None for free-run, 'software' for ExecuteSoftwareTrigger, or a trigger line such as 'Line1';
+        # synthetic: None or 'software' (SyntheticCamera.execute_trigger)
+        self.trigger = trigger
+        self.trigger_timeout = trigger_timeout      # ms
+        self.capture_latency = LatencyStats('capture')
+        self.frame_log = FrameLog()                 # device timestamp and host times of every captured frame
+        self.chunk_timestamps = False               # pylon: timestamp from the chunk data instead of the grab result
+
+        # pylon only: name of a saved settings profile, restored on connect and updated when the settings change
+        self.profile = profile
+        self.settings = None
+
+        # Region of interest in binned pixels: None for the full sensor, (width, height) centred on the sensor, or
+        # (x, y, width, height). It is read out by the sensor where the camera supports it, and cropped as a view of
+        # the delivered frame otherwise; binning falls back to averaging in software.
+        self.roi = roi
+        self.binning = binning
+        self.hardware_roi = None            # (x, y, width, height) read out by the sensor
+        self.crop = None                    # (row slice, column slice) of the delivered frame, or None
+        self.soft_binning = 1
+
+        # live preview on its own thread; headless only logs the histogram statistics
+        self.headless = headless
+        self.preview = None
 
         self.brightness=brightness
         self.contrast = contrast
@@ -103,7 +179,13 @@ class Camera():
         print(f'Available cameras: {self.get_available_cameras()}')
 
     def get_available_cameras(self,):
-        if self.camera_mode in ['Sony imx179 8MP', 'See3CAM_CU135M_H03R1']:
+        if self.camera_type is not None:
+            pass
+
+        elif self.camera_mode == 'Synthetic':
+            self.camera_type = 'synthetic'
+
+        elif self.camera_mode in ['Sony imx179 8MP', 'See3CAM_CU135M_H03R1']:
             self.camera_type = 'opencv'
 
         elif self.camera_mode == 'DFM 37UX226-ML':
@@ -117,7 +199,7 @@ class Camera():
 
         available_cameras = {}
         if self.camera_type == "opencv":
-            devices_cv = FilterGraph().get_input_devices()
+            devices_cv = dshow_graph.FilterGraph().get_input_devices()
             for device_index in range(len(devices_cv)):
                 available_cameras[device_index] = devices_cv[device_index]
 
@@ -136,6 +218,9 @@ class Camera():
             for device_index in range(len(devices_pylon)):
                 available_cameras[device_index] = devices_pylon[device_index].GetDeviceFactory()
 
+        elif self.camera_type == "synthetic":
+            available_cameras[0] = 'Synthetic camera'
+
         return available_cameras
 
     def set_camera(self):
@@ -154,52 +239,62 @@ class Camera():
                 self.cam.Close()
 
             #########################  Camera setting #################################
-            basler_names = ["AcquisitionFrameRate", "Width", "Height", "PixelFormat", "ExposureTime", "Gain",
-                            "BslBrightness", "BslContrast"]
-
-            str = f'Default settings: Avaible pixelformat: {self.cam.PixelFormat.Symbolics}; \n'
-            for i in range(len(basler_names)):
-                str = f'{str}{basler_names[i]}: {self.cam.GetNodeMap().GetNode(basler_names[i]).ToString()}; '
-            print(str)
+            # Only the nodes that differ from the camera are written; acquisition is only stopped for the ones
+            # that need it. A saved profile restores everything else in one load.
+            self.settings = PylonSettings(self.cam)
+            if self.settings.has_profile(self.profile):
+                self.settings.load_profile(self.profile)
+            print(f'Available pixelformat: {self.cam.PixelFormat.Symbolics}')
 
-            self.cam.AcquisitionStop.Execute()        # cam stop
-            self.cam.TLParamsLocked = False           # grab unlock
-
-            self.cam.OffsetX, self.cam.OffsetY = 0, 0
-            self.cam.Width, self.cam.Height = self.cam.Width.Max, self.cam.Height.Max
-            self.width,self.height = self.cam.Width, self.cam.Height
-            self.cam.AcquisitionFrameRateEnable = True
-            self.cam.BslContrastMode = "Linear"
             self.cam.MaxNumBuffer = 150
-            self.cam.AcquisitionFrameRate = self.framerate
-            # set color space mode to "off" for mask camera since it's not mono camera
-            # self.cam.BslHue = 0
-            # self.cam.BslSaturation = 0
-            # self.cam.BslColorSpace = "Off"
-            self.cam.BslBrightness = self.brightness    # 0.1
-            self.cam.BslContrast = self.contrast        # 0.3
-            self.cam.PixelFormat = self.pixelformat     # "Mono12"
-            self.cam.Gain = self.gain                   # 1
-            self.cam.ExposureTime = self.exposuretime   # 4000ms
             self.cam.StaticChunkNodeMapPoolSize = self.cam.MaxNumBuffer.GetValue()
 
-            self.cam.TLParamsLocked = True              # grab lock
-            self.cam.AcquisitionStart.Execute()         # cam start
-
-            str = 'New camera settings: \n'
-            for i in range(len(basler_names)):
-                str = f'{str}{basler_names[i]}: {self.cam.GetNodeMap().GetNode(basler_names[i]).ToString()}; '
-            print(str)
+            binning = self.binning if self.settings.available('BinningHorizontal') else 1
+            if self.settings.available('BinningHorizontal'):
+                self.settings.apply({'BinningHorizontal': binning, 'BinningVertical': binning})
+            self.soft_binning = self.binning // binning
+
+            increments = [getattr(self.cam, name).GetInc() for name in ['OffsetX', 'OffsetY', 'Width', 'Height']]
+            self.hardware_roi, self.crop = split_roi(self.roi, self.cam.WidthMax.GetValue(),
+                                                     self.cam.HeightMax.GetValue(), self.soft_binning, increments)
+            settings = roi_settings(self.hardware_roi, [self.settings.get(name) for name in roi_nodes])
+            settings.update({'PixelFormat': self.pixelformat,       # "Mono12"
+                        'BslContrastMode': "Linear",
+                        'BslBrightness': self.brightness,       # 0.1
+                        'BslContrast': self.contrast,           # 0.3
+                        'Gain': self.gain,                      # 1
+                        'ExposureTime': self.exposuretime,      # 4000ms
+                        'TriggerSelector': "FrameStart"})
+            # set color space mode to "off" for mask camera since it's not mono camera
+            # settings.update({'BslHue': 0, 'BslSaturation': 0, 'BslColorSpace': "Off"})
+            if self.trigger is None:
+                settings.update({'TriggerMode': "Off",
+                                 'AcquisitionFrameRateEnable': True,
+                                 'AcquisitionFrameRate': self.framerate})
+            else:
+                settings.update({'AcquisitionFrameRateEnable': False,      # the trigger sets the frame rate
+                                 'TriggerMode': "On",
+                                 'TriggerSource': "Software" if self.trigger == 'software' else self.trigger})
+                if self.trigger != 'software':
+                    settings['TriggerActivation'] = "RisingEdge"
+
+            # device timestamp of every frame in the chunk data
+            self.chunk_timestamps = self.settings.available('ChunkModeActive')
+            if self.chunk_timestamps:
+                settings.update({'ChunkModeActive': True, 'ChunkSelector': "Timestamp", 'ChunkEnable': True})
+
+            changed = self.settings.apply(settings)
+            self.width, self.height = self.settings.get('Width'), self.settings.get('Height')
+            if self.profile is not None and (changed or not self.settings.has_profile(self.profile)):
+                self.settings.save_profile(self.profile)
+
+            print(f'Camera settings ({len(changed)} changed): '
+                  f'{self.settings.describe(["AcquisitionFrameRate"] + list(settings.keys()))}')
+            self.acquisition_info()
 
             ############################## Test setting ##################################
-            self.cam.StartGrabbing()
-            result = self.cam.RetrieveResult(2000, pylon.TimeoutHandling_ThrowException)   # Wait for an image and retrieve it. timeout of 2000 ms.
-
-            if result.GrabSucceeded():
-                frame_image = result.Array
-                self.show_camera_image(frame_image)
-
-            self.cam.StopGrabbing()
+            if self.trigger in [None, 'software']:      # a hardware trigger may not be wired up yet
+                self.show_camera_image(self.grab_frame())
             # self.cam.DeviceReset.Execute()
             # self.cam.Close()
 
@@ -215,15 +310,34 @@ class Camera():
                 print("Camera is open make settings...")
 
                 if self.camera_mode == 'DFM 37UX226-ML':
-                    self.cam.IC_SetVideoFormat(self.hGrabber, "RGB64 (4000x3000)".encode("utf-8"))
+                    # Y16 for mono frames, RGB64 (to 8-bit gray) if an RGB pixel format is asked for
+                    self.fourcc = 'RGB64' if self.pixelformat.upper().startswith('RGB') else 'Y16'
+                    sensor_width, sensor_height = 4000, 3000
+                    self.decoder = get_decoder(self.camera_mode, self.fourcc)
                 else:
-                    print('Camera mode is not implemented.')
+                    # sensor size and video formats are only known for the camera above
+                    self.cam.IC_ReleaseGrabber(self.hGrabber)
+                    raise ValueError(f'Camera mode {self.camera_mode!r} is not implemented for The Imaging Source '
+                                     f'cameras.')
+
+                # "Partial scan": a smaller video format plus an offset; the full format and a crop if it is refused
+                self.soft_binning = self.binning
+                self.hardware_roi, self.crop = split_roi(self.roi, sensor_width, sensor_height, self.soft_binning,
+                                                         [1, 1, 16, 4])
+                x, y, self.width, self.height = self.hardware_roi
+                if self.cam.IC_SetVideoFormat(self.hGrabber, f"{self.fourcc} ({self.width}x{self.height})".encode("utf-8")) != tis.IC_SUCCESS:
+                    self.hardware_roi, self.crop = split_roi(self.roi, sensor_width, sensor_height, self.soft_binning,
+                                                             [sensor_width, sensor_height, sensor_width, sensor_height])
+                    x, y, self.width, self.height = self.hardware_roi
+                    self.cam.IC_SetVideoFormat(self.hGrabber, f"{self.fourcc} ({self.width}x{self.height})".encode("utf-8"))
 
                 self.cam.IC_SetFrameRate(self.hGrabber, ctypes.c_float(self.framerate))
-                self.cam.IC_SetPropertyValue(self.hGrabber, tis.T("Partial scan"), tis.T("Y Offset"), 0)
-                self.cam.IC_SetPropertyValue(self.hGrabber, tis.T("Partial scan"), tis.T("X Offset"), 0)
+                self.cam.IC_SetPropertySwitch(self.hGrabber, tis.T("Partial scan"), tis.T("Auto-center"), 0)
+                self.cam.IC_SetPropertyValue(self.hGrabber, tis.T("Partial scan"), tis.T("Y Offset"), y)
+                self.cam.IC_SetPropertyValue(self.hGrabber, tis.T("Partial scan"), tis.T("X Offset"), x)
                 
-                self.cam.IC_SetFormat(self.hGrabber,  ctypes.c_int(1))   #???
+                # sink format: the layout of the image buffer that IC_GetImagePtr returns
+                self.cam.IC_SetFormat(self.hGrabber, ctypes.c_int(tis.SinkFormats[tis_formats[self.fourcc][0]].value))
 
                 self.cam.IC_SetPropertySwitch(self.hGrabber, tis.T("Exposure"), tis.T("Auto"), 0)
                 self.cam.IC_SetPropertyAbsoluteValue(self.hGrabber, tis.T("Exposure"), tis.T("Value"), ctypes.c_float(self.exposuretime))
@@ -244,32 +358,14 @@ class Camera():
             if self.cam.IC_IsDevValid(self.hGrabber):
                 self.cam.IC_StartLive(self.hGrabber, 1)
                 if self.cam.IC_SnapImage(self.hGrabber, 2000) == tis.IC_SUCCESS:
-                    Width = ctypes.c_long()
-                    Height = ctypes.c_long()
-                    BitsPerPixel = ctypes.c_int()
-                    colorformat = ctypes.c_int()   
-                    self.cam.IC_GetImageDescription(self.hGrabber, Width, Height, BitsPerPixel, colorformat)
-     
-                    # Calculate the buffer size
-                    bpp = int(BitsPerPixel.value / 8.0)
-                    buffer_size = Width.value * Height.value * BitsPerPixel.value
-
-                    # Get the image data
-                    imagePtr = self.cam.IC_GetImagePtr(self.hGrabber)
-                    imagedata = ctypes.cast(imagePtr, ctypes.POINTER(ctypes.c_uint16 *buffer_size))
-
-                    # Create the numpy array
-                    image = np.ndarray(buffer=imagedata.contents,dtype=np.uint8, shape=(Height.value, Width.value, bpp))        
-                    image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-                    image = np.uint16(image)*256
-                    image = imutils.rotate(cv2.flip(image, 1), angle=180)
-
+                    image = self.apply_roi(self.decode(self._imaging_source_buffer()))
                     self.show_camera_image(image)
 
                 else:
                     print("No frame received in 2 seconds.")
 
                 self.cam.IC_StopLive(self.hGrabber)
+                self.acquisition_info()
 
             else:
                 self.cam.IC_MsgBox("No device opened".encode("utf-8"), "Simple Live Video".encode("utf-8"),)
@@ -292,6 +388,13 @@ class Camera():
             else:
                 print('Camera model is not implemented.')
 
+            self.width, self.height = int(self.cam.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.cam.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+            # UVC cameras only offer fixed resolutions: the ROI is a view of the decoded frame
+            self.soft_binning = self.binning
+            self.hardware_roi, self.crop = split_roi(self.roi, self.width, self.height, self.soft_binning,
+                                                     [self.width, self.height, self.width, self.height])
+
             # print(f'Camera frame size is:{cv2.CAP_PROP_FRAME_WIDTH} x {cv2.CAP_PROP_FRAME_HEIGHT}')
             print(f'Camera frame size is:{self.cam.get(cv2.CAP_PROP_FRAME_WIDTH)} x {self.cam.get(cv2.CAP_PROP_FRAME_HEIGHT)}')
 
@@ -326,10 +429,13 @@ class Camera():
             ######################## Retrieval raw data ########################
             # reference: https://stackoverflow.com/questions/70718890/how-to-retrieve-raw-data-from-yuv2-streaming
             # Disable the conversion to BGR by setting FOURCC to Y16 and `CAP_PROP_CONVERT_RGB` to 0.
+            self.fourcc = 'Y16'
+            self.decoder = get_decoder(self.camera_mode, self.fourcc)
+
             if self.camera_mode == 'See3CAM_CU135M_H03R1':
                 # self.cam.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc('G', 'R', 'E', 'Y'))
                 # fmt = self.cam.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc('Y','8',' ',' '))
-                fmt = self.cam.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc('Y', '1', '6', ' '))
+                fmt = self.cam.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*f'{self.fourcc:<4}'))
 
                 self.cam.set(cv2.CAP_PROP_CONVERT_RGB, 0)
 
@@ -338,7 +444,7 @@ class Camera():
                 # cam.set(cv2.CAP_PROP_FORMAT, cv2.CV_8UC1)
 
             else:
-                self.cam.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter.fourcc('Y', '1', '6', ' '))
+                self.cam.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter.fourcc(*f'{self.fourcc:<4}'))
                 self.cam.set(cv2.CAP_PROP_CONVERT_RGB, 0)
 
                 # Fetch undecoded RAW video streams
@@ -359,119 +465,565 @@ class Camera():
             success, frame = self.cam.retrieve(0)
             if success:
                 print(f'frame.shape = {frame.shape}, frame.dtype = {frame.dtype}')
-                if self.camera_mode == 'HD USB Camera':
-                    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                    frame = np.uint16(frame) * 256
-
-                elif self.camera_mode == 'See3CAM_CU135M_H03R1':
-                    frame = frame.astype(np.uint16) * 255
-
-                elif self.camera_mode == 'Sony imx179 8MP':
-                    frame = frame.reshape(self.height, self.width * 2)
-                    frame = frame.astype(np.uint16)   # Convert uint8 elements to uint16 elements
-                    frame = (frame[:, 0::2] << 8) + frame[:, 1::2]   # Convert from little endian to big endian (apply byte swap)
-                    frame = frame.view(np.uint16)    # The data is actually signed 16 bits - view it as int16 (16 bits singed).
-
-                else:
-                    frame = frame.reshape(self.height, self.width * 2)
-                    frame = frame.astype(np.uint16)   # Convert uint8 elements to uint16 elements
-                    frame = (frame[:, 0::2] << 8) + frame[:, 1::2]   # Convert from little endian to big endian (apply byte swap)
-                    frame = frame.view(np.uint16)    # The data is actually signed 16 bits - view it as int16 (16 bits singed).
-                   
+                frame = self.apply_roi(self.decode(frame))
                 self.show_camera_image(frame)
                 
             else:
                 print('failed to grab frame')
-
-    def capture(self, out_file_name):
+            self.acquisition_info()
+
+        elif self.camera_type == 'synthetic':
+            self._set_synthetic_camera()
+
+    def _set_synthetic_camera(self):
+        # no hardware: deterministic frames at the configured resolution, bit depth, frame rate and latency
+        self.camera_mode = 'Synthetic'
+        bits = int(''.join(c for c in self.pixelformat if c.isdigit()) or 8)
+        synthetic = dict(self.synthetic, trigger='software') if self.trigger == 'software' else self.synthetic
+        self.cam = SyntheticCamera(bit_depth=bits, framerate=self.framerate, exposure=self.exposuretime,
+                                   **synthetic)
+
+        # the synthetic sensor reads out any ROI, binning is done in software
+        self.soft_binning = self.binning
+        self.hardware_roi, self.crop = split_roi(self.roi, self.cam.sensor_width, self.cam.sensor_height,
+                                                 self.soft_binning)
+        self.cam.set_roi(self.hardware_roi)
+        self.width, self.height = self.cam.width, self.cam.height
+        print(f'Synthetic camera: {self.width}x{self.height}, {bits} bit, {self.framerate} fps, '
+              f'readout latency {1e3*self.cam.readout_latency:.1f} ms, drop rate {self.cam.drop_rate}')
+
+        if self.cam.trigger in [None, 'software']:    # a position-triggered camera has no frame until the stage moves
+            self.show_camera_image(self.grab_frame())
+        self.acquisition_info()
+
+    def set_exposure(self, exposuretime):
+        # Fast path between scan points: only the exposure node is written, acquisition keeps running.
         if self.camera_type == 'pylon':
-            # trigger the camera.
-            img = pylon.PylonImage()
-            self.cam.StartGrabbing()
-            with self.cam.RetrieveResult(2000) as result:
-                # Calling AttachGrabResultBuffer creates another reference to the grab result buffer.
-                # This prevents the buffer's reuse for grabbing.
-                if result.GrabSucceeded():
-                    img.AttachGrabResultBuffer(result)
+            self.settings.apply({'ExposureTime': exposuretime})
 
-                    if platform.system() == 'Windows':
-                        img.Save(pylon.ImageFileFormat_Tiff, out_file_name)
-                        # img.Save(pylon.ImageFileFormat_Raw, filename)
-                    else:
-                        img.Save(pylon.ImageFileFormat_Png, out_file_name)
+        elif self.camera_type == 'imaging_source':
+            self.cam.IC_SetPropertyAbsoluteValue(self.hGrabber, tis.T("Exposure"), tis.T("Value"), ctypes.c_float(exposuretime))
 
-                    time.sleep(0.1)
+        elif self.camera_type == 'opencv':
+            self.cam.set(cv2.CAP_PROP_EXPOSURE, exposuretime)
+
+        elif self.camera_type == 'synthetic':
+            self.cam.exposure = exposuretime
+
+        self.exposuretime = exposuretime
+        if self.stream is not None:
+            self.stream.set_latency(self._stream_latency())
+
+    def auto_exposure(self, target=0.8, percentile=99.9, tolerance=0.05, max_frames=6, limits=None, black_level=0):
+        # Set the exposure so that the `percentile` of the pixel values is at `target` of full scale (for the bit
+        # depth of the pixel format). The response is linear in the exposure time, so every frame gives the next
+        # exposure directly instead of a fixed step. A saturated percentile only tells that the exposure is too long,
+        # it is then cut to a quarter. `limits` (min, max) in the units of `exposuretime`; `black_level` is the pixel
+        # value at zero exposure, in the units of the frame.
+        full = self.max_value()
+        if limits is None and self.camera_type == 'pylon':
+            limits = (self.cam.ExposureTime.GetMin(), self.cam.ExposureTime.GetMax())
+
+        # exposure <-> linear exposure time; on DirectShow the exposure is log2(s) in integer steps
+        log2 = self.camera_type == 'opencv'
+        to_linear = (lambda e: 2.0 ** e) if log2 else (lambda e: e)
+        from_linear = (lambda t: int(round(np.log2(t)))) if log2 else (lambda t: t)
+
+        exposure = self.exposuretime
+        t_set = time.perf_counter()
+        for idx in range(max_frames):
+            frame = self.grab_frame(after=t_set)
+            value, saturated = histogram_percentile(frame, percentile, full)
+            level = value / full
+            print(f'Auto exposure {idx+1}: exposure={exposure}, p{percentile}={value:.0f} ({100*level:.1f} %), '
+                  f'saturated={100*saturated:.2f} %')
+
+            if saturated * 100 > 100 - percentile:
+                factor = 0.25           # clipped: the true level is unknown, so step well below it
+            elif abs(level / target - 1) <= tolerance:
+                break
+            else:
+                factor = (target * full - black_level) / max(value - black_level, 1)
+
+            new_exposure = from_linear(to_linear(exposure) * min(max(factor, 1 / 16), 16))
+            if limits is not None:
+                new_exposure = min(max(new_exposure, limits[0]), limits[1])
+            if new_exposure == exposure:
+                break
+
+            exposure = new_exposure
+            self.set_exposure(exposure)
+            t_set = time.perf_counter()
+
+        return exposure
+
+    def update_settings(self, **nodes):
+        # pylon only: write the nodes (name=value) that changed. If one of them needs acquisition to be stopped,
+        # grabbing and streaming are stopped and restarted around it.
+        changed = self.settings.diff(nodes)
+        if not changed:
+            return changed
+
+        restart = None
+        if self.settings.requires_stop(changed) and self.cam.IsGrabbing():
+            restart = self.stream.ring.size if self.stream is not None else None
+            self.stop_streaming()
+            if self.cam.IsGrabbing():
+                self.cam.StopGrabbing()
 
-            result.Release()
-            self.cam.StopGrabbing()
+        self.settings.apply(changed)
+        self.width, self.height = self.settings.get('Width'), self.settings.get('Height')
+        if 'ExposureTime' in changed:
+            self.exposuretime = changed['ExposureTime']
 
-        elif self.camera_type == 'imaging_source':
-            # if self.camera_mode == 'DFM 37UX226-ML':
-            # self.hGrabber = self.cam.IC_CreateGrabber()
-            ######################### Test capture #################################
-            if self.cam.IC_IsDevValid(self.hGrabber):
-                self.cam.IC_StartLive(self.hGrabber, 1)
-                if self.cam.IC_SnapImage(self.hGrabber, 2000) == tis.IC_SUCCESS:
-                    Width = ctypes.c_long()
-                    Height = ctypes.c_long()
-                    BitsPerPixel = ctypes.c_int()
-                    colorformat = ctypes.c_int()   
-                    self.cam.IC_GetImageDescription(self.hGrabber, Width, Height, BitsPerPixel, colorformat)
+        if restart is not None:
+            self.start_streaming(buffer_size=restart)
+
+        return changed
 
-                    # Calculate the buffer size
-                    bpp = int(BitsPerPixel.value / 8.0)
-                    buffer_size = Width.value * Height.value * BitsPerPixel.value
+    def start_streaming(self, buffer_size=None, grab_timeout=100, pool_size=None):
+        # Keep the camera grabbing for the whole scan; capture() then takes the next frame from a bounded ring.
+        # pylon buffers the last `buffer_size` frames (default 8), OpenCV only keeps the latest frame (default 1).
+        # pylon and synthetic frames are copied into a pool of `pool_size` preallocated buffers (default: the ring
+        # plus 16 frames in the writer); pool_size=0 allocates a new array per frame instead.
+        if self.stream is not None:
+            return
 
-                    # Get the image data
-                    imagePtr = self.cam.IC_GetImagePtr(self.hGrabber)
-                    imagedata = ctypes.cast(imagePtr, ctypes.POINTER(ctypes.c_uint16 *buffer_size))
+        self.grab_timeout = grab_timeout        # ms, so the reader notices stop_streaming() quickly
+        if self.camera_type in ['pylon', 'synthetic'] and pool_size != 0:
+            # the dtype of the frames that are copied in: a narrower pool would truncate them
+            dtype = self.cam.dtype if self.camera_type == 'synthetic' else pixel_dtype(self.pixelformat)
+            self.pool = BufferPool((self.height, self.width), dtype, pool_size or (buffer_size or 8) + 16)
+        on_discard = None if self.pool is None else self.pool.release
 
-                    # Create the numpy array
-                    frame = np.ndarray(buffer=imagedata.contents,dtype=np.uint8, shape=(Height.value, Width.value, bpp))        
-                    frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
-                    frame = np.uint16(frame)*256
-                    frame = imutils.rotate(cv2.flip(frame, 1), angle=180)
+        if self.camera_type == 'pylon':
+            if not self.cam.IsGrabbing():
+                self.cam.StartGrabbing(pylon.GrabStrategy_OneByOne)
+            self.stream = StreamReader(self._read_pylon, FrameRing(buffer_size or 8, on_discard),
+                                       latency=self._stream_latency(), device_clock=True, name='PylonStream').start()
 
-                    cv2.imwrite(out_file_name, frame, [cv2.IMWRITE_TIFF_COMPRESSION, 1])
+        elif self.camera_type == 'opencv':
+            # the driver queues a few frames itself; reading them continuously keeps only the newest one around
+            self.stream = StreamReader(self._read_opencv, FrameRing(buffer_size or 1),
+                                       latency=self._stream_latency(), name='OpenCVStream').start()
 
-                else:
-                    print("No frame received in 2 seconds.")
-                # self.cam.IC_StopLive(self.hGrabber)
+        elif self.camera_type == 'synthetic':
+            # the synthetic camera reuses its output buffer, the ring keeps copies
+            self.stream = StreamReader(self._read_synthetic, FrameRing(buffer_size or 8, on_discard),
+                                       latency=self._stream_latency(), device_clock=True,
+                                       name='SyntheticStream').start()
+
+        else:
+            print(f'Streaming is not implemented for {self.camera_type} cameras.')
 
+    def _stream_latency(self):
+        # Longest time from the exposure start to the arrival of a frame [s]: the exposure plus readout and transfer.
+        # While the camera keeps up, readout and transfer take at most a frame period (pylon: at the highest frame
+        # rate the current settings allow).
+        if self.camera_type == 'pylon':
+            return self.exposuretime * 1e-6 + 1 / self.cam.ResultingFrameRate.GetValue()
+        if self.camera_type == 'synthetic':
+            return self.exposuretime * 1e-6 + self.cam.readout_latency
+        if self.camera_type == 'opencv':
+            # the exposure is log2(s) on DirectShow; otherwise unknown, but at most a frame period in free-run
+            period = 1 / (self.cam.get(cv2.CAP_PROP_FPS) or self.framerate)
+            return (2.0 ** self.exposuretime if self.exposuretime < 0 else period) + period
+        return 0.0
+
+    def stop_streaming(self):
+        if self.stream is None:
+            return
+
+        self.stream.stop()
+        if self.camera_type == 'pylon' and self.trigger is None:
+            self.cam.StopGrabbing()
+
+        print(f'Streaming stopped: {self.stream.stats()}')
+        self.stream = None
+        if self.pool is not None:
+            print(f'Buffer pool: {self.pool.stats()}')
+            self.pool = None
+
+    def stream_stats(self):
+        return None if self.stream is None else self.stream.stats()
+
+    def _read_pylon(self):
+        result = self.cam.RetrieveResult(self.grab_timeout, pylon.TimeoutHandling_Return)
+        if result is None or not result.IsValid():
+            return None
+
+        try:
+            if not result.GrabSucceeded():
+                return None
+            if self.pool is None:
+                frame = result.GetArray()
             else:
-                print("No device opened.")
-            # self.cam.IC_ReleaseGrabber(self.hGrabber)
-           
+                frame = self.pool.acquire(self.grab_timeout / 1000)
+                if frame is None:
+                    return None         # every slot is still in use downstream: the frame is dropped
+                with result.GetArrayZeroCopy() as raw:
+                    np.copyto(frame, raw, casting='safe')     # raises instead of truncating
+            return frame, result.GetNumberOfSkippedImages(), self._pylon_timestamp(result)
+        finally:
+            result.Release()      # give the buffer back to pylon straight away
+
+    def _pylon_timestamp(self, result):
+        # device timestamp in s; the timestamp ticks are ns on the USB3 cameras
+        if self.chunk_timestamps:
+            return result.ChunkTimestamp.Value * 1e-9
+        return result.GetTimeStamp() * 1e-9
+
+    def _read_synthetic(self):
+        result = self.cam.read()
+        if result is None:
+            return None
+        if self.pool is None:
+            return result[0].copy(), result[1], result[2]
+
+        frame = self.pool.acquire(self.grab_timeout / 1000)
+        if frame is None:
+            return None
+        np.copyto(frame, result[0], casting='safe')
+        return frame, result[1], result[2]
+
+    def _read_opencv(self):
+        success, frame = self.cam.read()
+        return (frame, 0, self.cam.get(cv2.CAP_PROP_POS_MSEC) * 1e-3) if success else None
+
+    def capture(self, out_file_name, after=None):
+        # only accept frames exposed after `after` (time.perf_counter()), by default after the capture request,
+        # i.e. after the stage has settled
+        # Return the FrameRecord of the frame; its `written` time is filled in once the file is written.
+        t_request = time.perf_counter()
+        record = self.frame_log.new(out_file_name, t_request)
+        frame, reused, info = self._grab(t_request if after is None else after)
+        frame, reused = self.apply_roi(frame), reused and self.soft_binning == 1
+        record.arrival, record.device_timestamp = info['arrival'], info['device_timestamp']
+
+        record.decoded = time.perf_counter()
+        self.capture_latency.add(record.decoded - t_request)
+        if self.preview is not None:
+            self.preview.update(frame)
+        self.save_frame(frame, out_file_name, copy=reused, record=record, release=self._slot_release(info))
+        record.returned = time.perf_counter()      # after a possible wait for room in the writer queue
+        return record
+
+    def arm(self):
+        # Get ready for the next frame while the stage is still moving or settling, so that a grab after the settle
+        # only waits for the exposure: the stream is running, or in pylon trigger mode the camera is grabbing and
+        # (software trigger) ready for the trigger.
+        if self.camera_type == 'pylon' and self.trigger is not None:
+            if not self.cam.IsGrabbing():
+                self.cam.StartGrabbing(pylon.GrabStrategy_OneByOne)
+            if self.trigger == 'software':
+                self.cam.WaitForFrameTriggerReady(self.trigger_timeout, pylon.TimeoutHandling_Return)
+        elif self.stream is None and self.camera_type in ['pylon', 'opencv', 'synthetic']:
+            self.start_streaming()
+
+    def grab_frame(self, after=None, on_exposed=None, keep_slot=False):
+        # Return one frame as an ndarray that the caller owns.
+        # on_exposed() is called as soon as the exposure is over: in pylon software trigger mode before the frame is
+        # read out, so that e.g. the stage can move on meanwhile; otherwise once the frame has arrived.
+        # keep_slot=True returns a frame of the buffer pool as it is instead of a copy: it stays out of the pool until
+        # last_info['release']() is called (None for a frame the caller owns), e.g. by save_frame(release=...).
+        t_request = time.perf_counter()
+        frame, reused, info = self._grab(t_request if after is None else after, on_exposed)
+        if on_exposed is not None and not info.get('exposed'):
+            on_exposed()
+        frame, reused = self.apply_roi(frame), reused and self.soft_binning == 1
+        self.capture_latency.add(time.perf_counter() - t_request)
+        self.last_info = info
+
+        if info.get('slot') is not None:
+            if keep_slot and self.soft_binning == 1:
+                self.last_info = dict(info, release=self._slot_release(info))
+                return frame
+            frame = frame.copy() if self.soft_binning == 1 else frame       # binning made a new array
+            self.pool.release(info['slot'])
+            return frame
+        return frame.copy() if reused else frame
+
+    def _slot_release(self, info):
+        # a call that gives the frame's pool slot back, None if the frame is not from the pool
+        slot, pool = info.get('slot'), self.pool
+        return None if slot is None else lambda: pool.release(slot)
+
+    def capture_hdr(self, out_file_name, exposures, black_level=0, saturation=0.95, save_brackets=False):
+        # Capture one frame per exposure time in `exposures` and merge them into a float32 HDR frame on a worker
+        # thread (see hdr.py), written to `out_file_name`. Only the exposure is changed between the frames; in
+        # pylon trigger mode the next exposure is written while the previous frame is still being read out.
+        # Returns a Future of (hdr, saturated mask).
+        if self.hdr is None:
+            self.hdr = HDRMerger(max_value=self.max_value(), black_level=black_level, saturation=saturation)
+
+        exposure = self.exposuretime
+        try:
+            if self.camera_type == 'pylon' and self.trigger == 'software':
+                frames = self._bracket_triggered(exposures)
+            else:
+                frames = []
+                for e in exposures:
+                    self.set_exposure(e)
+                    frames.append(self.grab_frame(after=time.perf_counter()))
+        finally:
+            self.set_exposure(exposure)
+
+        if save_brackets:
+            root, ext = os.path.splitext(out_file_name)
+            for frame, e in zip(frames, exposures):
+                self.save_frame(frame, f'{root}_exp{e:g}{ext}', copy=False)
+        return self.hdr.submit(frames, exposures, out_file_name)
+
+    def _bracket_triggered(self, exposures):
+        # Pipelined bracket: trigger every exposure as soon as the camera is ready for the next trigger (the
+        # exposure of the previous frame has ended), then collect the frames. The exposure, and with it the stream
+        # latency, changes while the frames are in flight, so stream frames are matched to the triggers by their
+        # order in the ring, not by their timestamps.
+        if not self.cam.IsGrabbing():
+            self.cam.StartGrabbing(pylon.GrabStrategy_OneByOne)
+
+        if self.stream is not None:
+            stats = self.stream.stats()
+            seq, dropped = stats['received'], stats['dropped']     # frames before the first trigger are stale
+        t_triggers = []
+        for e in exposures:
+            self.set_exposure(e)
+            if not self.cam.WaitForFrameTriggerReady(self.trigger_timeout, pylon.TimeoutHandling_Return):
+                raise TimeoutError(f'Camera not ready for a trigger within {self.trigger_timeout} ms.')
+            t_triggers.append(time.perf_counter())
+            self.cam.ExecuteSoftwareTrigger()
+
+        frames = []
+        for _ in t_triggers:
+            if self.stream is not None:
+                seq, _, frame, info = self.stream.next_frame(after_seq=seq, timeout=self.trigger_timeout / 1000)
+                if self.stream.stats()['dropped'] != dropped:
+                    if self.pool is not None:
+                        self.pool.release(frame)
+                    raise RuntimeError('A frame of the exposure bracket was dropped, the frames cannot be matched '
+                                       'to their exposures.')
+                if self.pool is not None:
+                    owned = frame.copy()
+                    self.pool.release(frame)
+                    frame = owned
+            else:
+                result = self.cam.RetrieveResult(self.trigger_timeout, pylon.TimeoutHandling_Return)
+                if result is None or not result.IsValid():
+                    raise TimeoutError(f'No triggered frame received in {self.trigger_timeout} ms.')
+                try:
+                    if not result.GrabSucceeded():
+                        raise RuntimeError(f'Grab failed: {result.GetErrorDescription()}')
+                    frame = result.GetArray()
+                finally:
+                    result.Release()
+            frames.append(self.apply_roi(frame))
+        return frames
+
+    def _grab(self, after, on_exposed=None):
+        # Return (frame, reused, info): `reused` frames live in a buffer that is overwritten by the next grab,
+        # info holds the host arrival time and the device timestamp (None if the backend has none).
+        if self.camera_type == 'pylon' and self.trigger is not None:
+            frame, info = self._grab_triggered(after, on_exposed)
+            return frame, False, info
+        if self.camera_type == 'synthetic' and self.trigger == 'software':
+            return self._grab_synthetic_triggered(on_exposed)
+
+        if self.stream is not None:
+            _, _, frame, info = self.stream.next_frame(after=after)
+            if self.camera_type == 'opencv':
+                return self.decode(frame), True, info
+            if self.pool is not None:
+                info = dict(info, slot=frame)       # to be returned to the pool once it is written
+            return frame, False, info   # ring frames are not reused
+
+        if self.camera_type == 'pylon':
+            self.cam.StartGrabbing()
+            try:
+                with self.cam.RetrieveResult(2000) as result:
+                    if not result.GrabSucceeded():
+                        raise RuntimeError(f'Grab failed: {result.GetErrorDescription()}')
+                    info = {'arrival': time.perf_counter(), 'device_timestamp': self._pylon_timestamp(result)}
+                    return result.GetArray(), False, info
+            finally:
+                self.cam.StopGrabbing()
+
+        elif self.camera_type == 'imaging_source':
+            # tisgrabber has no per-frame time, the frame is stamped when the snap returns
+            assert self.cam.IC_IsDevValid(self.hGrabber), 'No device opened.'
+            self.cam.IC_StartLive(self.hGrabber, 1)
+            if self.cam.IC_SnapImage(self.hGrabber, 2000) != tis.IC_SUCCESS:
+                raise TimeoutError('No frame received in 2 seconds.')
+            info = {'arrival': time.perf_counter(), 'device_timestamp': None}
+            return self.decode(self._imaging_source_buffer()), True, info
+
         elif self.camera_type == 'opencv':
             # success, frame = self.cam.read()    # combines both grab and retrieve into one command and returns the decoded frame
             self.cam.grab()  # "only" gets the image from the camera and holds it for further processing:
             success, frame = self.cam.retrieve(0)
             assert success, 'failed to grab frame'
+            info = {'arrival': time.perf_counter(), 'device_timestamp': self.cam.get(cv2.CAP_PROP_POS_MSEC) * 1e-3}
+            return self.decode(frame), True, info
+
+        elif self.camera_type == 'synthetic':
+            frame = self.cam.snap()
+            return frame, True, {'arrival': time.perf_counter(), 'device_timestamp': self.cam.last_timestamp}
+
+    def _grab_triggered(self, after=None, on_exposed=None):
+        # Triggered pylon capture: the exposure starts when the software trigger is executed (or the trigger line
+        # fires), so the latency is exposure plus readout instead of up to a full frame period in free-run mode.
+        # A trigger line may fire before the call (fly_scan.py): then any frame exposed after `after` is taken.
+        if not self.cam.IsGrabbing():
+            self.cam.StartGrabbing(pylon.GrabStrategy_OneByOne)
+
+        t_trigger = time.perf_counter()
+        if self.trigger == 'software':
+            if not self.cam.WaitForFrameTriggerReady(self.trigger_timeout, pylon.TimeoutHandling_Return):
+                raise TimeoutError(f'Camera not ready for a trigger within {self.trigger_timeout} ms.')
+            self.cam.ExecuteSoftwareTrigger()
+
+            if on_exposed is not None:
+                # the exposure ends `exposuretime` after the trigger, the readout runs while the caller goes on
+                time.sleep(max(t_trigger + self.exposuretime * 1e-6 - time.perf_counter(), 0.0))
+                on_exposed()
+        exposed = {'exposed': True} if self.trigger == 'software' and on_exposed is not None else {}
+
+        if self.stream is not None:
+            since = t_trigger if self.trigger == 'software' or after is None else after
+            _, _, frame, info = self.stream.next_frame(after=since, timeout=self.trigger_timeout / 1000)
+            info = dict(info, **exposed)
+            if self.pool is not None:
+                info = dict(info, slot=frame)
+            return frame, info
+
+        result = self.cam.RetrieveResult(self.trigger_timeout, pylon.TimeoutHandling_Return)
+        if result is None or not result.IsValid():
+            raise TimeoutError(f'No triggered frame received in {self.trigger_timeout} ms.')
+        try:
+            if not result.GrabSucceeded():
+                raise RuntimeError(f'Grab failed: {result.GetErrorDescription()}')
+            info = {'arrival': time.perf_counter(), 'device_timestamp': self._pylon_timestamp(result), **exposed}
+            return result.GetArray(), info
+        finally:
+            result.Release()
+
+    def _grab_synthetic_triggered(self, on_exposed=None):
+        # The synthetic counterpart of the software trigger in _grab_triggered: the exposure starts at the trigger
+        # and on_exposed() is called when it ends, while the frame is still being read out.
+        t_trigger = self.cam.execute_trigger()
+        exposed = {}
+        if on_exposed is not None:
+            time.sleep(max(t_trigger + self.exposuretime * 1e-6 - time.perf_counter(), 0.0))
+            on_exposed()
+            exposed = {'exposed': True}
+
+        if self.stream is not None:
+            _, _, frame, info = self.stream.next_frame(after=t_trigger, timeout=self.trigger_timeout / 1000)
+            info = dict(info, **exposed)
+            if self.pool is not None:
+                info = dict(info, slot=frame)
+            return frame, False, info
+
+        frame, _, timestamp = self.cam.wait_triggered(self.trigger_timeout / 1000)
+        return frame, True, {'arrival': time.perf_counter(), 'device_timestamp': timestamp, **exposed}
+
+    def latency_histogram(self, bins=20):
+        # histogram of the capture latencies (request to frame available), to compare free-run and triggered modes
+        print(self.capture_latency.summary())
+        return self.capture_latency.histogram(bins)
+
+    def start_writer(self, workers=2, max_inflight_mb=512, compression='none', png_level=1):
+        # Write frames on a thread pool; capture() only blocks when `max_inflight_mb` of frames are queued.
+        # compression: lossless TIFF codec ('none', 'lzw' or 'deflate'); png_level for .png file names.
+        if self.writer is None:
+            self.writer = FrameWriter(workers=workers, max_inflight_mb=max_inflight_mb, compression=compression,
+                                      png_level=png_level)
+
+    def save_frame(self, frame, out_file_name, copy=True, record=None, release=None):
+        # Decoded frames live in buffers reused by the next capture, so the writer gets a copy unless `copy=False`.
+        # The write-complete time goes into `record` (a FrameRecord); release() is called once the frame is written,
+        # e.g. to give its pool slot back.
+        def on_done(_):
+            if record is not None:
+                record.written = time.perf_counter()
+            if release is not None:
+                release()
+
+        if self.writer is None:
+            try:
+                cv2.imwrite(out_file_name, frame, imwrite_params(out_file_name))
+            finally:
+                on_done(frame)
+        else:
+            self.writer.submit(frame.copy() if copy else frame, out_file_name, on_done=on_done)
+
+    def _imaging_source_buffer(self):
+        # Zero-copy view over the driver's image buffer, only valid until the next snap.
+        Width = ctypes.c_long()
+        Height = ctypes.c_long()
+        BitsPerPixel = ctypes.c_int()
+        colorformat = ctypes.c_int()
+        self.cam.IC_GetImageDescription(self.hGrabber, Width, Height, BitsPerPixel, colorformat)
+
+        bpp = BitsPerPixel.value // 8      # bytes per pixel
+        buffer_size = Width.value * Height.value * bpp
+
+        imagePtr = self.cam.IC_GetImagePtr(self.hGrabber)
+        imagedata = ctypes.cast(imagePtr, ctypes.POINTER(ctypes.c_uint8 * buffer_size))
+        return np.ndarray(buffer=imagedata.contents, dtype=np.uint8, shape=(Height.value, Width.value, bpp))
+
+    def apply_roi(self, frame):
+        # the part of the ROI that the sensor could not do: a crop view, then software binning (a new array)
+        if self.crop is not None:
+            frame = frame[self.crop]
+        if self.soft_binning > 1:
+            frame = bin_frame(frame, self.soft_binning)
+        return frame
+
+    def acquisition_info(self):
+        # effective frame rate and bytes per frame transferred from the camera in the current ROI/binning mode
+        if self.camera_type == 'pylon':
+            fps = self.cam.ResultingFrameRate.GetValue()
+            n_bytes = self.cam.PayloadSize.GetValue()
+        elif self.camera_type == 'imaging_source':
+            fps = self.cam.IC_GetFrameRate(self.hGrabber)
+            n_bytes = self.width * self.height * tis_formats[self.fourcc][1]     # over USB, not in the sink
+        elif self.camera_type == 'synthetic':
+            fps = self.cam.framerate
+            n_bytes = self.width * self.height * self.cam.dtype.itemsize
+        else:
+            fps = self.cam.get(cv2.CAP_PROP_FPS)
+            n_bytes = self.width * self.height * self.decoder.bytes_per_pixel
 
-            if self.camera_mode == 'HD USB Camera':
-                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                frame = np.uint16(frame) * 256
+        info = {'hardware_roi': self.hardware_roi, 'crop': self.crop is not None, 'soft_binning': self.soft_binning,
+                'fps': fps, 'bytes_per_frame': n_bytes, 'MB/s': fps * n_bytes / 1e6}
+        print(f'Acquisition mode: ' + ', '.join(f'{key}={value}' for key, value in info.items()))
+        return info
 
-            elif self.camera_mode == 'See3CAM_CU135M_H03R1':
-                frame = frame.astype(np.uint16) * 255
+    def decode(self, raw):
+        # raw backend buffer -> uint16 frame, written into a buffer that the decoder reuses for the next frame
+        return self.decoder(raw, self.width, self.height)
 
-            elif self.camera_mode == 'Sony imx179 8MP':
-                frame = frame.reshape(self.height, self.width * 2)
-                frame = frame.astype(np.uint16)  # Convert uint8 elements to uint16 elements
-                frame = (frame[:, 0::2] << 8) + frame[:, 1::2]  # Convert from little endian to big endian (byte swap)
-                frame = frame.view(np.uint16)  # The data is signed 16 bits - view it as int16 (16 bits singed).
+    def close(self):
+        self.stop_streaming()
 
-            else:
-                frame = frame.reshape(self.height, self.width * 2)
-                frame = frame.astype(np.uint16)  # Convert uint8 elements to uint16 elements
-                frame = (frame[:, 0::2] << 8) + frame[:, 1::2]  # Convert from little endian to big endian (byte swap)
-                frame = frame.view(np.uint16)  # The data is signed 16 bits - view it as int16 (16 bits singed).
+        if self.preview is not None:
+            self.preview.close()
+            self.preview = None
 
-                # Save the frame as a TIF image
-            cv2.imwrite(out_file_name, frame, [cv2.IMWRITE_TIFF_COMPRESSION, 1])
+        if self.hdr is not None:
+            self.hdr.close()           # waits for the queued merges
+            self.hdr = None
+
+        if self.writer is not None:
+            self.writer.close()        # waits for the queued frames, raises if one of them could not be written
+            self.writer = None
+
+        if len(self.frame_log) > 0:
+            print(f'Frame log: {self.frame_log.summary()}')
 
-    def close(self):
         if self.camera_type == 'pylon':
+            if self.cam.IsGrabbing():
+                self.cam.StopGrabbing()
             self.cam.Close()
 
         elif self.camera_type == 'imaging_source':
@@ -481,25 +1033,24 @@ class Camera():
         elif self.camera_type == 'opencv':
             self.cam.release()
 
+        elif self.camera_type == 'synthetic':
+            self.cam.close()
+
         print('Camera is closed.')
 
     def show_camera_image(self, img_frame):
-        plt.rcParams.update({'font.size': 18})
-        fig, ax = plt.subplots(2, 1, sharey=False, figsize=(10, 12))
-        h = ax[0].imshow(img_frame, cmap='gray')
-        ax[0].axison = False
-        ax[0].set_title('camera image')
-        divider = make_axes_locatable(ax[0])
-        cax = divider.append_axes("right", size="3%", pad=0.05)
-        plt.colorbar(h, cax=cax, label='pixel value')
-
-        img_flatten = img_frame.flatten()
-        ax[1].hist(img_flatten, bins=256, weights=np.ones_like(img_flatten) / len(img_flatten))
-        ax[1].set_ylabel('pixel count')
-        ax[1].xlim = (0, 65535)
-        ax[1].set_title('Histogram of the camera image')
-
-        plt.show()
+        # hand the frame to the live preview and return straight away
+        if self.preview is None:
+            self.preview = LivePreview(max_value=self.max_value(), headless=self.headless,
+                                       name=f'{self.camera_mode} preview')
+        self.preview.update(img_frame)
+
+    def max_value(self):
+        # full-scale pixel value of the frames returned by capture()
+        if self.camera_type in ['pylon', 'synthetic']:
+            bits = int(''.join(c for c in self.pixelformat if c.isdigit()) or 8)      # Mono8, Mono12, ...
+            return 2**bits - 1
+        return self.decoder.max_value
 
 def decode_fourcc(v):
     v = int(v)
@@ -0,0 +1,160 @@
+'''
+
+Cached, diff-only settings for pylon cameras.
+
+Reading and writing GenICam nodes goes over USB/GigE, and changing a parameter that affects the buffer layout needs
+AcquisitionStop / TLParamsLocked = False / AcquisitionStart around it. PylonSettings remembers the last value of
+every node it has read or written, writes only the nodes whose value changes, and stops acquisition only when one of
+them cannot be written while the camera is acquiring (PixelFormat, Width, Height, offsets, binning).
+
+Nodes behind a selector (TriggerMode under TriggerSelector, ChunkEnable under ChunkSelector, ...) hold one value per
+selector entry, so they are cached per entry and compared with the entry the selector points at when they are
+written.
+
+Named profiles are stored with the pylon feature persistence (.pfs files), so a reconnect restores the whole
+configuration in one load instead of writing the nodes one by one:
+    settings.save_profile('scan')
+    settings.load_profile('scan')
+
+'''
+
+import math
+import os
+
+from lazy_import import LazyModule
+
+pylon = LazyModule('pypylon.pylon')
+genicam = LazyModule('pypylon.genicam')
+
+# nodes that change the buffer layout: only writable while acquisition is stopped and the TL params are unlocked
+STOP_NODES = ['PixelFormat', 'Width', 'Height', 'OffsetX', 'OffsetY', 'BinningHorizontal', 'BinningVertical',
+              'BinningHorizontalMode', 'BinningVerticalMode', 'ReverseX', 'ReverseY']
+
+# selector-dependent nodes -> their selector
+SELECTED_BY = {'TriggerMode': 'TriggerSelector', 'TriggerSource': 'TriggerSelector',
+               'TriggerActivation': 'TriggerSelector', 'TriggerDelay': 'TriggerSelector',
+               'ChunkEnable': 'ChunkSelector',
+               'LineMode': 'LineSelector', 'LineSource': 'LineSelector', 'LineInverter': 'LineSelector'}
+SELECTORS = set(SELECTED_BY.values())
+
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'camera_profiles')
+
+
+def _same(a, b):
+    if isinstance(a, float) or isinstance(b, float):
+        try:
+            return math.isclose(float(a), float(b), rel_tol=1e-6, abs_tol=1e-9)
+        except (TypeError, ValueError):
+            return False
+    return a == b
+
+
+class PylonSettings():
+    def __init__(self, cam, profile_dir=PROFILE_DIR):
+        self.cam = cam
+        self.profile_dir = profile_dir
+        self.cache = {}             # key() -> last value read from / written to the camera
+
+    def available(self, name):
+        node = self.cam.GetNodeMap().GetNode(name)
+        return node is not None and genicam.IsAvailable(node)
+
+    def key(self, name, selected=None):
+        # cache key of a node: its name, or (name, selector entry) for a selector-dependent node; the entry is taken
+        # from `selected` (selector -> value about to be written) or else from the camera
+        selector = SELECTED_BY.get(name)
+        if selector is None:
+            return name
+        return name, selected[selector] if selected and selector in selected else self.get(selector)
+
+    def get(self, name):
+        # value of the node, for the entry its selector points at now
+        key = self.key(name)
+        if key not in self.cache:
+            self.cache[key] = getattr(self.cam, name).GetValue()
+        return self.cache[key]
+
+    def diff(self, settings):
+        # The subset of `settings` (node name -> value) that differs from the camera, in the order given. A
+        # selector-dependent node is compared with the entry its selector will point at once the nodes before it
+        # are written; an entry that is neither cached nor selected now cannot be read, so it counts as changed.
+        changed, selected = {}, {}
+        for name, value in settings.items():
+            key = self.key(name, selected)
+            if key not in self.cache and key == self.key(name):
+                self.get(name)
+            if key not in self.cache or not _same(self.cache[key], value):
+                changed[name] = value
+            if name in SELECTORS:
+                selected[name] = value
+        return changed
+
+    def requires_stop(self, changed):
+        for name in changed:
+            if name in STOP_NODES:
+                return True
+            node = getattr(self.cam, name).GetNode()
+            if not genicam.IsWritable(node):
+                return True
+        return False
+
+    def apply(self, settings):
+        # Write the nodes of `settings` whose value changed; return them. Nodes are written in the order given,
+        # so put e.g. OffsetX before Width and TriggerSelector before TriggerMode.
+        changed = self.diff(settings)
+        if not changed:
+            return changed
+
+        if self.requires_stop(changed):
+            if self.cam.IsGrabbing():
+                raise RuntimeError(f'Stop grabbing before changing {list(changed.keys())}.')
+            self.cam.AcquisitionStop.Execute()        # cam stop
+            self.cam.TLParamsLocked = False           # grab unlock
+            try:
+                self._write(changed)
+            finally:
+                self.cam.TLParamsLocked = True        # grab lock
+                self.cam.AcquisitionStart.Execute()   # cam start
+        else:
+            self._write(changed)
+
+        return changed
+
+    def _write(self, changed):
+        for name, value in changed.items():
+            node = getattr(self.cam, name)
+            key = self.key(name)                # a selector written before has already updated the cache
+            try:
+                node.SetValue(value)
+            except Exception:
+                self.cache.pop(key, None)           # unknown state, read it again next time
+                raise
+            self.cache[key] = value
+
+    def describe(self, names):
+        return '; '.join(f'{name}: {self.get(name)}' for name in names)
+
+    ##### Feature persistence profiles #####
+    def profile_path(self, name):
+        return os.path.join(self.profile_dir, f'{name}.pfs')
+
+    def has_profile(self, name):
+        return name is not None and os.path.isfile(self.profile_path(name))
+
+    def save_profile(self, name):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        pylon.FeaturePersistence.Save(self.profile_path(name), self.cam.GetNodeMap())
+        print(f'Camera settings saved to {self.profile_path(name)}')
+
+    def load_profile(self, name):
+        assert not self.cam.IsGrabbing(), 'Stop grabbing before loading a camera profile.'
+        self.cam.AcquisitionStop.Execute()
+        self.cam.TLParamsLocked = False
+        try:
+            pylon.FeaturePersistence.Load(self.profile_path(name), self.cam.GetNodeMap(), True)
+        finally:
+            self.cam.TLParamsLocked = True
+            self.cam.AcquisitionStart.Execute()
+
+        self.cache.clear()          # every node may have changed
+        print(f'Camera settings loaded from {self.profile_path(name)}')
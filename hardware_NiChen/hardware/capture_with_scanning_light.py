@@ -16,10 +16,23 @@ sys.path.append("../hardware")
 
 from camera import *
 from translation_stage import *
+from scan_planner import ScanPlanner, save_order
+from scan_engine import ScanEngine, FileSink, DatasetSink
+from scan_dataset import ScanDataset
+from settle_detector import SettleDetector
 import matplotlib.pyplot as plt
 import os
 
 
+# visit the positions in the order that takes the stages the least time instead of the pattern order; the frames
+# keep the pattern index
+optimize_path = False
+
+# write all frames with their positions and timestamps into one scan dataset file (scan_dataset.py) instead of one
+# TIFF per position
+save_dataset = False
+
+
 plt.rcParams.update({'font.size': 12})
 
 
@@ -53,6 +66,9 @@ Num = Nx*Ny
 ss = KinesisStage('LST150')     # LST150, Z825, Z812
 ss.open(axis_num=2)
 
+# after every move, wait until both axes stay within 0.5 um of the target for 20 ms instead of a fixed sleep
+ss.settle_detector = SettleDetector(tolerance=0.5e-6 / ss.step_in_m, dwell=0.02, timeout=1.0)
+
 # ss.stage_pos = [10031337, -4359278]
 
 
@@ -94,25 +110,49 @@ ax.set_ylabel('y axis (um)')
 ax.set_title('scanning routine')
 plt.show()
 
+order = np.arange(Num)
+if optimize_path:
+    planner = ScanPlanner(*ss.velocity_parameters(), settle=0.05)
+    order = planner.plan(pos, start=ss.stage_pos)
+    print(f'Scan path: {planner.summary()}')
 
 
 ############################################################
 ss.move_to_origin()
 
+# read frames continuously in the background so that a capture never gets a stale frame from the driver queue
+c.start_streaming()
+
+# write the frames in the background, the next move starts while the previous frame is still being written;
+# compression='lzw' or 'deflate' writes lossless compressed TIFFs (smaller files, more CPU per frame)
+c.start_writer(workers=2, max_inflight_mb=1024, compression='none')
+
 cam_name = re.sub(r'\s+', '_', c.camera_mode)
 
-start = time.time()
-for idx in range(Num):
-    file_name = f'{out_dir}/{cam_name}_{idx+1:04}.tiff'
-    print(f'{idx+1:04}/{Num} scanning position:({pos[1,idx]:02}, {pos[0,idx]:02})')
+# the frames go to slot / file name of their position index
+if save_dataset:
+    os.makedirs(out_dir, exist_ok=True)
+    frame = c.grab_frame()
+    ds = ScanDataset.create(f'{out_dir}/scan.ds', Num, frame.shape[0], frame.shape[1], dtype=frame.dtype,
+                            attrs=sys_params)
+    sink = DatasetSink(ds, exposure=c.exposuretime)
+else:
+    sink = FileSink(c, out_dir, name=f'{cam_name}_{{:04}}.tiff')
 
-    ss.move_to(pos[:,idx])
-    time.sleep(0.05)
+# the stage moves to the next position while the frame is handed off and written, the camera is armed while the
+# stage settles (settle=None: until the settle detector sees the stage at rest)
+engine = ScanEngine(ss, c, sink, settle=None, verbose=True)
 
-    c.capture(file_name)
-    time.sleep(0.05)
+start = time.time()
+engine.run(pos, order)
+print(f'Scan engine: {engine.summary()}')
+print(f'Settle detector: {ss.settle_detector.summary()}')
 
 c.close()
+if save_dataset:
+    ds.close()
+c.frame_log.save(f'{out_dir}/frame_log.csv')     # per-frame device timestamp and host times
+save_order(f'{out_dir}/scan_order.csv', order, pos)   # scan step -> position index of the frame
 ss.close()
 
 end = time.time()
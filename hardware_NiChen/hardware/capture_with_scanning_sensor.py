@@ -7,6 +7,25 @@ import os
 
 from ptychography import spiral_pattern, save_config_to_file
 from translation_stage import KinesisStage
+from synthetic import SimulatedStage
+from scan_planner import ScanPlanner, save_order
+from scan_engine import ScanEngine, FileSink, DatasetSink
+from scan_dataset import ScanDataset
+from settle_detector import SettleDetector
+
+# run the scan without hardware: simulated stages and a synthetic camera that images a pattern moved by the stages
+simulate = False
+
+# set the exposure from the first frames (99.9th percentile at 80% of full scale) instead of exposuretime below
+auto_exposure = False
+
+# visit the positions in the order that takes the stages the least time instead of the pattern order; the frames
+# keep the pattern index
+optimize_path = False
+
+# write all frames with their positions and timestamps into one scan dataset file (scan_dataset.py) instead of one
+# TIFF per position
+save_dataset = False
 
 plt.rcParams.update({'font.size': 12})
 
@@ -39,22 +58,28 @@ scanning_step = 6e-6
 Num = Nx*Ny
 
 ############################################################
-ss = KinesisStage('LST150')      # LST150, Z825, Z812
+ss = SimulatedStage('LST150') if simulate else KinesisStage('LST150')      # LST150, Z825, Z812
 ss.open(axis_num=2)
 
+# after every move, wait until both axes stay within 0.1 um of the target for 20 ms instead of a fixed sleep
+ss.settle_detector = SettleDetector(tolerance=0.1e-6 / ss.step_in_m, dwell=0.02, timeout=1.0)
+
 print(ss.stage_pos)
 
 ss.stage_pos = [7666288, 5555843]
 
-# Camera could be pylon or opencv
-c = Camera(camera_type='pylon', brightness=0.0, contrast=0.0, gain=0.0, framerate=30, pixelformat="Mono12",
-           exposuretime=220)     # blue laser, 30mA
+# Camera could be pylon, opencv or synthetic
+c = Camera(camera_type='synthetic' if simulate else 'pylon', brightness=0.0, contrast=0.0, gain=0.0, framerate=30,
+           pixelformat="Mono12", exposuretime=220, headless=simulate,
+           synthetic={'stage': ss, 'drop_rate': 0.01})     # blue laser, 30mA
 
 # c = Camera(camera_type='pylon', brightness=0.0, contrast=0.0, gain=0.0, framerate=30, pixelformat="Mono12",
 #            exposuretime=8500)     # red laser, 70mA
 # c = Camera(camera_type='opencv', brightness=0, contrast=0, gain=12, framerate=20, gamma=120,
 #            exposuretime=1/250)
 c.set_camera()
+if auto_exposure:
+    c.auto_exposure(target=0.8, percentile=99.9)
 
 ############################################################
 # pos = line_pattern(Ny,Nx) * scanning_step / ss.step_in_m
@@ -70,26 +95,52 @@ ax.set_xlabel('x axis (um)')
 ax.set_ylabel('y axis (um)')
 ax.set_title('scanning routine')
 plt.axis('scaled')
-plt.show()
+if not simulate:
+    plt.show()
 
 pos[0, :] += ss.stage_pos[0]
 pos[1, :] += ss.stage_pos[1]
 
+order = np.arange(Num)
+if optimize_path:
+    planner = ScanPlanner(*ss.velocity_parameters(), settle=0.1)
+    order = planner.plan(pos, start=ss.stage_pos)
+    print(f'Scan path: {planner.summary()}')
+
 ############################################################
 ss.move_to_origin()
 
-start = time.time()
-for idx in range(Num):
-    file_name = f'{out_dir}/img{idx+1:04}.tiff'
-    print(f'{idx+1:04}/{Num} scanning position:({pos[1,idx]:02}, {pos[0,idx]:02})')
+# keep the camera grabbing for the whole scan instead of starting/stopping the stream for every frame
+c.start_streaming(buffer_size=8)
+
+# write the frames in the background, the next move starts while the previous frame is still being written;
+# compression='lzw' or 'deflate' writes lossless compressed TIFFs (smaller files, more CPU per frame)
+c.start_writer(workers=2, max_inflight_mb=1024, compression='none')
 
-    ss.move_to(pos[:,idx])
-    time.sleep(0.1)
+# the frames go to slot / file name of their position index
+if save_dataset:
+    os.makedirs(out_dir, exist_ok=True)
+    frame = c.grab_frame()
+    ds = ScanDataset.create(f'{out_dir}/scan.ds', Num, frame.shape[0], frame.shape[1], dtype=frame.dtype,
+                            attrs=sys_params)
+    sink = DatasetSink(ds, exposure=c.exposuretime)
+else:
+    sink = FileSink(c, out_dir, name='img{:04}.tiff')
 
-    c.capture(file_name)
-    # time.sleep(0.05)
+# the stage moves to the next position while the frame is handed off and written, the camera is armed while the
+# stage settles (settle=None: until the settle detector sees the stage at rest)
+engine = ScanEngine(ss, c, sink, settle=None, verbose=True)
+
+start = time.time()
+engine.run(pos, order)
+print(f'Scan engine: {engine.summary()}')
+print(f'Settle detector: {ss.settle_detector.summary()}')
 
 c.close()
+if save_dataset:
+    ds.close()
+c.frame_log.save(f'{out_dir}/frame_log.csv')     # per-frame device timestamp and host times
+save_order(f'{out_dir}/scan_order.csv', order, pos)   # scan step -> position index of the frame
 ss.close()
 
 end = time.time()
@@ -0,0 +1,235 @@
+'''
+
+On-the-fly scanning with position-triggered exposures.
+
+A step scan stops at every position: move, settle, expose. A fly scan moves the fast axis through a whole row at
+constant velocity instead, and the KCube controller emits a trigger pulse every `interval` steps on its trigger
+output. The pulse drives the camera's trigger input (Camera(trigger='Line1') for a Basler camera), so every
+exposure starts at a known position without the stage stopping.
+
+The controller is set up with two APT messages (see Python/KCube/KBD101/kbd101_triggering_serial.py):
+
+  MGMSG_MOT_SET_KCUBETRIGIOCONFIG     trigger port modes: one output in 'position steps' mode
+  MGMSG_MOT_SET_KCUBEPOSTRIGPARAMS    first trigger position, interval and number of pulses, per direction
+
+FlyScan computes these from the pitch and the velocity. It checks that the stage travels less than `max_blur` during
+one exposure, and that the triggers come no faster than the camera can take them. Every row starts a run-up
+distance ahead of the first trigger so that the axis is at full speed when the first pulse fires. It compares the
+row times the trapezoidal velocity profile predicts with the measured ones:
+
+  fly = FlyScan(ss, c, pitch=6e-6 / ss.step_in_m, velocity=0.2e-3 / ss.step_in_m, max_blur=0.5e-6 / ss.step_in_m)
+  fly.run(x_start, x_stop, y_rows, FileSink(c, out_dir))
+  print(fly.summary())
+
+'''
+
+import struct
+import time
+
+import numpy as np
+
+from scan_planner import move_time
+from timing import LatencyStats
+
+# APT message IDs, Thorlabs APT communications protocol
+MGMSG_MOT_SET_KCUBETRIGIOCONFIG = 0x0523
+MGMSG_MOT_SET_KCUBEPOSTRIGPARAMS = 0x0526
+
+# KCube trigger port modes
+trigger_modes = {'disabled': 0x00,
+                 'in_gpi': 0x01, 'in_relative_move': 0x02, 'in_absolute_move': 0x03, 'in_home': 0x04,
+                 'out_gpo': 0x0A, 'out_in_motion': 0x0B, 'out_max_velocity': 0x0C,
+                 'out_position_fwd': 0x0D, 'out_position_rev': 0x0E, 'out_position_both': 0x0F}
+trigger_polarities = {'high': 0x01, 'low': 0x02}
+
+
+############################################# APT messages #############################################################
+def trig_io_config_data(trig1_mode='disabled', trig2_mode='out_position_both', trig1_polarity='high',
+                        trig2_polarity='high', channel=1):
+    # data of MGMSG_MOT_SET_KCUBETRIGIOCONFIG: channel, mode and polarity of both ports, 6 reserved words
+    return struct.pack('<5H12x', channel, trigger_modes[trig1_mode], trigger_polarities[trig1_polarity],
+                       trigger_modes[trig2_mode], trigger_polarities[trig2_polarity])
+
+
+def pos_trig_params_data(start_fwd=0, interval_fwd=0, num_fwd=0, start_rev=0, interval_rev=0, num_rev=0,
+                         pulse_width=100, num_cycles=1, channel=1):
+    # data of MGMSG_MOT_SET_KCUBEPOSTRIGPARAMS: positions and intervals in steps, pulse width in us, 3 reserved longs
+    return struct.pack('<H8i12x', channel, int(start_fwd), int(interval_fwd), int(num_fwd), int(start_rev),
+                       int(interval_rev), int(num_rev), int(pulse_width), int(num_cycles))
+
+
+def apt_message(message_id, data, dest=0x50, source=0x01):
+    # complete message with the 6-byte header, for a raw serial port; pylablib adds the header itself
+    # (KinesisMotor.send_comm_data)
+    return struct.pack('<HHBB', message_id, len(data), dest | 0x80, source) + data
+
+
+############################################# Fly scan #################################################################
+class FlyScan():
+    def __init__(self, stage, camera, pitch, velocity, max_blur, axis=0, acceleration=None, exposure=None,
+                 max_framerate=None, pulse_width=100e-6, margin=0.0, trigger_port=2, move_timeout=60.0):
+        '''
+        stage:         KinesisStage (or SimulatedStage), positions in steps
+        camera:        Camera whose trigger input is wired to the trigger output of the fast axis' controller
+        pitch:         distance between exposures along the fast axis, steps (rounded to whole steps)
+        velocity:      fast axis velocity during a row, steps/s
+        max_blur:      steps the stage may travel during one exposure
+        axis:          index of the fast axis in stage.stages
+        acceleration:  steps/s^2 during a row, default: the axis' acceleration
+        exposure:      s, default: camera.exposuretime (us)
+        max_framerate: highest trigger rate the camera follows, default: the camera's resulting frame rate (pylon)
+                       or its frame rate
+        pulse_width:   s
+        margin:        steps added to the run-up and run-out distances
+        trigger_port:  controller trigger port (1 or 2) wired to the camera
+        '''
+        self.stage = stage
+        self.camera = camera
+        self.axis = axis
+        self.interval = max(int(round(pitch)), 1)
+        self.velocity = velocity
+        self.max_blur = max_blur
+        self.pulse_width = pulse_width
+        self.margin = margin
+        self.trigger_port = trigger_port
+        self.move_timeout = move_timeout
+
+        max_velocity, max_acceleration = stage.velocity_parameters()
+        self.default_velocity = (max_velocity[axis], max_acceleration[axis])     # restored after the scan
+        self.acceleration = max_acceleration[axis] if acceleration is None else acceleration
+        self.exposure = camera.exposuretime * 1e-6 if exposure is None else exposure
+        if max_framerate is None:
+            max_framerate = camera.framerate
+            if camera.camera_type == 'pylon' and camera.settings.available('ResultingFrameRate'):
+                max_framerate = camera.settings.get('ResultingFrameRate')
+            elif camera.camera_type == 'synthetic':
+                max_framerate = camera.cam.framerate
+        self.max_framerate = max_framerate
+
+        # blur and trigger rate do not depend on the row
+        self.blur = velocity * self.exposure
+        self.trigger_period = self.interval / velocity
+        if self.blur > max_blur:
+            raise ValueError(f'An exposure of {1e6*self.exposure:.0f} us at {velocity:.0f} steps/s blurs '
+                             f'{self.blur:.1f} steps, more than max_blur={max_blur:.1f}: lower the velocity to '
+                             f'{max_blur / self.exposure:.0f} steps/s or the exposure to '
+                             f'{1e6 * max_blur / velocity:.0f} us')
+        if self.trigger_period * max_framerate < 1:
+            raise ValueError(f'A trigger every {1e3*self.trigger_period:.2f} ms is faster than the camera\'s '
+                             f'{max_framerate:.1f} fps: lower the velocity to {self.interval * max_framerate:.0f} '
+                             f'steps/s or increase the pitch')
+        if pulse_width >= self.trigger_period:
+            raise ValueError(f'Trigger pulse width {1e3*pulse_width:.2f} ms is not shorter than the trigger period '
+                             f'{1e3*self.trigger_period:.2f} ms')
+        if velocity > max_velocity[axis]:
+            raise ValueError(f'Velocity {velocity:.0f} steps/s is above the axis maximum {max_velocity[axis]:.0f}')
+
+        self.row_time = LatencyStats('row')
+        self.rows = []          # expected and measured times of every row
+
+    def plan_row(self, start, stop):
+        # triggers from `start` towards `stop` (steps on the fast axis), every `interval` steps; the last one is the
+        # closest to `stop`, the pitch is rounded to whole steps
+        direction = 1 if stop >= start else -1
+        num = int(round(abs(stop - start) / self.interval)) + 1
+        first = int(round(start))
+        last = first + direction * (num - 1) * self.interval
+        run_up = self.velocity**2 / (2 * self.acceleration) + self.margin      # distance to reach full speed
+        move_from, move_to = first - direction * run_up, last + direction * run_up
+        return {'direction': direction, 'num': num, 'first': first, 'last': last, 'interval': self.interval,
+                'move_from': move_from, 'move_to': move_to,
+                'expected_row_time': float(move_time(move_to - move_from, self.velocity, self.acceleration)),
+                'expected_trigger_span': (num - 1) * self.trigger_period}
+
+    def trigger_positions(self, row):
+        return row['first'] + row['direction'] * self.interval * np.arange(row['num'])
+
+    def setup_triggers(self, row):
+        # one output in 'position steps' mode (both directions, so that zigzag rows need no reconfiguration), the
+        # other one off; the triggers of `row` in its direction
+        motor = self.stage.stages[self.axis]
+        modes = ['disabled', 'out_position_both'] if self.trigger_port == 2 else ['out_position_both', 'disabled']
+        motor.send_comm_data(MGMSG_MOT_SET_KCUBETRIGIOCONFIG, trig_io_config_data(*modes))
+        triggers = [row['first'], row['interval'], row['num']]
+        fwd, rev = (triggers, [0, 0, 0]) if row['direction'] > 0 else ([0, 0, 0], triggers)
+        motor.send_comm_data(MGMSG_MOT_SET_KCUBEPOSTRIGPARAMS,
+                             pos_trig_params_data(*fwd, *rev, pulse_width=round(self.pulse_width * 1e6)))
+
+    def run_row(self, start, stop, sink, slow=None, slow_axis=1, index_offset=0):
+        # One row: to the run-up position (and the slow axis to `slow`) at the normal velocity, then through the row
+        # at the fly velocity while the camera takes one frame per trigger. sink(index, frame, meta) as for
+        # ScanEngine; it has to keep up with the trigger rate.
+        row = self.plan_row(start, stop)
+        motor = self.stage.stages[self.axis]
+
+        pos = [stage.get_position() for stage in self.stage.stages]
+        pos[self.axis] = row['move_from']
+        if slow is not None:
+            pos[slow_axis] = slow
+        motor.setup_velocity(max_velocity=self.default_velocity[0], acceleration=self.default_velocity[1])
+        self.stage.move_to(pos)
+        if getattr(self.stage, 'settle_detector', None) is not None:
+            self.stage.wait_settled(pos)
+        self.setup_triggers(row)
+        motor.setup_velocity(max_velocity=self.velocity, acceleration=self.acceleration)
+        self.camera.arm()
+
+        t_start = time.perf_counter()
+        motor.move_to(row['move_to'])
+        positions = self.trigger_positions(row)
+        arrivals, timestamps = [], []
+        try:
+            for k in range(row['num']):
+                frame = self.camera.grab_frame(after=t_start)
+                info = getattr(self.camera, 'last_info', None) or {'arrival': time.perf_counter(),
+                                                                   'device_timestamp': None}
+                arrivals.append(info['arrival'])
+                timestamps.append(info['device_timestamp'])
+                commanded = list(pos)
+                commanded[self.axis] = positions[k]
+                sink(index_offset + k, frame, {'commanded': np.array(commanded), 'settled': t_start,
+                                               'arrival': info['arrival'], 'device_timestamp': info['device_timestamp'],
+                                               'returned': time.perf_counter()})
+        except TimeoutError as e:
+            motor.stop()
+            raise RuntimeError(f'Fly scan row from {row["first"]} to {row["last"]}: {len(arrivals)} of {row["num"]} '
+                               f'frames received, the camera missed a trigger or the trigger is not wired') from e
+        motor.wait_move(timeout=self.move_timeout)
+        row_time = time.perf_counter() - t_start
+
+        # the device timestamps are the exposure starts, i.e. the triggers; the arrival times if there are none
+        times = timestamps if None not in timestamps else arrivals
+        self.row_time.add(row_time)
+        self.rows.append({'frames': row['num'], 'expected_row_time': row['expected_row_time'], 'row_time': row_time,
+                          'expected_trigger_span': row['expected_trigger_span'],
+                          'trigger_span': times[-1] - times[0]})
+        return row
+
+    def run(self, start, stop, slow_positions, sink, slow_axis=1, zigzag=True):
+        # rows from `start` to `stop` on the fast axis, one per slow axis position; every other row runs backwards
+        # if `zigzag`. Frames are numbered row by row in scan order.
+        index = 0
+        try:
+            for k, slow in enumerate(slow_positions):
+                a, b = (stop, start) if zigzag and k % 2 else (start, stop)
+                row = self.run_row(a, b, sink, slow=slow, slow_axis=slow_axis, index_offset=index)
+                index += row['num']
+            if hasattr(sink, 'close'):
+                sink.close()
+        finally:
+            self.stage.stages[self.axis].setup_velocity(max_velocity=self.default_velocity[0],
+                                                        acceleration=self.default_velocity[1])
+
+    def summary(self):
+        if not self.rows:
+            return 'no rows'
+        expected = np.array([row['expected_row_time'] for row in self.rows])
+        actual = np.array([row['row_time'] for row in self.rows])
+        span_expected = np.array([row['expected_trigger_span'] for row in self.rows])
+        span = np.array([row['trigger_span'] for row in self.rows])
+        return f'{len(self.rows)} rows, {sum(row["frames"] for row in self.rows)} frames, ' \
+               f'pitch {self.interval} steps, trigger every {1e3*self.trigger_period:.2f} ms, ' \
+               f'blur {self.blur:.1f} of {self.max_blur:.1f} steps\n' \
+               f'  row time: expected {1e3*expected.mean():.1f} ms, actual {1e3*actual.mean():.1f} ms ' \
+               f'(max {1e3*actual.max():.1f} ms)\n' \
+               f'  first to last trigger: expected {1e3*span_expected.mean():.1f} ms, actual {1e3*span.mean():.1f} ms'
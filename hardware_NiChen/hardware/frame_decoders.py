@@ -0,0 +1,146 @@
+'''
+
+Raw frame decoders, keyed by camera model and FOURCC.
+
+A decoder turns the raw buffer delivered by a backend into the uint16 frame that is saved, in one pass and into
+an output buffer that is reused from frame to frame. Copy the result if it has to outlive the next frame.
+
+Adding a camera model only needs a registry entry:
+    register_decoder('My camera', 'Y16', Y16Decoder)
+
+'''
+
+import numpy as np
+import cv2
+
+
+class Decoder():
+    bytes_per_pixel = 1
+    max_value = 65535       # full-scale value of the decoded frame
+
+    def __init__(self):
+        self.out = None
+        self.gray = None        # 8-bit intermediate of the color decoders
+
+    def buffer(self, shape, dtype=np.uint16):
+        if self.out is None or self.out.shape != shape or self.out.dtype != dtype:
+            self.out = np.empty(shape, dtype=dtype)
+        return self.out
+
+    def raw_shape(self, width, height):
+        # shape of the raw buffer a backend delivers for a width x height frame
+        if self.bytes_per_pixel <= 2:
+            return height, width * self.bytes_per_pixel
+        return height, width, self.bytes_per_pixel
+
+    def __call__(self, raw, width, height):
+        raise NotImplementedError
+
+
+class Y16Decoder(Decoder):
+    # undecoded Y16 stream (8UC1, 2 bytes per pixel, big endian): the byte swap is done by the dtype conversion
+    bytes_per_pixel = 2
+
+    def __call__(self, raw, width, height):
+        out = self.buffer((height, width))
+        np.copyto(out, np.ascontiguousarray(raw).view('>u2').reshape(height, width))
+        return out
+
+
+class TisY16Decoder(Decoder):
+    # tisgrabber Y16 sink buffer: little endian, stored bottom-up, the sensor bits MSB-aligned (the low bits are 0)
+    bytes_per_pixel = 2
+    bit_depth = 12
+
+    @property
+    def max_value(self):
+        return 0xFFFF & ~((1 << (16 - self.bit_depth)) - 1)
+
+    def __call__(self, raw, width, height):
+        out = self.buffer((height, width))
+        np.copyto(out, np.ascontiguousarray(raw).view('<u2').reshape(height, width)[::-1])
+        return out
+
+
+class Y8Decoder(Decoder):
+    # 8-bit mono, scaled to the 16-bit range; the undecoded stream (CAP_PROP_FORMAT=-1) is a 1 x N Mat
+    scale = 256
+
+    @property
+    def max_value(self):
+        return 255 * self.scale
+
+    def __call__(self, raw, width, height):
+        out = self.buffer((height, width))
+        np.multiply(np.ascontiguousarray(raw).reshape(height, width), self.scale, out=out, dtype=np.uint16)
+        return out
+
+
+class See3CAMDecoder(Y8Decoder):
+    scale = 255
+
+
+class BGRDecoder(Decoder):
+    # 8-bit BGR (converted by OpenCV), to 16-bit gray
+    bytes_per_pixel = 3
+    max_value = 255 << 8
+
+    def __call__(self, raw, width, height):
+        self.gray = cv2.cvtColor(raw, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        out = self.buffer(self.gray.shape)
+        np.left_shift(self.gray, 8, out=out, dtype=np.uint16)
+        return out
+
+
+class RGBFlipDecoder(Decoder):
+    # tisgrabber RGB24/RGB32 sink buffer, stored bottom-up, to 16-bit gray in the orientation of the scan
+    bytes_per_pixel = 3
+    max_value = 255 << 8
+
+    def __call__(self, raw, width, height):
+        if self.gray is None or self.gray.shape != raw.shape[:2]:
+            self.gray = np.empty(raw.shape[:2], dtype=np.uint8)
+        return rgb_to_gray16(raw, self.buffer(raw.shape[:2]), self.gray)
+
+
+def rgb_to_gray16(image, out=None, gray=None):
+    '''
+    Convert an 8-bit RGB(A) frame to a 16-bit gray frame in the orientation of the scan.
+
+    cv2.flip(image, 1) followed by imutils.rotate(image, 180) is a vertical flip, so the orientation is only a
+    strided view that is folded into the 8 -> 16 bit conversion. `out` and `gray` can be preallocated buffers.
+    '''
+    code = cv2.COLOR_RGB2GRAY if image.shape[2] == 3 else cv2.COLOR_RGBA2GRAY
+    gray = cv2.cvtColor(image, code, dst=gray)
+    if out is None:
+        out = np.empty(gray.shape, dtype=np.uint16)
+
+    np.left_shift(gray[::-1], 8, out=out, dtype=np.uint16)     # *256
+    return out
+
+
+############################################# Registry #################################################################
+# (camera model, FOURCC) -> decoder class; a camera model of None is the default for that FOURCC
+decoders = {
+    (None, 'Y16'): Y16Decoder,
+    (None, 'Y8'): Y8Decoder,
+    (None, 'GREY'): Y8Decoder,
+    ('See3CAM_CU135M_H03R1', 'Y16'): See3CAMDecoder,
+    ('HD USB Camera', 'Y16'): BGRDecoder,
+    ('DFM 37UX226-ML', 'RGB64'): RGBFlipDecoder,
+    ('DFM 37UX226-ML', 'Y16'): TisY16Decoder,
+}
+
+
+def register_decoder(camera_mode, fourcc, decoder):
+    decoders[(camera_mode, fourcc.strip())] = decoder
+
+
+def get_decoder(camera_mode, fourcc):
+    # a new decoder instance, so that every camera owns its output buffers
+    fourcc = fourcc.strip()
+    for key in [(camera_mode, fourcc), (None, fourcc)]:
+        if key in decoders:
+            return decoders[key]()
+
+    raise ValueError(f'No decoder for camera mode {camera_mode} with FOURCC {fourcc}')
@@ -0,0 +1,135 @@
+'''
+
+Asynchronous frame writer.
+
+Camera.capture() hands the frame to a bounded queue and returns; a thread pool encodes and writes the TIFF/PNG
+files in the background, so the stage can move on while the previous frame is still being written.
+
+  - backpressure: submit() blocks while more than `max_inflight_mb` of frames are waiting to be written
+  - errors:       a failed write is raised by the next submit(), flush() or close() in the scan loop
+  - latency:      per-file write time and submit-to-written latency
+  - compression:  lossless TIFF compression ('lzw' or 'deflate') with the horizontal differencing predictor,
+                  and the zlib level of PNG files; the encoding runs on the writer threads, so more workers keep up
+                  with a faster frame rate. benchmark_acquisition.py compression compares the codecs.
+
+'''
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+from timing import LatencyStats
+
+
+# TIFF compression schemes; all lossless, and read back by cv2.imread like uncompressed files
+tiff_compression = {
+    'none': 1,
+    'lzw': 5,
+    'deflate': 8,           # Adobe deflate, zlib
+}
+
+
+def imwrite_params(file_name, compression='none', png_level=1):
+    if file_name.lower().endswith(('.tif', '.tiff')):
+        if compression not in tiff_compression:
+            raise ValueError(f'TIFF compression {compression} is not supported, use one of {list(tiff_compression)}')
+        params = [cv2.IMWRITE_TIFF_COMPRESSION, tiff_compression[compression]]
+        if compression != 'none' and hasattr(cv2, 'IMWRITE_TIFF_PREDICTOR'):     # OpenCV >= 4.8
+            # neighbouring pixels differ by little, their differences compress far better than the values
+            params += [cv2.IMWRITE_TIFF_PREDICTOR, 2]
+        return params
+    if file_name.lower().endswith('.png'):
+        return [cv2.IMWRITE_PNG_COMPRESSION, png_level]      # 0 (none) .. 9 (smallest, slowest)
+    return []
+
+
+class FrameWriter():
+    def __init__(self, workers=2, max_inflight_mb=512, compression='none', png_level=1):
+        imwrite_params('.tiff', compression)        # fail on an unknown codec now, not on the first frame
+        self.compression = compression
+        self.png_level = png_level
+
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='FrameWriter')
+        self.max_inflight = max_inflight_mb * 2**20
+        self.inflight = 0               # bytes submitted but not written yet
+        self.cond = threading.Condition()
+
+        self.errors = []
+        self.written = 0
+        self.bytes_in = 0               # frame bytes and file bytes written, for the compression ratio
+        self.bytes_out = 0
+        self.write_time = LatencyStats('write')
+        self.latency = LatencyStats('submit to written')
+
+    def submit(self, frame, file_name, on_done=None):
+        # The writer keeps a reference to `frame` until it is written: do not modify it afterwards.
+        # on_done(frame) is called from the worker thread once the frame is no longer needed.
+        self.check()
+
+        n_bytes = frame.nbytes
+        with self.cond:
+            # always let one frame through, even if it is larger than the cap on its own
+            while self.inflight > 0 and self.inflight + n_bytes > self.max_inflight:
+                self.cond.wait()
+            self.inflight += n_bytes
+
+        self.pool.submit(self._write, frame, file_name, n_bytes, time.perf_counter(), on_done)
+
+    def _write(self, frame, file_name, n_bytes, t_submit, on_done):
+        t0 = time.perf_counter()
+        try:
+            if not cv2.imwrite(file_name, frame, imwrite_params(file_name, self.compression, self.png_level)):
+                raise IOError(f'cv2.imwrite could not write {file_name}')
+            file_size = os.path.getsize(file_name)
+            with self.cond:
+                self.written += 1
+                self.bytes_in += n_bytes
+                self.bytes_out += file_size
+        except Exception as e:
+            with self.cond:
+                self.errors.append((file_name, e))
+        finally:
+            t1 = time.perf_counter()
+            self.write_time.add(t1 - t0)
+            self.latency.add(t1 - t_submit)
+
+            try:
+                if on_done is not None:
+                    on_done(frame)
+            except Exception as e:
+                # e.g. a buffer pool refusing the slot; reported by check(), flush() must not wait for it forever
+                with self.cond:
+                    self.errors.append((file_name, e))
+            finally:
+                with self.cond:
+                    self.inflight -= n_bytes
+                    self.cond.notify_all()
+
+    def check(self):
+        with self.cond:
+            if not self.errors:
+                return
+            file_name, error = self.errors.pop(0)
+        raise RuntimeError(f'Writing {file_name} failed: {error}') from error
+
+    def flush(self):
+        with self.cond:
+            while self.inflight > 0:
+                self.cond.wait()
+        self.check()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.pool.shutdown(wait=True)
+            print(f'Frame writer: {self.written} files written, {self.bytes_out / 2**20:.1f} MB, '
+                  f'compression ratio {self.compression_ratio():.2f}. '
+                  f'{self.write_time.summary()}; {self.latency.summary()}')
+
+    def compression_ratio(self):
+        with self.cond:
+            return self.bytes_in / self.bytes_out if self.bytes_out else 1.0
@@ -0,0 +1,100 @@
+'''
+
+Exposure-bracketed HDR frames.
+
+A bracket is a set of frames of the same scene at different exposure times. merge_hdr() combines them into one
+float32 frame in counts per exposure unit, scaled to the longest exposure of the bracket: every pixel averages the
+exposures in which it is not saturated, weighted by the exposure time (the maximum-likelihood estimate for shot
+noise). Pixels that are saturated in every exposure take the value of the shortest one and are flagged in the mask.
+
+HDRMerger runs the merges on a worker thread so the stage can move to the next position meanwhile.
+
+'''
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from timing import LatencyStats
+
+
+def merge_hdr(frames, exposures, max_value=65535, black_level=0, saturation=0.95):
+    '''
+    frames:     frames of one bracket (uint8/uint16 arrays of the same shape)
+    exposures:  their exposure times, in any unit
+    max_value:  full-scale pixel value; pixels at or above saturation * max_value are ignored
+    Returns the float32 HDR frame (counts at the longest exposure) and the mask of pixels saturated everywhere.
+    '''
+    shape = frames[0].shape
+    num = np.zeros(shape, dtype=np.float32)         # sum of the unsaturated signals
+    den = np.zeros(shape, dtype=np.float32)         # sum of their exposure times
+    count = np.zeros(shape, dtype=np.float32) if black_level else None
+    valid = np.empty(shape, dtype=np.uint8)
+
+    # OpenCV's masked accumulate/add run multithreaded, about 3x faster than numpy ufuncs with where=
+    threshold = saturation * max_value
+    for frame, exposure in zip(frames, exposures):
+        cv2.compare(frame, threshold, cv2.CMP_LT, dst=valid)
+        cv2.accumulate(frame, num, mask=valid)
+        cv2.add(den, float(exposure), dst=den, mask=valid)
+        if count is not None:
+            cv2.add(count, 1.0, dst=count, mask=valid)
+    if count is not None:
+        cv2.scaleAdd(count, -float(black_level), num, dst=num)
+
+    longest = max(exposures)
+    hdr = cv2.divide(num, den, scale=float(longest))    # 0 where den == 0
+    saturated = den == 0
+    if saturated.any():
+        shortest = int(np.argmin(exposures))
+        hdr[saturated] = (frames[shortest][saturated] - np.float32(black_level)) * (longest / exposures[shortest])
+    return hdr, saturated
+
+
+class HDRMerger():
+    def __init__(self, max_value=65535, black_level=0, saturation=0.95, max_pending=4):
+        self.max_value = max_value
+        self.black_level = black_level
+        self.saturation = saturation
+
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='HDRMerger')
+        self.pending = threading.BoundedSemaphore(max_pending)     # brackets waiting to be merged
+        self.merge_time = LatencyStats('HDR merge')
+        self.merged = 0
+        self.futures = []
+
+    def submit(self, frames, exposures, out_file_name=None):
+        # Merge on the worker thread; blocks while `max_pending` brackets are queued. The frames must not be
+        # modified afterwards. Returns a Future of (hdr, saturated mask); the HDR frame is also written as a float32
+        # TIFF to `out_file_name` if given.
+        self.pending.acquire()
+        try:
+            future = self.pool.submit(self._merge, frames, exposures, out_file_name)
+        except Exception:
+            self.pending.release()
+            raise
+
+        self.futures = [f for f in self.futures if not f.done() or f.exception() is not None] + [future]
+        return future
+
+    def _merge(self, frames, exposures, out_file_name):
+        try:
+            t0 = time.perf_counter()
+            hdr, saturated = merge_hdr(frames, exposures, self.max_value, self.black_level, self.saturation)
+            if out_file_name is not None and not cv2.imwrite(out_file_name, hdr):
+                raise IOError(f'cv2.imwrite could not write {out_file_name}')
+            self.merge_time.add(time.perf_counter() - t0)
+            self.merged += 1
+            return hdr, saturated
+        finally:
+            self.pending.release()
+
+    def close(self):
+        # waits for the queued merges, raises the first error
+        self.pool.shutdown(wait=True)
+        print(f'HDR merger: {self.merged} brackets merged. {self.merge_time.summary()}')
+        for future in self.futures:
+            future.result()
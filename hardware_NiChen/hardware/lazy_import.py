@@ -0,0 +1,44 @@
+'''
+
+Lazy module imports for the camera SDKs.
+
+Only one camera backend is used per run, so its SDK is imported the first time one of its attributes is used
+instead of when camera.py is imported. This keeps the start-up time of the scan scripts down and lets camera.py be
+imported on machines where the other SDKs are not installed:
+
+    pylon = LazyModule('pypylon.pylon')
+    pylon.TlFactory.GetInstance()           # pypylon is imported here
+
+'''
+
+import importlib
+
+
+class LazyModule():
+    def __init__(self, name, before_import=None):
+        # before_import() is called once, right before the module is imported (e.g. to set a DLL path)
+        self.__dict__['_name'] = name
+        self.__dict__['_before_import'] = before_import
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            if self._before_import is not None:
+                self._before_import()
+            try:
+                module = importlib.import_module(self._name)
+            except ImportError as e:
+                raise ImportError(f'{self._name} could not be imported, it is needed by the selected camera '
+                                  f'backend: {e}') from e
+            self.__dict__['_module'] = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f'<LazyModule {self._name} ({state})>'
@@ -0,0 +1,144 @@
+'''
+
+Non-blocking live preview.
+
+update() is called from the acquisition loop: it only takes a strided, decimated copy of the frame and returns.
+A preview thread computes the histogram of the decimated image with np.bincount, the saturation and clipping
+percentages, and shows the image with its histogram in an OpenCV window. Frames that arrive while the previous one
+is still being drawn replace it, so the preview never slows down the acquisition.
+
+With headless=True nothing is displayed; the statistics are printed every `log_interval` seconds instead, which is
+what an unattended scan needs.
+
+The window is created and redrawn by the preview thread, not by the main thread. The Win32 and GTK backends of
+OpenCV HighGUI allow that as long as one thread owns the window. Cocoa (macOS) only accepts HighGUI calls from the
+main thread, so use headless=True there.
+
+'''
+
+import threading
+import time
+
+import cv2
+import numpy as np
+
+
+def frame_stats(sample, max_value=65535, bins=256):
+    # histogram and exposure statistics of a (subsampled) frame
+    sample = sample.ravel()
+    idx = sample.astype(np.uint32) * bins // (max_value + 1)
+    hist = np.bincount(np.minimum(idx, bins - 1), minlength=bins)
+
+    n = max(sample.size, 1)
+    return {'hist': hist,
+            'mean': float(sample.mean()) if sample.size else 0.0,
+            'max': int(sample.max()) if sample.size else 0,
+            'saturated_%': 100.0 * np.count_nonzero(sample >= max_value) / n,
+            'clipped_%': 100.0 * np.count_nonzero(sample == 0) / n}
+
+
+def histogram_percentile(frame, q, max_value=65535, max_samples=2**18, bins=4096):
+    # q-th percentile of the pixel values and the saturated fraction, from a strided subsample of the frame
+    step = max(1, int(np.sqrt(frame.shape[0] * frame.shape[1] / max_samples)))
+    sample = frame[::step, ::step].ravel()
+
+    bins = min(bins, max_value + 1)
+    idx = sample.astype(np.uint32) * bins // (max_value + 1)
+    hist = np.bincount(np.minimum(idx, bins - 1), minlength=bins)
+    cdf = np.cumsum(hist)
+
+    k = min(int(np.searchsorted(cdf, q / 100 * cdf[-1])), bins - 1)
+    value = (k + 0.5) * (max_value + 1) / bins     # centre of the bin
+    saturated = np.count_nonzero(sample >= max_value) / max(sample.size, 1)
+    return value, saturated
+
+
+class LivePreview():
+    def __init__(self, max_value=65535, max_size=1024, headless=False, log_interval=5.0, name='Camera preview'):
+        self.max_value = max_value          # full-scale pixel value, for the saturation percentage
+        self.max_size = max_size            # longest side of the displayed image
+        self.headless = headless
+        self.log_interval = log_interval    # s
+        self.name = name
+
+        self.stats = None
+        self.frames = 0                     # frames handed to update()
+        self.shown = 0                      # frames the preview thread processed
+
+        self.latest = None
+        self.cond = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='LivePreview', daemon=True)
+        self.thread.start()
+
+    def update(self, frame):
+        # called from the acquisition thread: a decimated copy, so the caller can reuse its buffer straight away
+        step = max(1, -(-max(frame.shape[:2]) // self.max_size))
+        small = frame[::step, ::step].copy()
+        with self.cond:
+            self.latest = small
+            self.frames += 1
+            self.cond.notify()
+
+    def _run(self):
+        t_log = time.perf_counter()
+        while True:
+            # only the hand-over is done under the lock: update() must never wait for HighGUI
+            with self.cond:
+                if self.running and self.latest is None:
+                    self.cond.wait(0.1)
+                if not self.running:
+                    break
+                small, self.latest = self.latest, None
+            if small is None:
+                if not self.headless:
+                    cv2.waitKey(1)              # keep the window responsive
+                continue
+
+            self.stats = frame_stats(small, self.max_value)
+            self.shown += 1
+
+            if self.headless:
+                now = time.perf_counter()
+                if now - t_log >= self.log_interval:
+                    print(f'{self.name}: {self.summary()}')
+                    t_log = now
+            else:
+                cv2.imshow(self.name, self._render(small, self.stats['hist']))
+                cv2.waitKey(1)
+
+        if not self.headless:
+            cv2.destroyWindow(self.name)
+
+    def _render(self, small, hist, hist_height=128):
+        # 8-bit image with the log histogram drawn underneath and the statistics as text
+        shift = max(int(np.ceil(np.log2(self.max_value + 1))) - 8, 0)
+        image = (small >> shift).astype(np.uint8) if small.dtype != np.uint8 else small
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+        width = image.shape[1]
+        panel = np.zeros((hist_height, width, 3), dtype=np.uint8)
+        levels = np.log1p(hist)
+        levels = (hist_height - 1) * (1 - levels / max(levels.max(), 1e-9))
+        points = np.stack([np.linspace(0, width - 1, len(hist)), levels], axis=1).astype(np.int32)
+        cv2.polylines(panel, [points], False, (255, 255, 255), 1)
+
+        text = f'mean {self.stats["mean"]:.0f}  saturated {self.stats["saturated_%"]:.2f}%  ' \
+               f'clipped {self.stats["clipped_%"]:.2f}%'
+        cv2.putText(panel, text, (5, 15), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (0, 255, 255), 1)
+        return np.vstack([image, panel])
+
+    def summary(self):
+        if self.stats is None:
+            return 'no frames'
+        return f'mean={self.stats["mean"]:.1f}, max={self.stats["max"]}, ' \
+               f'saturated={self.stats["saturated_%"]:.3f}%, clipped={self.stats["clipped_%"]:.3f}%, ' \
+               f'frames={self.frames}, shown={self.shown}'
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join(timeout=2.0)
+        print(f'{self.name}: {self.summary()}')
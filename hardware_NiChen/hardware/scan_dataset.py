@@ -0,0 +1,177 @@
+'''
+
+Single-file scan dataset.
+
+All frames of a scan go into one preallocated, memory-mappable file together with the per-frame metadata, instead
+of one TIFF per position plus a config.yaml:
+
+  frames      (N, H, W) uint16
+  commanded   (N, axes) float64    commanded stage position [device units]
+  measured    (N, axes) float64    stage position read back after the move [device units]
+  timestamp   (N,)      float64    [s]
+  exposure    (N,)      float64    exposure time in the camera's units
+  valid       (N,)      uint8      1 once the slot has been written
+
+Layout: 8-byte magic, uint64 header length, JSON header (array offsets, dtypes, shapes and the scan parameters),
+then the arrays, each aligned to 4096 bytes. Writers fill slots in place; readers memory-map any slice without
+decoding anything.
+
+'''
+
+import glob
+import json
+import os
+
+import numpy as np
+
+MAGIC = b'SCANDS01'
+ALIGN = 4096
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _layout(num, height, width, axes, dtype):
+    arrays = {
+        'frames': (np.dtype(dtype).str, (num, height, width)),
+        'commanded': ('<f8', (num, axes)),
+        'measured': ('<f8', (num, axes)),
+        'timestamp': ('<f8', (num,)),
+        'exposure': ('<f8', (num,)),
+        'valid': ('|u1', (num,)),
+    }
+    return {name: {'dtype': dt, 'shape': list(shape)} for name, (dt, shape) in arrays.items()}
+
+
+class ScanDataset():
+    def __init__(self, path, mode='r'):
+        # mode 'r' for reading, 'r+' to fill slots of an existing dataset
+        self.path = path
+        with open(path, 'rb') as f:
+            assert f.read(len(MAGIC)) == MAGIC, f'{path} is not a scan dataset'
+            header_len = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            self.header = json.loads(f.read(header_len).decode('utf-8'))
+
+        self.attrs = self.header['attrs']
+        self.arrays = {}
+        for name, spec in self.header['arrays'].items():
+            self.arrays[name] = np.memmap(path, dtype=np.dtype(spec['dtype']), mode=mode,
+                                          offset=spec['offset'], shape=tuple(spec['shape']))
+
+        self.frames = self.arrays['frames']
+        self.commanded = self.arrays['commanded']
+        self.measured = self.arrays['measured']
+        self.timestamp = self.arrays['timestamp']
+        self.exposure = self.arrays['exposure']
+        self.valid = self.arrays['valid']
+
+    @classmethod
+    def create(cls, path, num, height, width, axes=2, dtype=np.uint16, attrs=None):
+        arrays = _layout(num, height, width, axes, dtype)
+
+        # the header is written once, so reserve room for the offsets before computing them
+        header = {'version': 1, 'attrs': attrs or {}, 'arrays': arrays}
+        for spec in arrays.values():
+            spec['offset'] = 0
+        reserved = _align(len(MAGIC) + 8 + len(json.dumps(header)) + 256)
+
+        offset = reserved
+        for spec in arrays.values():
+            spec['offset'] = offset
+            offset = _align(offset + int(np.prod(spec['shape'])) * np.dtype(spec['dtype']).itemsize)
+
+        header_bytes = json.dumps(header).encode('utf-8')
+        assert len(MAGIC) + 8 + len(header_bytes) <= reserved
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(np.uint64(len(header_bytes)).astype('<u8').tobytes())
+            f.write(header_bytes)
+            f.truncate(offset)          # preallocate, the frames are filled in place
+
+        return cls(path, mode='r+')
+
+    def __len__(self):
+        return self.frames.shape[0]
+
+    def __getitem__(self, idx):
+        return self.frames[idx]
+
+    def write(self, idx, frame, commanded=None, measured=None, timestamp=None, exposure=None):
+        self.frames[idx] = frame
+        if commanded is not None:
+            self.commanded[idx] = commanded
+        if measured is not None:
+            self.measured[idx] = measured
+        if timestamp is not None:
+            self.timestamp[idx] = timestamp
+        if exposure is not None:
+            self.exposure[idx] = exposure
+        self.valid[idx] = 1
+
+    def stack(self, img_size=None, shift=(0, 0)):
+        # (H, W, N) view of the centre crop, in the layout of load_data(); nothing is read until it is used
+        frames = self.frames
+        if img_size is not None:
+            h, w = frames.shape[1:]
+            y0 = (h - img_size) // 2 + shift[0]
+            x0 = (w - img_size) // 2 + shift[1]
+            frames = frames[:, y0:y0 + img_size, x0:x0 + img_size]
+        return frames.transpose(1, 2, 0)
+
+    def flush(self):
+        for array in self.arrays.values():
+            if isinstance(array, np.memmap) and array.mode != 'r':
+                array.flush()
+
+    def close(self):
+        self.flush()
+        for name in list(self.arrays.keys()):
+            self.arrays[name] = None
+        self.frames = self.commanded = self.measured = self.timestamp = self.exposure = self.valid = None
+
+
+############################################# Per-TIFF layout ##########################################################
+def import_tiff_dir(tiff_dir, path, pattern='img*.tiff', positions=None, attrs=None):
+    # Pack a directory of per-position TIFFs (sorted by name) into one dataset; positions is an optional (axes, N)
+    # array. The attrs come from config.yaml in the directory (export_tiff_dir) or in its parent (the scan scripts
+    # write the frames to <out_dir>/raw/), updated with `attrs`.
+    import cv2
+
+    files = sorted(glob.glob(os.path.join(tiff_dir, pattern)))
+    assert len(files) > 0, f'No files matching {pattern} in {tiff_dir}'
+
+    config = {}
+    for config_file in [os.path.join(tiff_dir, 'config.yaml'), os.path.join(tiff_dir, os.pardir, 'config.yaml')]:
+        if os.path.exists(config_file):
+            import yaml
+            with open(config_file) as f:
+                config = yaml.safe_load(f) or {}
+            break
+    attrs = {**config, **(attrs or {})}
+
+    first = cv2.imread(files[0], cv2.IMREAD_UNCHANGED)
+    axes = 2 if positions is None else positions.shape[0]
+    ds = ScanDataset.create(path, len(files), first.shape[0], first.shape[1], axes=axes, dtype=first.dtype,
+                            attrs=attrs)
+    for idx, file_name in enumerate(files):
+        frame = first if idx == 0 else cv2.imread(file_name, cv2.IMREAD_UNCHANGED)
+        ds.write(idx, frame, commanded=None if positions is None else positions[:, idx])
+
+    ds.flush()
+    return ds
+
+
+def export_tiff_dir(ds, out_dir, name='img{:04}.tiff'):
+    # write the dataset back to one TIFF per position (1-based names, as in the scan scripts) plus config.yaml
+    import cv2
+
+    os.makedirs(out_dir, exist_ok=True)
+    for idx in range(len(ds)):
+        cv2.imwrite(os.path.join(out_dir, name.format(idx + 1)), np.asarray(ds.frames[idx]),
+                    [cv2.IMWRITE_TIFF_COMPRESSION, 1])
+
+    if ds.attrs:
+        import yaml
+        with open(os.path.join(out_dir, 'config.yaml'), 'w') as f:
+            yaml.safe_dump(ds.attrs, f)
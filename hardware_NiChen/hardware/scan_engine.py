@@ -0,0 +1,279 @@
+'''
+
+Pipelined scan engine.
+
+The scan scripts used to run every step serially: move, sleep, capture, write. ScanEngine runs the stages of a
+step on their own threads, connected by bounded queues:
+
+  motion  (calling thread)  wait until frame i-1 is exposed, move to point i, settle (a fixed wait, or until the
+                            stage's settle detector sees it at rest)
+  camera  (ScanCamera)      arm while the stage moves and settles, grab the first frame exposed after the settle;
+                            the stage is released when the exposure ends (software trigger) or the frame
+                            arrives
+  sink    (ScanSink)        hand the frame to the output: files, a ScanDataset, or any callable
+
+So the stage already travels to point i+1 while frame i is copied and written, and the camera waits for the
+trigger or the next stream frame while the stage settles. Every stage keeps its own LatencyStats.
+
+The engine only needs stage.move_to(pos) and camera.grab_frame(after, on_exposed) (camera.arm() if it has one), so
+it runs unchanged on SimulatedStage and the synthetic camera:
+
+  engine = ScanEngine(ss, c, FileSink(c, out_dir), settle=0.1)
+  engine.run(pos, order)
+  print(engine.summary())
+
+'''
+
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from timing import LatencyStats
+
+
+############################################# Sinks ####################################################################
+class FileSink():
+    # One file per position, named by the (1-based) position index and written through camera.save_frame, i.e. by
+    # the camera's background writer if it was started. The frame also goes to the camera's live preview and
+    # frame log, as with Camera.capture(). Pool frames go to the writer as they are and back to the pool once written.
+    releases_frames = True
+
+    def __init__(self, camera, out_dir, name='img{:04}.tiff'):
+        self.camera = camera
+        self.out_dir = out_dir
+        self.name = name
+        os.makedirs(out_dir, exist_ok=True)
+
+    def __call__(self, index, frame, meta):
+        file_name = os.path.join(self.out_dir, self.name.format(index + 1))
+        record = None
+        if getattr(self.camera, 'frame_log', None) is not None:
+            record = self.camera.frame_log.new(file_name, meta['settled'])
+            record.arrival, record.device_timestamp = meta['arrival'], meta['device_timestamp']
+            record.decoded = meta['returned']
+        if getattr(self.camera, 'preview', None) is not None:
+            self.camera.preview.update(frame)
+        self.camera.save_frame(frame, file_name, copy=False, record=record, release=meta.get('release'))
+        if record is not None:
+            record.returned = time.perf_counter()
+
+    def close(self):
+        if getattr(self.camera, 'writer', None) is not None:
+            self.camera.writer.flush()
+
+
+class DatasetSink():
+    # frames and metadata into the slots of a ScanDataset (scan_dataset.py); a pool frame is copied into the dataset
+    # and given back straight away
+    releases_frames = True
+
+    def __init__(self, ds, exposure=None):
+        self.ds = ds
+        self.exposure = exposure
+
+    def __call__(self, index, frame, meta):
+        try:
+            self.ds.write(index, frame, commanded=meta['commanded'], measured=meta.get('measured'),
+                          timestamp=meta['arrival'], exposure=self.exposure)
+        finally:
+            if meta.get('release') is not None:
+                meta['release']()
+
+    def close(self):
+        self.ds.flush()
+
+
+############################################# Engine ###################################################################
+class ScanEngine():
+    def __init__(self, stage, camera, sink, settle=0.05, queue_size=4, verbose=False):
+        '''
+        stage:      move_to(pos) that returns once the stage is there (KinesisStage, SimulatedStage)
+        camera:     grab_frame(after, on_exposed) returning a frame the caller owns and calling on_exposed() once the
+                    exposure is over, and optionally arm() (Camera)
+        sink:       sink(index, frame, meta), and optionally close(); meta holds the commanded position, the
+                    position read back after the settle (if the stage has `stages`, KinesisStage), the settle
+                    time, the frame's arrival time and device timestamp, and when the grab returned. A sink with
+                    releases_frames = True gets the camera's pool frames without a copy (grab_frame(keep_slot=True))
+                    and must call meta['release']() once it is done with the frame, if that is not None
+        settle:     s to wait after a move before the exposure may start, or None to wait until
+                    stage.wait_settled(pos) returns (KinesisStage with a SettleDetector)
+        queue_size: frames waiting for the sink before the camera (and then the stage) waits
+        verbose:    print every position as the stage moves there
+        '''
+        self.stage = stage
+        self.camera = camera
+        self.sink = sink
+        self.settle = settle
+        self.queue_size = queue_size
+        self.verbose = verbose
+
+        self.stats = {name: LatencyStats(name) for name in
+                      ['wait for camera', 'move', 'settle', 'read position', 'arm', 'wait for frame',
+                       'exposed to frame', 'hand off', 'sink', 'step']}
+        self.steps = 0
+        self.errors = []
+
+    def run(self, positions, order=None):
+        # Visit positions[:, order[k]] for k = 0, 1, ...; frames are passed to the sink with the position index.
+        positions = np.asarray(positions)
+        order = np.arange(positions.shape[1]) if order is None else np.asarray(order)
+        settled = queue.Queue(maxsize=1)                    # motion -> camera: (index, settle time, position)
+        frames = queue.Queue(maxsize=self.queue_size)       # camera -> sink
+        exposed = threading.Semaphore(1)                    # camera -> motion: the stage may move again
+        self.stop = threading.Event()
+        self.errors = []
+
+        threads = [threading.Thread(target=self._camera_loop, args=(settled, frames, exposed), name='ScanCamera'),
+                   threading.Thread(target=self._sink_loop, args=(frames,), name='ScanSink')]
+        for thread in threads:
+            thread.start()
+
+        t_start = time.perf_counter()
+        try:
+            t_last = None
+            for k, index in enumerate(order.tolist()):
+                if self.verbose:
+                    print(f'{k+1:04}/{len(order)} scanning position {index+1:04}: {positions[:, index]}')
+                t0 = time.perf_counter()
+                while not exposed.acquire(timeout=0.1):
+                    if self.stop.is_set():
+                        break
+                if self.stop.is_set():
+                    break
+                t1 = time.perf_counter()
+                self.stage.move_to(positions[:, index])
+                t2 = time.perf_counter()
+                if self.settle is None:
+                    self.stage.wait_settled(positions[:, index])
+                else:
+                    time.sleep(self.settle)
+                t3 = time.perf_counter()
+                measured = self._read_position()
+                self._put(settled, (index, t3, positions[:, index], measured))
+
+                self.stats['wait for camera'].add(t1 - t0)
+                self.stats['move'].add(t2 - t1)
+                self.stats['settle'].add(t3 - t2)
+                self.stats['read position'].add(time.perf_counter() - t3)
+                if t_last is not None:
+                    self.stats['step'].add(t3 - t_last)
+                t_last = t3
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._put(settled, None, force=True)
+            for thread in threads:
+                thread.join()
+            self.elapsed = time.perf_counter() - t_start
+
+        if self.errors:
+            name, error = self.errors[0]
+            raise RuntimeError(f'Scan failed in the {name} stage: {error}') from error
+
+    def _camera_loop(self, settled, frames, exposed):
+        try:
+            arm = getattr(self.camera, 'arm', None)
+            keep_slot = getattr(self.sink, 'releases_frames', False)
+            while True:
+                if arm is not None:
+                    t0 = time.perf_counter()
+                    arm()                                   # while the stage moves and settles
+                    self.stats['arm'].add(time.perf_counter() - t0)
+
+                item = settled.get()
+                if item is None:
+                    break
+                index, t_settled, position, measured = item
+
+                released = []
+
+                def release():
+                    # the exposure is over: the stage can move on while the frame is read out and handed off
+                    if not released:
+                        released.append(time.perf_counter())
+                        exposed.release()
+
+                t0 = time.perf_counter()
+                if keep_slot:
+                    frame = self.camera.grab_frame(after=t_settled, on_exposed=release, keep_slot=True)
+                else:
+                    frame = self.camera.grab_frame(after=t_settled, on_exposed=release)
+                t1 = time.perf_counter()
+                release()
+                self.stats['exposed to frame'].add(t1 - released[0])
+                info = getattr(self.camera, 'last_info', None) or {'arrival': t1, 'device_timestamp': None}
+                meta = {'commanded': position, 'measured': measured, 'settled': t_settled, 'arrival': info['arrival'],
+                        'device_timestamp': info['device_timestamp'], 'returned': t1,
+                        'release': info.get('release') if keep_slot else None}
+                self._put(frames, (index, frame, meta))
+                self.stats['wait for frame'].add(t1 - t0)
+                self.stats['hand off'].add(time.perf_counter() - t1)
+        except Exception as e:
+            self._fail(e, 'camera')
+            exposed.release()
+        finally:
+            self._put(frames, None, force=True)
+
+    def _read_position(self):
+        # every axis in device units (steps for KinesisStage), or None if the stage cannot be read back
+        stages = getattr(self.stage, 'stages', None)
+        if not stages:
+            return None
+        return np.array([float(axis.get_position()) for axis in stages])
+
+    def _sink_loop(self, frames):
+        try:
+            while True:
+                item = frames.get()
+                if item is None:
+                    break
+                if self.stop.is_set():
+                    self._discard(item)                     # drain the queue after an error
+                    continue
+                t0 = time.perf_counter()
+                self.sink(*item)
+                self.stats['sink'].add(time.perf_counter() - t0)
+                self.steps += 1
+
+            if hasattr(self.sink, 'close') and not self.stop.is_set():
+                self.sink.close()
+        except Exception as e:
+            self._fail(e, 'sink')
+            while True:                                     # keep the camera from blocking on a full queue
+                item = frames.get()
+                if item is None:
+                    break
+                self._discard(item)
+
+    def _discard(self, item):
+        # a frame that never reaches the sink goes back to the camera's pool
+        release = item[2].get('release')
+        if release is not None:
+            release()
+
+    def _put(self, q, item, force=False):
+        # put that gives up once the scan is stopped, unless `force` (the end-of-scan marker)
+        while True:
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if self.stop.is_set() and not force:
+                    return
+                if self.stop.is_set():
+                    try:
+                        q.get_nowait()                      # make room for the marker
+                    except queue.Empty:
+                        pass
+
+    def _fail(self, error, name='motion'):
+        self.errors.append((name, error))
+        self.stop.set()
+
+    def summary(self):
+        lines = [f'{self.steps} positions in {self.elapsed:.2f} s']
+        lines += [f'  {stats.summary()}' for stats in self.stats.values() if len(stats)]
+        return '\n'.join(lines)
@@ -0,0 +1,220 @@
+'''
+
+Scan path planner.
+
+The scan scripts build the positions from a spiral/zigzag/line pattern and add a random offset to every position,
+which can make the pattern order a poor visiting order. ScanPlanner reorders an arbitrary (2, N) position array to
+minimise the time the stages spend moving and settling:
+
+  - cost:   the time of a move is the longest of the axis moves (the axes travel together, see
+            KinesisStage.move_axes), each a trapezoidal velocity profile with the axis velocity and acceleration,
+            plus the settle time; not the Euclidean distance
+  - start:  nearest neighbour from the start position, on a grid of cells so that a step only looks at the points
+            around the current one
+  - refine: 2-opt on the open path, vectorised over all segment reversals of up to `window` points per pass
+
+plan() returns the permutation `order`: scan step k visits logical position order[k]. Save it with the data
+(save_order) and name the frames by the logical index, so the reconstruction sees the pattern order.
+
+  planner = ScanPlanner(velocity=2e-3 / ss.step_in_m, acceleration=10e-3 / ss.step_in_m, settle=0.05)
+  order = planner.plan(pos, start=ss.stage_pos)
+  pos = pos[:, order]
+
+'''
+
+import math
+import time
+
+import numpy as np
+
+
+def move_time(distance, velocity, acceleration):
+    # time of a trapezoidal (or triangular, if full speed is not reached) velocity profile, elementwise
+    distance = np.abs(distance)
+    d_acc = velocity**2 / acceleration      # distance to accelerate to full speed and to stop again
+    return np.where(distance < d_acc, 2 * np.sqrt(distance / acceleration),
+                    distance / velocity + velocity / acceleration)
+
+
+class ScanPlanner():
+    def __init__(self, velocity, acceleration, settle=0.0, window=32, time_limit=1.0):
+        '''
+        velocity, acceleration: per axis (or one value for all axes), in position units per s and per s^2
+        settle:     time added to every move, s
+        window:     longest segment (in points) that a 2-opt move reverses
+        time_limit: stop refining after this many seconds
+        '''
+        self.velocity = np.atleast_1d(np.asarray(velocity, dtype=float))
+        self.acceleration = np.atleast_1d(np.asarray(acceleration, dtype=float))
+        self.settle = settle
+        self.window = window
+        self.time_limit = time_limit
+        self.stats = {}
+
+    def move_times(self, a, b):
+        # time to move from positions a to positions b, both (axes, M)
+        return self._move_times(np.asarray(b, dtype=float) - np.asarray(a, dtype=float))
+
+    def _move_times(self, d):
+        # the axes move together: the longest axis move, plus the settle time if anything moves
+        velocity = np.broadcast_to(self.velocity, len(d))
+        acceleration = np.broadcast_to(self.acceleration, len(d))
+        t = move_time(d[0], velocity[0], acceleration[0])
+        for axis in range(1, len(d)):
+            np.maximum(t, move_time(d[axis], velocity[axis], acceleration[axis]), out=t)
+        return t + self.settle * (t > 0)
+
+    def path_time(self, pos, order=None, start=None):
+        # time to visit pos[:, order] in turn, from `start` (default: the first point)
+        pos = np.asarray(pos, dtype=float)
+        if order is not None:
+            pos = pos[:, order]
+        if start is not None:
+            pos = np.concatenate([np.asarray(start, dtype=float).reshape(-1, 1), pos], axis=1)
+        return float(self.move_times(pos[:, :-1], pos[:, 1:]).sum())
+
+    def plan(self, pos, start=None):
+        # permutation of the N points that shortens the path from `start` (default: the first point of pos)
+        pos = np.asarray(pos, dtype=float)
+        assert pos.ndim == 2 and pos.shape[0] == 2, 'positions must be a (2, N) array'
+        n = pos.shape[1]
+        fixed_start = start is None
+        start = pos[:, 0] if start is None else np.asarray(start, dtype=float).reshape(2)
+
+        t0 = time.perf_counter()
+        if fixed_start:     # the first point stays first
+            order = np.concatenate([[0], 1 + self._nearest_neighbour(pos[:, 1:], start)]) if n > 1 else np.arange(n)
+        else:
+            order = self._nearest_neighbour(pos, start)
+        t1 = time.perf_counter()
+        order, passes = self._two_opt(pos, order, start, fixed_first=fixed_start, deadline=t0 + self.time_limit)
+        t2 = time.perf_counter()
+
+        # never worse than the pattern order
+        before = self.path_time(pos, start=None if fixed_start else start)
+        after = self.path_time(pos, order, start=None if fixed_start else start)
+        if after > before:
+            order, after = np.arange(n), before
+
+        self.stats = {'points': n, 'time_before': before, 'time_after': after, 'nearest_neighbour_s': t1 - t0,
+                      'two_opt_s': t2 - t1, 'two_opt_passes': passes}
+        return order
+
+    def summary(self):
+        s = self.stats
+        return f'{s["points"]} points, path time {s["time_before"]:.1f} s -> {s["time_after"]:.1f} s ' \
+               f'(nearest neighbour {1e3*s["nearest_neighbour_s"]:.0f} ms, ' \
+               f'2-opt {1e3*s["two_opt_s"]:.0f} ms in {s["two_opt_passes"]} passes)'
+
+    def _nearest_neighbour(self, pos, start):
+        # Greedy path from `start`. The points are binned on a grid in units of cruise time (distance / velocity),
+        # about one point per cell; a step searches rings of cells around the current point, and the whole
+        # remaining set only if the rings near it are empty. The per-step work is on a handful of candidates, so it
+        # is plain Python: numpy calls would cost more than the arithmetic.
+        n = pos.shape[1]
+        scaled = pos / self.velocity[:, None]
+        lo = scaled.min(axis=1)
+        extent = np.maximum(scaled.max(axis=1) - lo, 1e-12)
+        h = max(np.sqrt(extent[0] * extent[1] / n), extent.max() / n, 1e-12)
+        nx, ny = (extent // h).astype(int) + 1
+        cell_x = np.minimum(((scaled[0] - lo[0]) // h).astype(int), nx - 1).tolist()
+        cell_y = np.minimum(((scaled[1] - lo[1]) // h).astype(int), ny - 1).tolist()
+
+        cells = [[] for _ in range(nx * ny)]
+        for idx, (cx, cy) in enumerate(zip(cell_x, cell_y)):
+            cells[cx * ny + cy].append(idx)
+
+        max_ring = 4
+        rings = [[(0, 0)]] + [[(dx, dy) for dx in range(-r, r + 1) for dy in range(-r, r + 1)
+                               if max(abs(dx), abs(dy)) == r] for r in range(1, max_ring + 1)]
+
+        (vx, vy), (ax, ay) = self.velocity[:2].repeat(2 // len(self.velocity)), \
+            self.acceleration[:2].repeat(2 // len(self.acceleration))
+        dx_acc, dy_acc = vx * vx / ax, vy * vy / ay
+        xs, ys = pos[0].tolist(), pos[1].tolist()
+
+        def cost(dx, dy):
+            dx, dy = abs(dx), abs(dy)
+            tx = 2 * math.sqrt(dx / ax) if dx < dx_acc else dx / vx + vx / ax
+            ty = 2 * math.sqrt(dy / ay) if dy < dy_acc else dy / vy + vy / ay
+            return tx if tx > ty else ty
+
+        visited = np.zeros(n, dtype=bool)
+        order = []
+        x, y = float(start[0]), float(start[1])
+        cx, cy = [int(v) for v in np.clip((np.array([x, y]) / self.velocity[:2] - lo) // h, 0, [nx - 1, ny - 1])]
+        for _ in range(n):
+            candidates, found_ring, ring = [], None, 0
+            while ring <= max_ring and (found_ring is None or ring <= found_ring + 1):
+                for dx, dy in rings[ring]:
+                    if 0 <= cx + dx < nx and 0 <= cy + dy < ny:
+                        candidates += cells[(cx + dx) * ny + cy + dy]
+                if candidates and found_ring is None:
+                    found_ring = ring
+                ring += 1
+
+            if candidates:
+                best = min(candidates, key=lambda idx: cost(xs[idx] - x, ys[idx] - y))
+            else:
+                remaining = np.flatnonzero(~visited)
+                best = int(remaining[np.argmin(self.move_times(np.array([[x], [y]]), pos[:, remaining]))])
+            cx, cy = cell_x[best], cell_y[best]
+            cells[cx * ny + cy].remove(best)
+            visited[best] = True
+            order.append(best)
+            x, y = xs[best], ys[best]
+        return np.array(order, dtype=int)
+
+    def _two_opt(self, pos, order, start, fixed_first=False, deadline=None):
+        # Route: start, the points, and an end node that costs nothing to reach, so the path can end anywhere.
+        # Reversing route[i+1:j+1] replaces the edges (i, i+1) and (j, j+1) by (i, j) and (i+1, j+1); a pass
+        # evaluates every i with 2 <= j - i <= window at once and applies the best improvements that do not overlap.
+        n = pos.shape[1]
+        points = np.concatenate([pos, np.reshape(start, (2, 1)), np.zeros((2, 1))], axis=1)
+        route = np.concatenate([[n], order, [n + 1]])
+        length = len(route)
+        first = 1 if fixed_first else 0    # the start is route[0]; with fixed_first, route[1] stays as well
+
+        def cost(a, b):
+            # take() on each axis is several times faster than points[:, a]
+            t = self._move_times([axis.take(b) - axis.take(a) for axis in points])
+            t[(a == n + 1) | (b == n + 1)] = 0.0
+            return t
+
+        i = np.arange(first, length - 1)[None, :]
+        j = i + np.arange(2, self.window + 1)[:, None]
+        valid = j <= length - 2
+        i, j = np.broadcast_to(i, j.shape)[valid], j[valid]
+        if len(i) == 0:
+            return route[1:-1], 0
+
+        passes, t_pass = 0, 0.0
+        while deadline is None or time.perf_counter() + t_pass < deadline:
+            t0 = time.perf_counter()
+            passes += 1
+            edges = cost(route[:-1], route[1:])                 # edge e: route[e] -> route[e + 1]
+            gain = edges[i] + edges[j] - cost(route[i], route[j]) - cost(route[i + 1], route[j + 1])
+            improving = np.flatnonzero(gain > 1e-9)
+            if len(improving) == 0:
+                break
+
+            used = np.zeros(length, dtype=bool)
+            for idx in improving[np.argsort(-gain[improving])].tolist():
+                a, b = i[idx], j[idx]
+                if used[a:b + 1].any():
+                    continue
+                used[a:b + 1] = True
+                route[a + 1:b + 1] = route[a + 1:b + 1][::-1]
+            t_pass = time.perf_counter() - t0
+
+        return route[1:-1], passes
+
+
+def save_order(file_name, order, pos=None):
+    # one CSV row per scan step: logical index of the position it visits (and the position)
+    import csv
+    with open(file_name, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['scan_index', 'logical_index'] + ([] if pos is None else ['x', 'y']))
+        for k, idx in enumerate(np.asarray(order).tolist()):
+            writer.writerow([k, idx] + ([] if pos is None else list(np.asarray(pos)[:, idx])))
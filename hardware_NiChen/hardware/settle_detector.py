@@ -0,0 +1,92 @@
+'''
+
+Position-based settle detection.
+
+The scan scripts used to sleep a fixed time after every move. That is too long when the stage is already still,
+and too short when it is still ringing. SettleDetector polls the position of every axis instead, at about 1 kHz or
+as fast as the controller answers. An axis has settled once its position has stayed within `tolerance` of the
+target for `dwell` seconds. The Kinesis DC servo controllers report the encoder count as the position, so this
+watches the encoder.
+Tolerance and dwell can be set per axis, in the axis' position units (steps for KinesisStage); one timeout bounds
+the whole wait.
+
+  ss = KinesisStage('LST150', settle_detector=SettleDetector(tolerance=40, dwell=0.01))     # 40 steps ~ 0.1 um
+  ss.move_to(p)
+  ss.wait_settled(p)      # or ScanEngine(..., settle=None)
+  print(ss.settle_detector.summary())
+
+'''
+
+import time
+
+import numpy as np
+
+from timing import LatencyStats
+
+
+class SettleDetector():
+    def __init__(self, tolerance, dwell=0.01, timeout=2.0, poll_interval=1e-3):
+        '''
+        tolerance:     half width of the window around the target, per axis or one value for all axes
+        dwell:         s the position has to stay in the window, per axis or one value
+        timeout:       s after which wait() raises a TimeoutError
+        poll_interval: s between polls of all axes; 0 polls as fast as the controller answers, but then holds the
+                       GIL from the camera and writer threads unless get_position() waits on the device
+        '''
+        self.tolerance = np.atleast_1d(np.asarray(tolerance, dtype=float))
+        self.dwell = np.atleast_1d(np.asarray(dwell, dtype=float))
+        assert np.all(self.tolerance > 0) and np.all(self.dwell >= 0), 'tolerance must be > 0 and dwell >= 0'
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+        self.settle_time = []                   # LatencyStats per axis: until the axis entered the window for good
+        self.wait_time = LatencyStats('settle wait')    # time spent in wait(), including the dwell
+        self.polls = 0
+        self.timeouts = 0
+
+    def wait(self, axes, targets=None):
+        # Blocks until every axis has settled, returns the time spent. axes: objects with get_position() (pylablib
+        # KinesisMotor, SimulatedMotor). Without targets, an axis has settled when it stays within the tolerance of
+        # where it was when it entered the window.
+        n = len(axes)
+        tolerance = np.broadcast_to(self.tolerance, n).tolist()
+        dwell = np.broadcast_to(self.dwell, n).tolist()
+        while len(self.settle_time) < n:
+            self.settle_time.append(LatencyStats(f'axis {len(self.settle_time)} settle'))
+
+        reference = None if targets is None else [float(p) for p in targets]
+        window = [None] * n                     # reference position and time the axis entered the window
+        deviation = [None] * n
+        pending = list(range(n))
+        t0 = time.perf_counter()
+        deadline = t0 + self.timeout
+        while pending:
+            for idx in list(pending):
+                position = float(axes[idx].get_position())
+                t = time.perf_counter()
+                self.polls += 1
+                if window[idx] is None:
+                    window[idx] = (position if reference is None else reference[idx], t)
+                deviation[idx] = position - window[idx][0]
+                if abs(deviation[idx]) > tolerance[idx]:
+                    window[idx] = None
+                elif t - window[idx][1] >= dwell[idx]:
+                    self.settle_time[idx].add(window[idx][1] - t0)
+                    pending.remove(idx)
+
+            if pending and time.perf_counter() > deadline:
+                self.timeouts += 1
+                state = ', '.join(f'axis {idx} {deviation[idx]:+.3g} (tolerance {tolerance[idx]:.3g})'
+                                  for idx in pending)
+                raise TimeoutError(f'Stage not settled within {self.timeout} s: {state}')
+            if pending and self.poll_interval > 0:
+                time.sleep(self.poll_interval)
+
+        elapsed = time.perf_counter() - t0
+        self.wait_time.add(elapsed)
+        return elapsed
+
+    def summary(self):
+        lines = [f'{len(self.wait_time)} settles, {self.timeouts} timeouts, {self.polls} polls']
+        lines += [f'  {stats.summary()}' for stats in self.settle_time + [self.wait_time] if len(stats)]
+        return '\n'.join(lines)
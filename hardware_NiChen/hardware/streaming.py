@@ -0,0 +1,173 @@
+'''
+
+Continuous frame streaming for the camera backends.
+
+Instead of starting and stopping the stream around every image, a reader thread keeps the camera grabbing for
+the whole scan and pushes every frame into a bounded FrameRing. Camera.capture() then only takes the next frame
+out of the ring.
+
+  - dropped: frames overwritten in the ring before anybody took them, plus frames skipped by the driver
+  - stale:   frames discarded by a capture because they were exposed before the capture was requested
+
+'''
+
+import threading
+import time
+from collections import deque
+
+
+class FrameRing():
+    def __init__(self, size=8, on_discard=None):
+        # on_discard(frame) is called for every frame that is dropped or stale, e.g. to return it to a BufferPool
+        assert size >= 1, 'ring size should be at least 1'
+        self.size = size
+        self.on_discard = on_discard
+        self.frames = deque()       # (seq, timestamp, frame, info), oldest first
+        self.cond = threading.Condition()
+        self.closed = False
+
+        self.seq = 0                # sequence number of the last frame pushed
+        self.delivered = 0
+        self.dropped = 0
+        self.stale = 0
+
+    def push(self, frame, timestamp=None, skipped=0, info=None):
+        # info: per-frame metadata handed back by next_frame(), e.g. the arrival time and the device timestamp
+        if timestamp is None:
+            timestamp = time.perf_counter()
+
+        with self.cond:
+            self.seq += 1
+            self.dropped += skipped
+            if len(self.frames) == self.size:
+                self._discard(self.frames.popleft())
+                self.dropped += 1
+            self.frames.append((self.seq, timestamp, frame, info))
+            self.cond.notify_all()
+
+    def next_frame(self, after=None, timeout=2.0, after_seq=None):
+        # Return (seq, timestamp, frame, info) of the oldest frame taken after `after` (time.perf_counter() clock)
+        # and pushed after the frame `after_seq` (a seq returned before, or the ring's seq before a trigger).
+        deadline = time.perf_counter() + timeout
+        with self.cond:
+            while True:
+                while self.frames:
+                    seq, timestamp, frame, info = self.frames.popleft()
+                    if (after is not None and timestamp < after) or (after_seq is not None and seq <= after_seq):
+                        self.stale += 1
+                        self._discard((seq, timestamp, frame, info))
+                        continue
+                    self.delivered += 1
+                    return seq, timestamp, frame, info
+
+                remaining = deadline - time.perf_counter()
+                if self.closed or remaining <= 0:
+                    raise TimeoutError(f'No frame received in {timeout} seconds.')
+                self.cond.wait(remaining)
+
+    def _discard(self, item):
+        if self.on_discard is not None:
+            self.on_discard(item[2])
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {'received': self.seq, 'delivered': self.delivered, 'dropped': self.dropped,
+                    'stale': self.stale, 'queued': len(self.frames)}
+
+
+class StreamReader():
+    '''
+    Drain a camera on a background thread.
+
+    `read()` should block for at most a short timeout and return (frame, skipped) or None when nothing arrived, or
+    (frame, skipped, device_timestamp) if the camera stamps its frames.
+    `latency` (s) is the longest time from the exposure start to the arrival, i.e. the exposure plus readout and
+    transfer. It is subtracted from the arrival time, so the ring timestamp is never later than the exposure start
+    and a frame exposed before a capture request is not taken for a fresh one.
+    With `device_clock` the device timestamps (s) are mapped to the host clock instead: the offset is the smallest
+    arrival - latency - device timestamp of the last `clock_window` frames, so a frame that was delayed in transfer
+    is still stamped with its exposure start.
+    Change the latency with set_latency(): frames exposed before a change still arrive up to the old latency later,
+    so until then the larger of the old and the new latency is used.
+    A stall is counted every time no frame arrives for longer than `stall_timeout` (s).
+    '''
+    def __init__(self, read, ring, latency=0.0, device_clock=False, clock_window=64, stall_timeout=1.0,
+                 name='StreamReader'):
+        self.read = read
+        self.ring = ring
+        self.latency = latency
+        self.previous_latency = (0.0, 0.0)                  # (latency, until when it may still apply)
+        self.device_clock = device_clock
+        self.clock_offsets = deque(maxlen=clock_window)     # a window, so that a drift of the clocks is followed
+        self.stall_timeout = stall_timeout
+        self.stalls = 0
+        self.error = None
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        last_arrival = time.perf_counter()
+        stalled = False
+        while not self._stop.is_set():
+            try:
+                item = self.read()
+            except Exception as e:
+                self.error = e
+                break
+
+            now = time.perf_counter()
+            if item is None:
+                if not stalled and now - last_arrival > self.stall_timeout:
+                    self.stalls += 1
+                    stalled = True
+                continue
+
+            if not stalled and now - last_arrival > self.stall_timeout:
+                self.stalls += 1
+            last_arrival, stalled = now, False
+
+            frame, skipped = item[:2]
+            device_timestamp = item[2] if len(item) > 2 else None
+            latency, (previous, until) = self.latency, self.previous_latency
+            timestamp = now - (max(latency, previous) if now < until else latency)
+            if self.device_clock and device_timestamp is not None:
+                self.clock_offsets.append(timestamp - device_timestamp)
+                timestamp = device_timestamp + min(self.clock_offsets)
+            self.ring.push(frame, timestamp, skipped, {'arrival': now, 'device_timestamp': device_timestamp})
+
+        self.ring.close()
+
+    def set_latency(self, latency):
+        now = time.perf_counter()
+        previous, until = self.previous_latency
+        previous = max(self.latency, previous) if now < until else self.latency
+        self.previous_latency = (previous, now + previous)
+        self.latency = latency
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        self._thread.join(timeout)
+        self.ring.close()
+
+    def next_frame(self, after=None, timeout=2.0, after_seq=None):
+        try:
+            return self.ring.next_frame(after, timeout, after_seq)
+        except TimeoutError:
+            if self.error is not None:
+                raise RuntimeError(f'Stream reader stopped: {self.error}') from self.error
+            raise
+
+    def stats(self):
+        stats = self.ring.stats()
+        stats['stalls'] = self.stalls
+        return stats
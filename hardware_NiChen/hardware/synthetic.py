@@ -0,0 +1,389 @@
+'''
+
+Synthetic camera and simulated stages, to run and profile the acquisition pipeline without hardware.
+
+SyntheticCamera is the device behind Camera(camera_type='synthetic'). It free-runs at `framerate` and delivers
+each frame `readout_latency` seconds after its exposure ends. Frames are deterministic: a periodic test pattern
+plus noise, both seeded, so the same scan gives the same frames. If a simulated stage is attached, the pattern is
+shifted by the stage position at the start of the exposure, like a sample moved under the sensor. `drop_rate` drops
+frames at random (seeded), which the stream reports as skipped. With `trigger` set to a SimulatedMotor, the camera
+exposes on the motor's position trigger pulses instead (fly_scan.py) and misses pulses that come faster than
+`framerate`.
+With trigger='software' every exposure starts at execute_trigger(), as Camera(trigger='software') on a pylon camera.
+
+SimulatedStage is a KinesisStage whose motors follow a trapezoidal velocity profile in real time, optionally
+followed by a damped oscillation around the target (`ringing`), so the scan scripts run unchanged:
+
+    ss = SimulatedStage('LST150')
+    ss.open(axis_num=2)
+    c = Camera(camera_type='synthetic', synthetic={'stage': ss, 'drop_rate': 0.01})
+
+'''
+
+import struct
+import threading
+import time
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from translation_stage import KinesisStage
+
+# as returned by pylablib's KinesisMotor.get_velocity_parameters()
+TVelocityParams = namedtuple('TVelocityParams', ['min_velocity', 'acceleration', 'max_velocity'])
+
+
+class SyntheticCamera():
+    def __init__(self, width=1920, height=1200, bit_depth=12, framerate=30, exposure=4000, readout_latency=0.005,
+                 drop_rate=0.0, stage=None, pixel_size=2e-6, period=256, noise=0.01, seed=0,
+                 reference_exposure=4000, trigger=None):
+        # exposure in us, as the pylon ExposureTime; pixel_size in m, to convert the stage position to pixels.
+        # The signal is proportional to the exposure, the pattern spans 10 - 70 % of full scale at reference_exposure.
+        # trigger: SimulatedMotor whose trigger output drives the camera's trigger input, 'software' to expose on
+        # execute_trigger(), or None to free-run.
+        self.sensor_width, self.sensor_height = width, height
+        self.roi = (0, 0, width, height)
+        self.bit_depth = bit_depth
+        self.dtype = np.dtype(np.uint8 if bit_depth <= 8 else np.uint16)     # as pylon unpacks Mono8 / Mono12
+        self.framerate = framerate
+        self._exposure = exposure
+        self.reference_exposure = reference_exposure
+        self.readout_latency = readout_latency
+        self.drop_rate = drop_rate
+        self.stage = stage
+        self.trigger = trigger
+        self.pixel_size = pixel_size
+        self.period = period
+
+        rng = np.random.default_rng(seed)
+        max_value = 2**bit_depth - 1
+
+        # smooth periodic texture with a coarse grid on top, in 10 - 70 % of the full scale
+        texture = np.tile(rng.random((period, period)).astype(np.float32), (3, 3))      # blurred periodically
+        texture = cv2.GaussianBlur(texture, (0, 0), 3)[period:2 * period, period:2 * period]
+        texture = (texture - texture.min()) / max(texture.max() - texture.min(), 1e-9)
+        texture[::period // 8, :] = 1.0
+        texture[:, ::period // 8] = 1.0
+        self.tile = max_value * (0.1 + 0.6 * texture)
+
+        # bank of noise frames, cycled by frame index
+        sigma = noise * max_value
+        self.noise = [np.clip(rng.normal(2 * sigma, sigma, (height, width)), 0, 4 * sigma).astype(self.dtype)
+                      for _ in range(8)]
+        self.drop_rng = np.random.default_rng(seed + 1)
+
+        self.pattern = None
+        self.out = None
+        self.set_roi(self.roi)
+
+        self.t0 = time.perf_counter()
+        self.next_index = 0
+        self.dropped = 0
+        self.last_timestamp = None
+        self.last_pulse = self.last_exposure = -np.inf
+        self.missed_triggers = 0
+        self.software_triggers = []             # time.perf_counter() of the execute_trigger() calls
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def set_roi(self, roi):
+        # (x, y, width, height) read out by the sensor
+        x, y, w, h = roi
+        assert x + w <= self.sensor_width and y + h <= self.sensor_height, f'ROI {roi} is outside of the sensor'
+        self.roi = roi
+        self.out = np.empty((h, w), dtype=self.dtype)
+        self._update_pattern()
+
+    def _update_pattern(self):
+        # the pattern at the current exposure, tiled to cover the ROI at any shift
+        x, y, w, h = self.roi
+        tile = np.clip(self.tile * self._exposure / self.reference_exposure, 0, 2**self.bit_depth - 1)
+        reps = (-(-(h + self.period) // self.period), -(-(w + self.period) // self.period))
+        self.pattern = np.tile(tile.astype(self.dtype), reps)
+
+    @property
+    def exposure(self):
+        return self._exposure
+
+    @exposure.setter
+    def exposure(self, exposure):
+        self._exposure = exposure
+        self._update_pattern()
+
+    @property
+    def width(self):
+        return self.roi[2]
+
+    @property
+    def height(self):
+        return self.roi[3]
+
+    def frame_time(self, index):
+        # end of the exposure of frame `index` [time.perf_counter()]
+        return self.t0 + index / self.framerate + self.exposure * 1e-6
+
+    def render(self, index, exposure_start):
+        # frame `index` into the reused output buffer, with the stage where it was at `exposure_start`
+        # [time.perf_counter()], not where it is once the frame has been read out
+        shift_x, shift_y = 0, 0
+        if self.stage is not None:
+            pos = [int(round(p / self.pixel_size)) for p in self.stage.position_in_m(exposure_start)]
+            shift_x, shift_y = (pos + [0, 0])[:2]
+
+        x, y, w, h = self.roi
+        y0, x0 = (y + shift_y) % self.period, (x + shift_x) % self.period
+        noise = self.noise[index % len(self.noise)][y:y + h, x:x + w]
+        cv2.add(self.pattern[y0:y0 + h, x0:x0 + w], noise, dst=self.out)          # saturates at the dtype's max
+        if self.bit_depth not in (8, 16):
+            np.minimum(self.out, 2**self.bit_depth - 1, out=self.out)
+        return self.out
+
+    def read(self):
+        # Next frame of the free-running stream as (frame, skipped, device timestamp), once it has been read out.
+        # A consumer that falls behind gets the newest frame and the number of frames it missed, like a driver with
+        # one buffer. The device timestamp is the exposure start in seconds since the camera started.
+        if self.trigger is not None:
+            return self._read_triggered()
+
+        with self.lock:
+            if self.closed:
+                return None
+
+            now = time.perf_counter()
+            newest = int(np.floor((now - self.readout_latency - self.t0 - self.exposure * 1e-6) * self.framerate))
+            index = max(self.next_index, newest)
+            skipped = index - self.next_index
+
+            # injected drops: the frame is lost in transfer and the next one is delivered instead
+            while self.drop_rate > 0 and self.drop_rng.random() < self.drop_rate:
+                index += 1
+                skipped += 1
+            self.dropped += skipped
+            self.next_index = index + 1
+
+        delay = self.frame_time(index) + self.readout_latency - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        self.last_timestamp = index / self.framerate
+        return self.render(index, self.t0 + self.last_timestamp), skipped, self.last_timestamp
+
+    def _read_triggered(self):
+        # the frame of the next trigger pulse, or None if there is none within 50 ms; a pulse less than a frame period
+        # after the previous exposure is missed, as by an overtriggered camera
+        with self.lock:
+            if self.closed:
+                return None
+
+            now = time.perf_counter()
+            pulse = None
+            pulses = self.software_triggers if self.trigger == 'software' else self.trigger.trigger_times
+            for t in pulses:
+                if t <= self.last_pulse:
+                    continue
+                if t > now + 0.05:
+                    break
+                self.last_pulse = t
+                if t < self.last_exposure + 1 / self.framerate:
+                    self.missed_triggers += 1
+                    continue
+                pulse = self.last_exposure = t
+                index = self.next_index
+                self.next_index += 1
+                break
+
+        if pulse is None:
+            time.sleep(0.005)
+            return None
+        delay = pulse + self.exposure * 1e-6 + self.readout_latency - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        self.last_timestamp = pulse - self.t0
+        return self.render(index, pulse), 0, self.last_timestamp
+
+    def execute_trigger(self):
+        # Software trigger: waits until the camera is ready for it, as pylon's WaitForFrameTriggerReady, i.e. one
+        # frame period after the previous trigger. Returns the exposure start [time.perf_counter()].
+        with self.lock:
+            ready = self.software_triggers[-1] + 1 / self.framerate if self.software_triggers else -np.inf
+        delay = ready - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        with self.lock:
+            t = time.perf_counter()
+            self.software_triggers = [p for p in self.software_triggers if p > self.last_pulse] + [t]
+        return t
+
+    def wait_triggered(self, timeout=2.0):
+        # the next triggered frame as (frame, skipped, device timestamp)
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            result = self._read_triggered()
+            if result is not None:
+                return result
+        raise TimeoutError(f'No trigger received in {timeout} seconds.')
+
+    def snap(self):
+        # one frame, as a per-frame grab: the next exposure that starts after the request
+        if self.trigger == 'software':
+            self.execute_trigger()
+        if self.trigger is not None:
+            return self.wait_triggered()[0]
+
+        with self.lock:
+            now = time.perf_counter()
+            self.next_index = max(self.next_index, int(np.ceil((now - self.t0) * self.framerate)))
+        frame, _, _ = self.read()
+        return frame
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+
+
+############################################# Simulated stage ##########################################################
+class SimulatedMotor():
+    # The subset of pylablib's KinesisMotor used by KinesisStage; positions in steps, moves in real time.
+    def __init__(self, position=0, velocity=1e5, acceleration=5e5, ringing=None):
+        self.velocity = velocity            # steps/s
+        self.acceleration = acceleration    # steps/s^2
+        self.ringing = ringing              # (amplitude in steps, frequency in Hz, decay time in s) after each move
+        self.start = self.target = position
+        self.t_start = time.perf_counter()
+        self.duration = 0.0
+
+        # KCube triggers, as set by MGMSG_MOT_SET_KCUBETRIGIOCONFIG and MGMSG_MOT_SET_KCUBEPOSTRIGPARAMS
+        self.trig_io = (0, 1, 0, 1)                 # mode and polarity of both ports
+        self.trig_pos = (0, 0, 0, 0, 0, 0, 100, 1)  # start, interval and number forwards and in reverse, width, cycles
+        self.trigger_times = []                     # time.perf_counter() of the position trigger pulses of this move
+
+    def move_time(self, distance):
+        # trapezoidal (or triangular) velocity profile
+        distance = abs(distance)
+        t_acc = self.velocity / self.acceleration
+        if distance < self.velocity * t_acc:
+            return 2 * np.sqrt(distance / self.acceleration)
+        return distance / self.velocity + t_acc
+
+    def move_to(self, position):
+        self.start = self.get_position()
+        self.target = position
+        self.t_start = time.perf_counter()
+        self.duration = self.move_time(position - self.start)
+        self.trigger_times = self._trigger_times()
+
+    def _trigger_times(self):
+        # pulses of the ports in 'position steps' mode (0x0D forwards, 0x0E in reverse, 0x0F both) during this move
+        distance = self.target - self.start
+        forward = distance > 0
+        if distance == 0 or not set(self.trig_io[0::2]) & {0x0D if forward else 0x0E, 0x0F}:
+            return []
+        start, interval, num = self.trig_pos[0:3] if forward else self.trig_pos[3:6]
+        positions = start + np.arange(num) * interval * (1 if forward else -1)
+        positions = positions[(positions >= min(self.start, self.target)) & (positions <= max(self.start, self.target))]
+
+        # invert the velocity profile of get_position()
+        done, total = np.abs(positions - self.start), abs(distance)
+        t_acc = min(self.velocity / self.acceleration, self.duration / 2)
+        d_acc = 0.5 * self.acceleration * t_acc**2
+        t = np.where(done <= d_acc, np.sqrt(2 * done / self.acceleration),
+                     np.where(done <= total - d_acc, t_acc + (done - d_acc) / (self.acceleration * t_acc),
+                              self.duration - np.sqrt(np.maximum(2 * (total - done) / self.acceleration, 0))))
+        return (self.t_start + t).tolist()
+
+    def send_comm_data(self, message_id, data):
+        # the KCube trigger messages (fly_scan.py), other messages are ignored
+        if message_id == 0x0523:
+            self.trig_io = struct.unpack('<4H', data[2:10])
+        elif message_id == 0x0526:
+            self.trig_pos = struct.unpack('<8i', data[2:34])
+
+    def setup_velocity(self, min_velocity=None, acceleration=None, max_velocity=None, **kwargs):
+        if acceleration is not None:
+            self.acceleration = acceleration
+        if max_velocity is not None:
+            self.velocity = max_velocity
+
+    def get_position(self, t=None):
+        # position now, or at time.perf_counter() `t` (before the current move: its start position)
+        t = (time.perf_counter() if t is None else t) - self.t_start
+        if t < 0:
+            return self.start
+        if t >= self.duration:
+            # a damped oscillation around the target once the profile is done, which wait_move() does not wait for
+            if self.ringing is None or self.duration == 0:
+                return self.target
+            amplitude, frequency, decay = self.ringing
+            t -= self.duration
+            return self.target + amplitude * np.exp(-t / decay) * np.sin(2 * np.pi * frequency * t)
+
+        distance = self.target - self.start
+        total = abs(distance)
+        t_acc = min(self.velocity / self.acceleration, self.duration / 2)
+        v_max = self.acceleration * t_acc
+        if t < t_acc:
+            done = 0.5 * self.acceleration * t**2
+        elif t < self.duration - t_acc:
+            done = 0.5 * v_max * t_acc + v_max * (t - t_acc)
+        else:
+            done = total - 0.5 * self.acceleration * (self.duration - t)**2
+        return self.start + np.sign(distance) * done
+
+    def is_moving(self):
+        return time.perf_counter() - self.t_start < self.duration
+
+    def wait_move(self, timeout=None):
+        remaining = self.t_start + self.duration - time.perf_counter()
+        if timeout is not None and remaining > timeout:
+            time.sleep(timeout)
+            raise TimeoutError(f'Move not finished within {timeout} s')
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def stop(self):
+        position = self.get_position()
+        self.start = self.target = position
+        self.duration = 0.0
+        now = time.perf_counter()
+        self.trigger_times = [t for t in self.trigger_times if t <= now]
+
+    def setup_jog(self, **kwargs):
+        pass
+
+    def setup_gen_move(self, **kwargs):
+        pass
+
+    def get_scale(self):
+        return 1, 1, 1
+
+    def get_jog_parameters(self):
+        return {}
+
+    def get_velocity_parameters(self):
+        return TVelocityParams(0.0, self.acceleration, self.velocity)
+
+    def close(self):
+        pass
+
+
+class SimulatedStage(KinesisStage):
+    def __init__(self, stage_type='LST150', velocity=2e-3, acceleration=10e-3, ringing=None, settle_detector=None):
+        # velocity in m/s and acceleration in m/s^2 of every axis; ringing: (amplitude in m, frequency in Hz, decay
+        # time in s) of the oscillation after every move
+        super().__init__(stage_type, settle_detector=settle_detector)
+        self.velocity = velocity
+        self.acceleration = acceleration
+        self.ringing = ringing
+
+    def open(self, axis_num=2):
+        ringing = None if self.ringing is None else (self.ringing[0] / self.step_in_m, *self.ringing[1:])
+        for idx in range(axis_num):
+            stage = SimulatedMotor(velocity=self.velocity / self.step_in_m,
+                                   acceleration=self.acceleration / self.step_in_m, ringing=ringing)
+            self.stages.append(stage)
+            self.stage_pos.append(stage.get_position())
+        print(f'{axis_num} simulated stages are open.')
+
+    def position_in_m(self, t=None):
+        # now, or at time.perf_counter() `t`
+        return [stage.get_position(t) * self.step_in_m for stage in self.stages]
@@ -0,0 +1,173 @@
+'''
+
+ScanEngine against the simulated devices (synthetic.py): python -m pytest test_scan_engine.py
+
+'''
+
+import time
+
+import numpy as np
+import pytest
+
+from camera import Camera
+from scan_dataset import ScanDataset
+from scan_engine import DatasetSink, FileSink, ScanEngine
+from synthetic import SimulatedStage, SyntheticCamera
+
+
+class ListSink():
+    # keeps what the engine hands over, with the time it arrived
+    def __init__(self):
+        self.items = []
+        self.closed = False
+
+    def __call__(self, index, frame, meta):
+        self.items.append((index, frame, meta, time.perf_counter()))
+
+    def close(self):
+        self.closed = True
+
+
+class LoggedStage(SimulatedStage):
+    # SimulatedStage that records when every move starts
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.move_times = []
+
+    def move_to(self, pos):
+        self.move_times.append(time.perf_counter())
+        super().move_to(pos)
+
+
+@pytest.fixture
+def devices(request):
+    trigger = getattr(request, 'param', None)
+    ss = LoggedStage('LST150')
+    ss.open(axis_num=2)
+    c = Camera(camera_type='synthetic', headless=True, trigger=trigger, roi=(128, 96), exposuretime=4000,
+               synthetic={'stage': ss, 'readout_latency': 0.02})
+    c.show_camera_image = lambda frame: None
+    c.set_camera()
+    yield ss, c
+    c.close()
+    ss.close()
+
+
+def raster(ss, n, step=2e-6):
+    side = int(np.ceil(np.sqrt(n)))
+    pos = np.stack(np.unravel_index(np.arange(n), (side, side))[::-1]).astype(float)
+    return pos * step / ss.step_in_m + np.array(ss.stage_pos)[:, None]
+
+
+@pytest.mark.parametrize('devices', [None, 'software'], indirect=True)
+def test_every_position_once_in_order(devices):
+    ss, c = devices
+    positions = raster(ss, 9)
+    order = np.arange(9)[::-1]
+    sink = ListSink()
+    engine = ScanEngine(ss, c, sink, settle=0.0)
+    engine.run(positions, order)
+
+    assert [item[0] for item in sink.items] == order.tolist()
+    assert sink.closed and engine.steps == 9
+    for index, frame, meta, _ in sink.items:
+        assert frame.shape == (96, 128)
+        np.testing.assert_array_equal(meta['commanded'], positions[:, index])
+        assert meta['arrival'] >= meta['settled']
+
+
+@pytest.mark.parametrize('devices', [None], indirect=True)
+def test_dataset_records_measured_positions(devices, tmp_path):
+    ss, c = devices
+    positions = raster(ss, 4)
+    ds = ScanDataset.create(str(tmp_path / 'scan.ds'), 4, 96, 128, dtype=np.uint16)
+    ScanEngine(ss, c, DatasetSink(ds, exposure=c.exposuretime), settle=0.0).run(positions)
+
+    # the simulated stage stops exactly at the target (no ringing)
+    np.testing.assert_allclose(ds.measured, positions.T, atol=1)
+    np.testing.assert_array_equal(ds.commanded, positions.T)
+    assert ds.valid.all()
+    ds.close()
+
+
+@pytest.mark.parametrize('devices', [None], indirect=True)
+def test_file_sink_writes_pool_frames_without_copy(devices, tmp_path, monkeypatch):
+    ss, c = devices
+    c.start_streaming()
+    c.start_writer()
+    submitted = []
+    submit = c.writer.submit
+
+    def logged_submit(frame, *args, **kwargs):
+        submitted.append(frame)
+        submit(frame, *args, **kwargs)
+
+    monkeypatch.setattr(c.writer, 'submit', logged_submit)
+    ScanEngine(ss, c, FileSink(c, str(tmp_path)), settle=0.0).run(raster(ss, 4))
+
+    slots = {id(slot) for slot in c.pool.slots}
+    assert len(submitted) == 4 and all(id(frame) in slots for frame in submitted)
+    assert c.pool.stats()['free'] == len(c.pool.slots)      # every slot is back once the files are written
+    assert len(list(tmp_path.glob('img*.tiff'))) == 4
+
+
+@pytest.mark.parametrize('devices', ['software'], indirect=True)
+def test_triggered_stage_moves_during_readout(devices):
+    # with the software trigger the stage is released at the end of the exposure, so the next move starts while
+    # the frame is still being read out (20 ms)
+    ss, c = devices
+    sink = ListSink()
+    engine = ScanEngine(ss, c, sink, settle=0.0)
+    engine.run(raster(ss, 6))
+
+    arrivals = [meta['arrival'] for _, _, meta, _ in sink.items]
+    overlapped = [ss.move_times[k + 1] < arrivals[k] for k in range(len(arrivals) - 1)]
+    assert all(overlapped)
+    assert np.mean(engine.stats['exposed to frame'].samples) > 0.01
+
+
+@pytest.mark.parametrize('devices', [None], indirect=True)
+def test_free_run_stage_waits_for_frame(devices):
+    ss, c = devices
+    sink = ListSink()
+    engine = ScanEngine(ss, c, sink, settle=0.0)
+    engine.run(raster(ss, 4))
+
+    arrivals = [meta['arrival'] for _, _, meta, _ in sink.items]
+    assert all(ss.move_times[k + 1] >= arrivals[k] for k in range(len(arrivals) - 1))
+
+
+@pytest.mark.parametrize('devices', [None], indirect=True)
+def test_sink_error_stops_the_scan(devices):
+    ss, c = devices
+
+    def sink(index, frame, meta):
+        raise IOError('disk full')
+
+    engine = ScanEngine(ss, c, sink, settle=0.0)
+    with pytest.raises(RuntimeError, match='sink stage: disk full'):
+        engine.run(raster(ss, 9))
+    assert len(ss.move_times) < 9
+
+
+def test_software_trigger_waits_for_ready():
+    cam = SyntheticCamera(width=64, height=48, framerate=50, exposure=1000, readout_latency=0.001,
+                          trigger='software')
+    t = [cam.execute_trigger() for _ in range(3)]
+    assert np.all(np.diff(t) >= 1 / 50)
+
+    frame, skipped, timestamp = cam.wait_triggered()
+    assert frame.shape == (48, 64) and skipped == 0
+    assert timestamp == pytest.approx(t[0] - cam.t0)
+    assert cam.wait_triggered()[2] == pytest.approx(t[1] - cam.t0)
+
+
+def test_synthetic_frames_match_pool_dtype():
+    for pixelformat, dtype in [('Mono8', np.uint8), ('Mono12', np.uint16)]:
+        c = Camera(camera_type='synthetic', headless=True, pixelformat=pixelformat, roi=(64, 48))
+        c.show_camera_image = lambda frame: None
+        c.set_camera()
+        c.start_streaming()
+        frame = c.grab_frame()
+        assert frame.dtype == dtype and c.pool.dtype == dtype
+        c.close()
@@ -0,0 +1,124 @@
+'''
+
+Latency bookkeeping for the acquisition pipeline.
+
+LatencyStats collects the samples of one latency. FrameLog keeps a FrameRecord per captured frame (device timestamp
+and host times at request, arrival, hand-off and write) and aggregates them into percentiles per pipeline stage.
+
+'''
+
+import threading
+
+import numpy as np
+
+
+class LatencyStats():
+    def __init__(self, name=''):
+        self.name = name
+        self.samples = []           # seconds
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def percentiles(self, q=(50, 90, 99)):
+        with self.lock:
+            samples = np.array(self.samples)
+        if len(samples) == 0:
+            return {}
+        return {f'p{p}': v for p, v in zip(q, np.percentile(samples, q))}
+
+    def histogram(self, bins=20):
+        with self.lock:
+            samples = np.array(self.samples)
+        return np.histogram(samples, bins=bins)
+
+    def summary(self):
+        with self.lock:
+            samples = np.array(self.samples)
+        if len(samples) == 0:
+            return f'{self.name}: no samples'
+
+        p50, p90, p99 = np.percentile(samples, [50, 90, 99])
+        return f'{self.name}: n={len(samples)}, mean={1e3*samples.mean():.2f} ms, p50={1e3*p50:.2f} ms, ' \
+               f'p90={1e3*p90:.2f} ms, p99={1e3*p99:.2f} ms, max={1e3*samples.max():.2f} ms'
+
+
+############################################# Per-frame records ########################################################
+class FrameRecord():
+    # Host times are time.perf_counter(); the device timestamp is in seconds of the camera clock (None if the
+    # backend has no timestamp).
+    def __init__(self, index, file_name=None, request=None):
+        self.index = index
+        self.file_name = file_name
+        self.device_timestamp = None
+        self.request = request      # capture requested
+        self.arrival = None         # frame received from the camera
+        self.decoded = None         # frame decoded, about to be handed to the writer
+        self.returned = None        # capture returned: the writer accepted the frame (may wait on backpressure)
+        self.written = None         # file written
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+class FrameLog():
+    # (name, from, to) of the pipeline stages whose latencies are aggregated
+    stages = [('wait for frame', 'request', 'arrival'),
+              ('decode', 'arrival', 'decoded'),
+              ('hand off', 'decoded', 'returned'),
+              ('write', 'decoded', 'written'),
+              ('request to written', 'request', 'written')]
+    fields = ['index', 'file_name', 'device_timestamp', 'request', 'arrival', 'decoded', 'returned', 'written']
+
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+    def new(self, file_name=None, request=None):
+        with self.lock:
+            record = FrameRecord(len(self.records), file_name, request)
+            self.records.append(record)
+        return record
+
+    def __len__(self):
+        return len(self.records)
+
+    def stage_stats(self):
+        stats = {}
+        with self.lock:
+            records = list(self.records)
+        for name, start, end in self.stages:
+            stats[name] = LatencyStats(name)
+            for record in records:
+                t0, t1 = getattr(record, start), getattr(record, end)
+                if t0 is not None and t1 is not None:
+                    stats[name].add(t1 - t0)
+        return stats
+
+    def device_intervals(self):
+        # time between consecutive device timestamps [s], to check the frame period and find dropped frames
+        stamps = [r.device_timestamp for r in self.records if r.device_timestamp is not None]
+        return np.diff(stamps)
+
+    def summary(self):
+        lines = [f'{len(self.records)} frames']
+        for stats in self.stage_stats().values():
+            if len(stats) > 0:
+                lines.append(stats.summary())
+        return '\n  '.join(lines)
+
+    def save(self, file_name):
+        # one CSV row per frame
+        import csv
+        with self.lock:
+            records = list(self.records)
+        with open(file_name, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=self.fields)
+            writer.writeheader()
+            for record in records:
+                writer.writerow(record.as_dict())
@@ -1,29 +1,24 @@
 import numpy as np
-from pylablib.devices import Thorlabs, Basler
-from pypylon import pylon     # https://github.com/basler/pypylon
-import platform
-import matplotlib.pyplot as plt
-from mpl_toolkits.axes_grid1 import make_axes_locatable
-from matplotlib.ticker import PercentFormatter
 from time import sleep
 import os
-# from pygrabber.dshow_graph import FilterGraph
-import cv2, queue, threading, time
-import pylablib
-
-pylablib.par["devices/dlls/basler_pylon"] = "C:/Basler/pylon/Runtime/x64/"
+import time
 
+from lazy_import import LazyModule
 
+# imported when the first stage is opened, so that the simulated stages work without the Thorlabs SDK
+Thorlabs = LazyModule('pylablib.devices.Thorlabs')
 
 
 ############################################# Translation stage ########################################################
 # - XY Stages: Thorlabs [Z825B](https://www.thorlabs.com/thorproduct.cfm?partnumber=Z825B) linear translation stage with [T-Cube DC Servo Controllers](https://www.thorlabs.com/newgrouppage9.cfm?objectgroup_id=5698)
 
 class KinesisStage():
-    def __init__(self, stage_type='LST150'):
+    def __init__(self, stage_type='LST150', move_timeout=60.0, settle_detector=None):
         super().__init__()
         self.stages = []
         self.stage_pos = []
+        self.move_timeout = move_timeout    # s, for all axes of one move together
+        self.settle_detector = settle_detector  # SettleDetector (settle_detector.py) used by wait_settled()
 
         # Set step size
         if stage_type == 'LST150':
@@ -60,25 +55,61 @@ class KinesisStage():
             self.stage_pos.append(stage.get_position())
 
 
+    def velocity_parameters(self):
+        # per-axis maximum velocity and acceleration, in steps/s and steps/s^2
+        params = [stage.get_velocity_parameters() for stage in self.stages]
+        return np.array([p.max_velocity for p in params]), np.array([p.acceleration for p in params])
+
+    def move_axes(self, pos, timeout=None):
+        # Start every axis, then wait for all of them: the axes travel at the same time, so a step takes the longest
+        # of the axis moves instead of their sum. If an axis fails or is not there within `timeout` s, all axes are
+        # stopped and a RuntimeError lists the error of every failed axis.
+        timeout = self.move_timeout if timeout is None else timeout
+        errors = {}
+        started = []
+        for idx, (stage, p) in enumerate(zip(self.stages, pos)):
+            try:
+                stage.move_to(p)
+                started.append(idx)
+            except Exception as e:
+                errors[idx] = e
+
+        deadline = time.perf_counter() + timeout
+        for idx in started:
+            try:
+                self.stages[idx].wait_move(timeout=max(deadline - time.perf_counter(), 0))
+            except Exception as e:
+                errors[idx] = e
+
+        if errors:
+            for stage in self.stages:
+                try:
+                    stage.stop()
+                except Exception:
+                    pass
+            message = '; '.join(f'axis {idx}: {type(e).__name__}: {e}' for idx, e in sorted(errors.items()))
+            raise RuntimeError(f'Stage move to {list(pos)} failed: {message}') from next(iter(errors.values()))
+
+    def wait_settled(self, pos=None):
+        # after a move: wait until every axis has stayed within the settle detector's tolerance of `pos` (or of
+        # where it came to rest) for its dwell time; returns the time spent
+        assert self.settle_detector is not None, 'no settle detector: KinesisStage(settle_detector=SettleDetector(...))'
+        return self.settle_detector.wait(self.stages, pos)
+
     def move_to_origin(self):
-        for stage, p in zip(self.stages, self.stage_pos):
-            stage.move_to(p)
-            stage.wait_move()
+        self.move_axes(self.stage_pos)
 
         print("Reset the stages.")
 
     def move_to(self, pos):
-        for stage, p in zip(self.stages, pos):
-            stage.move_to(p)
-            stage.wait_move()
+        self.move_axes(pos)
 
 
     def close(self):
-        for stage, pos in zip(self.stages, self.stage_pos):
-            stage.move_to(pos)
-            stage.wait_move()
-            stage.close()
+        try:
+            self.move_axes(self.stage_pos)
+        finally:
+            for stage in self.stages:
+                stage.close()
 
         print("Stages are closed.")
-
-